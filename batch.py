@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  batch module
+#
+#  Copyright © 2019 Favourix <vladimir.kokes@favourix.com
+#  This file is part of fx-drivers (Favourix OS Driver manager).
+#
+#  Favourix is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Favourix is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
+
+""" Driver detection over hardware inventories of many hosts
+
+An inventory has one row per PCI device with the columns host, class,
+vendor and device. class is the 24 bit PCI class code as found in sysfs.
+The compiled driver rules are applied to all rows at once with numpy,
+ids tables are searched in the compiled index without copying it.
+
+numpy is required, pyarrow only to read Parquet and Arrow files.
+"""
+
+import os
+import device
+
+COLUMNS = ("host", "class", "vendor", "device")
+
+
+def index_arrays(index):
+    """ Returns (keys, masks) arrays of a compiled ids index """
+    import numpy
+
+    records = numpy.frombuffer(index.records, dtype=[("key", "<u4"), ("mask", "<u4")])
+    return records["key"], records["mask"]
+
+
+def host_codes(hosts):
+    """ Returns (names, codes) for a column of host names """
+    import numpy
+
+    names, codes = numpy.unique(numpy.asarray(hosts), return_inverse=True)
+    return names, codes.reshape(-1)
+
+
+def default_table():
+    """ Returns rule table of the installed ids files, loading it on first use """
+    if device.RULE_TABLE is None:
+        device.load_ids()
+    return device.RULE_TABLE
+
+
+def detect_batch(hosts, classes, vendors, devices, host_count=None, table=None):
+    """ Computes driver bitmask of every host
+
+    hosts are integer host codes 0..host_count-1. Returns array of
+    masks indexed by host code, bit n set for rule n of table.
+    """
+    import numpy
+
+    table = table or default_table()
+
+    hosts = numpy.asarray(hosts, dtype=numpy.int64)
+    base_classes = numpy.asarray(classes, dtype=numpy.uint32) >> 16
+    vendors = numpy.asarray(vendors, dtype=numpy.uint32)
+    devices = numpy.asarray(devices, dtype=numpy.uint32) & 0xffff
+    keys = (vendors << 16) | devices
+    if host_count is None:
+        host_count = int(hosts.max()) + 1 if len(hosts) else 0
+
+    index_keys, index_masks = index_arrays(table.index)
+
+    if len(index_keys) == 0:
+        # No ids files, every lookup misses
+        found_masks = numpy.zeros(len(keys), dtype=numpy.uint32)
+    else:
+        position = numpy.searchsorted(index_keys, keys)
+        position[position == len(index_keys)] = 0
+        found_masks = numpy.where(index_keys[position] == keys, index_masks[position], 0).astype(numpy.uint32)
+
+    # Same dispatch as RuleTable.match, one (class, vendor) entry at a time
+    masks = numpy.zeros(len(keys), dtype=numpy.uint32)
+    for (class_id, vendor_id), (any_mask, ids_bits, device_masks) in table.dispatch.items():
+        selected = (base_classes == class_id) & (vendors == vendor_id)
+        if any_mask:
+            masks[selected] |= numpy.uint32(any_mask)
+        for index_bit, bit in ids_bits:
+            masks[selected & ((found_masks & index_bit) != 0)] |= numpy.uint32(bit)
+        for device_id, bit in device_masks.items():
+            masks[selected & (devices == device_id)] |= numpy.uint32(bit)
+
+    host_masks = numpy.zeros(host_count, dtype=numpy.uint32)
+    numpy.bitwise_or.at(host_masks, hosts, masks)
+    return host_masks
+
+
+def recommend(host_masks, table=None):
+    """ Returns index into table.driver_names of the preferred graphics driver per host, -1 if none """
+    import numpy
+
+    table = table or default_table()
+    recommended = numpy.full(len(host_masks), -1, dtype=numpy.int8)
+    for number in reversed(range(len(table.driver_names))):
+        if table.display_mask & (1 << number):
+            recommended[(host_masks & (1 << number)) != 0] = number
+    return recommended
+
+
+def read_lspci_dumps(paths):
+    """ Reads lspci -n outputs, one file per host named after it """
+    hosts = []
+    classes = []
+    vendors = []
+    devices = []
+    for path in paths:
+        host = os.path.basename(path)
+        with open(path) as dump:
+            for line in dump:
+                if not line.strip():
+                    continue
+                class_id, vendor_id, product_id = device.get_class_vendor_product(line)
+                hosts.append(host)
+                classes.append(int(class_id, 16) << 16)
+                vendors.append(int(vendor_id, 16))
+                devices.append(int(product_id, 16))
+    return {"host": hosts, "class": classes, "vendor": vendors, "device": devices}
+
+
+def read_inventory(path):
+    """ Reads inventory columns from a .parquet, .arrow/.feather or .npz file """
+    if path.endswith(".npz"):
+        import numpy
+        with numpy.load(path) as data:
+            return dict((column, data[column]) for column in COLUMNS)
+
+    if path.endswith(".parquet"):
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(path, columns=list(COLUMNS))
+    elif path.endswith((".arrow", ".feather")):
+        import pyarrow.feather
+        table = pyarrow.feather.read_table(path, columns=list(COLUMNS))
+    else:
+        raise ValueError("Unknown inventory format: {}".format(path))
+    return dict((column, table.column(column).to_numpy()) for column in COLUMNS)
+
+
+def detect_inventory(columns, table=None):
+    """ Returns [(host, recommended driver or None)] of an inventory """
+    table = table or default_table()
+    names, codes = host_codes(columns["host"])
+    host_masks = detect_batch(codes, columns["class"], columns["vendor"],
+                              columns["device"], host_count=len(names), table=table)
+    recommended = recommend(host_masks, table)
+    return [(str(name), table.driver_names[number] if number >= 0 else None)
+            for name, number in zip(names, recommended.tolist())]
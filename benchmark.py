@@ -0,0 +1,614 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  benchmark module
+#
+#  Copyright © 2019 Favourix <vladimir.kokes@favourix.com
+#  This file is part of fx-drivers (Favourix OS Driver manager).
+#
+#  Favourix is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Favourix is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
+
+""" Performance checks of fx-drivers
+
+Every check prints its measurements and exits with status 1 when a
+budget is exceeded, so it can be run from CI.
+"""
+
+import argparse
+import json
+import os
+import random
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# Cold start of the headless entry point, python's own startup included
+STARTUP_MODULE = "cli"
+STARTUP_BUDGET_MS = 100
+
+# Modules that must never be imported by the headless entry point
+STARTUP_FORBIDDEN = ("PyQt5",)
+
+# Time to first paint of the GUI with the offscreen Qt platform
+GUI_SCRIPT = "fx-drivers-qt.py"
+GUI_LOG_FILE = "installer.log"
+FIRST_PAINT_BUDGET_MS = 500
+
+# Stand-in for mkinitcpio, sleeps instead of building images
+MKINITCPIO_STUB = """#!/bin/sh
+echo "==> Building image from preset: $2"
+sleep {delay}
+echo "==> Image generation successful"
+"""
+
+# Plans computed per second from an in-memory state
+PLAN_BUDGET = 10000
+
+# (sysfs vendor id, lspci description) inputs, the classification itself
+# is checked by tests/test_devutils.py
+VENDOR_INPUTS = (
+    (0x10de, "NVIDIA Corporation GP107M [GeForce GTX 1050 Ti Mobile] (rev a1)"),
+    (0x1002, "Advanced Micro Devices, Inc. [AMD/ATI] Picasso (rev c2)"),
+    (0x8086, "Intel Corporation UHD Graphics 620 (rev 07)"),
+    (0x80ee, "InnoTek Systemberatung GmbH VirtualBox Graphics Adapter"),
+    (None, "NVIDIA Corporation TU116 [GeForce GTX 1660 SUPER] (rev a1)"),
+    (None, "ATI Technologies Inc RV280 [Radeon 9200 PRO]"),
+    (None, "Intel Corporation Xeon E3-1200 v3/4th Gen Core Processor Integrated Graphics Controller"),
+    (None, "Red Hat, Inc. Virtio GPU (rev 01)"))
+
+# Vendor classifications per second
+VENDOR_BUDGET = 1000000
+
+# Benchmark suite history and regression threshold
+HISTORY_PATH = os.path.join(BASE_PATH, "benchmark-history.json")
+HISTORY_RUNS = 50
+REGRESSION_THRESHOLD = 0.2
+
+# Sizes of the synthetic suite fixtures
+LSPCI_LINES = 20000
+LOCAL_PACKAGES = 5000
+IDS_ENTRIES = 100000
+SNAPSHOT_DEVICES = 200
+
+# Conflicts of the nouveau rule installed on the synthetic host
+NOUVEAU_CONFLICT_SAMPLE = ["nvidia-dkms", "nvidia-utils", "nvidia-settings", "bumblebee"]
+
+LOCAL_DESC = """%NAME%
+{name}
+
+%VERSION%
+{version}
+
+%DESC%
+Synthetic package {name}
+
+%PROVIDES%
+{provides}
+
+"""
+
+PRESET = """ALL_config="{config}"
+ALL_kver="/boot/vmlinuz-{kernel}"
+PRESETS=('default')
+default_image="/boot/initramfs-{kernel}.img"
+"""
+
+
+def parse_importtime(output):
+    """ Parses python -X importtime report
+
+    Returns list of (module, self us, cumulative us, nesting level).
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            # Header line
+            continue
+        name = fields[2].rstrip()
+        level = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(fields[0]), int(fields[1]), level))
+    return imports
+
+
+def bench_startup(cmd_line):
+    """ Checks import time of the headless entry point """
+    cmd = [sys.executable, "-X", "importtime", "-c", "import {}".format(STARTUP_MODULE)]
+    res = subprocess.run(cmd, cwd=BASE_PATH, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, universal_newlines=True)
+    if res.returncode != 0:
+        print(res.stderr)
+        return 1
+
+    imports = parse_importtime(res.stderr)
+    total_ms = sum(cumulative for _, _, cumulative, level in imports if level == 0) / 1000.0
+
+    print("startup: {0:.1f} ms (budget {1} ms)".format(total_ms, cmd_line.budget))
+    for name, own, _, _ in sorted(imports, key=lambda item: -item[1])[:cmd_line.top]:
+        print("  {0:8.1f} ms  {1}".format(own / 1000.0, name))
+
+    failed = False
+    for name, _, _, _ in imports:
+        if name.split(".")[0] in STARTUP_FORBIDDEN:
+            print("FAIL: {0} imports {1}".format(STARTUP_MODULE, name))
+            failed = True
+            break
+    if total_ms > cmd_line.budget:
+        print("FAIL: startup exceeds budget")
+        failed = True
+    return 1 if failed else 0
+
+
+def run_gui_probe(env):
+    """ Starts the GUI with --startup-probe, returns {event: ms since start} """
+    cmd = [sys.executable, GUI_SCRIPT, "--quiet", "--test", "--startup-probe"]
+    events = {}
+    start = time.monotonic()
+    process = subprocess.Popen(cmd, cwd=BASE_PATH, env=env, stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL, universal_newlines=True)
+    with process:
+        for line in process.stdout:
+            events.setdefault(line.strip(), (time.monotonic() - start) * 1000.0)
+    events["exit"] = (time.monotonic() - start) * 1000.0
+    return events
+
+
+def bench_gui(cmd_line):
+    """ Measures time to first paint of the GUI, with cold and warm icon cache """
+    try:
+        import PyQt5
+    except ImportError:
+        print("SKIP: PyQt5 is not installed")
+        return 0
+
+    # The GUI logs to installer.log of its working directory, BASE_PATH
+    log_path = os.path.join(BASE_PATH, GUI_LOG_FILE)
+    keep_log = os.path.exists(log_path)
+    try:
+        return run_gui_probes(cmd_line)
+    finally:
+        if not keep_log and os.path.exists(log_path):
+            os.remove(log_path)
+
+
+def run_gui_probes(cmd_line):
+    """ Runs the cold and warm GUI starts of bench_gui """
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp_path:
+        env = dict(os.environ, QT_QPA_PLATFORM="offscreen", XDG_CACHE_HOME=tmp_path,
+                   XDG_RUNTIME_DIR=tmp_path)
+        for label in ["cold"] + ["warm"] * cmd_line.runs:
+            events = run_gui_probe(env)
+            if "first-paint" not in events:
+                print("FAIL: {} start did not paint".format(label))
+                return 1
+            print("gui {0}: first paint {1:.0f} ms, detected {2:.0f} ms, exit {3:.0f} ms".format(
+                label, events["first-paint"], events.get("detected", float("nan")), events["exit"]))
+            if label == "warm" and events["first-paint"] > cmd_line.budget:
+                failed = True
+
+    if failed:
+        print("FAIL: first paint exceeds budget ({} ms)".format(cmd_line.budget))
+        return 1
+    return 0
+
+
+def bench_mkinitcpio(cmd_line):
+    """ Compares serial and parallel initramfs rebuild with a stub mkinitcpio """
+    import device
+
+    with tempfile.TemporaryDirectory() as tmp_path:
+        stub_path = os.path.join(tmp_path, "mkinitcpio")
+        with open(stub_path, "w") as stub:
+            stub.write(MKINITCPIO_STUB.format(delay=cmd_line.delay))
+        os.chmod(stub_path, os.stat(stub_path).st_mode | stat.S_IXUSR)
+
+        presets_path = os.path.join(tmp_path, "mkinitcpio.d")
+        os.mkdir(presets_path)
+        presets = ["linux-{}".format(index) for index in range(cmd_line.presets)]
+        for preset in presets:
+            with open(os.path.join(presets_path, preset + ".preset"), "w") as preset_file:
+                preset_file.write(PRESET.format(config=device.MKINITCPIO_CONF, kernel=preset))
+
+        device.MKINITCPIO = stub_path
+        device.MKINITCPIO_D = presets_path
+        presets = [preset for preset in device.find_presets()
+                   if device.MKINITCPIO_CONF in device.preset_configs(preset)]
+
+        start = time.monotonic()
+        device.rebuild_initramfs(presets, jobs=1)
+        serial = time.monotonic() - start
+
+        start = time.monotonic()
+        device.rebuild_initramfs(presets, jobs=cmd_line.jobs or len(presets))
+        parallel = time.monotonic() - start
+
+    speedup = serial / parallel
+    print("mkinitcpio: {0} presets, serial {1:.2f} s, parallel {2:.2f} s, speedup {3:.1f}x".format(
+        len(presets), serial, parallel, speedup))
+    if speedup < cmd_line.min_speedup:
+        print("FAIL: speedup below {}x".format(cmd_line.min_speedup))
+        return 1
+    return 0
+
+
+def synthetic_state(packages):
+    """ Returns planning state of a host with that many packages installed """
+    import localdb
+    import planner
+    import rules
+
+    versions = dict(("package-{}".format(index), "1.0-1") for index in range(packages))
+    versions.update(dict((name, "1.0-1") for name in rules.get_rule("nouveau")["conflicts"]))
+    provides = {"package-1": ["nvidia-utils", "opengl-driver"]}
+    return planner.SystemState(
+        "x86_64", True, "user", localdb.LocalDatabase(versions, provides, {}),
+        ['MODULES="nvidia ext4"\n'], ["linux", "linux-lts", "linux-zen"])
+
+
+def bench_plan(cmd_line):
+    """ Measures how many driver switch plans are computed per second """
+    import planner
+    import rules
+
+    system_state = synthetic_state(cmd_line.packages)
+    drivers = rules.DRIVERS
+    count = 0
+    start = time.monotonic()
+    while count < cmd_line.plans:
+        for driver in drivers:
+            planner.make_plan(driver, system_state)
+        count += len(drivers)
+    rate = count / (time.monotonic() - start)
+
+    print("plan: {0:.0f} plans/s with {1} installed packages (budget {2})".format(
+        rate, cmd_line.packages, cmd_line.budget))
+    if rate < cmd_line.budget:
+        print("FAIL: planning is slower than budget")
+        return 1
+    return 0
+
+
+def bench_vendor(cmd_line):
+    """ Measures the rate of vendor classification """
+    import devutils
+
+    rates = []
+    for label, inputs in (
+            ("vendor id", [item for item in VENDOR_INPUTS if item[0] is not None]),
+            ("text fallback", [item for item in VENDOR_INPUTS if item[0] is None])):
+        count = 0
+        start = time.monotonic()
+        while count < cmd_line.classifications:
+            for vendor_id, text in inputs:
+                devutils.classify_vendor(vendor_id, text)
+            count += len(inputs)
+        rate = count / (time.monotonic() - start)
+        rates.append(rate)
+        print("vendor: {0:.0f} classifications/s by {1}".format(rate, label))
+
+    if rates[0] < cmd_line.budget:
+        print("FAIL: classification by vendor id is slower than budget ({})".format(cmd_line.budget))
+        return 1
+    return 0
+
+
+def bench_batch(cmd_line):
+    """ Measures fleet detection throughput on a synthetic inventory """
+    try:
+        import numpy
+    except ImportError:
+        print("SKIP: numpy is not installed")
+        return 0
+    import batch
+    import device
+
+    device.load_ids()
+    keys, _ = batch.index_arrays(device.INDEX)
+    random = numpy.random.RandomState(0)
+    rows = cmd_line.devices
+    hosts = random.randint(0, cmd_line.hosts, rows)
+    classes = numpy.where(random.rand(rows) < 0.2, 0x030000, 0x020000)
+    known = random.choice(keys, rows)
+    vendors = known >> 16
+    devices = numpy.where(random.rand(rows) < 0.5, known & 0xffff, random.randint(0, 0xffff, rows))
+
+    start = time.monotonic()
+    batch.recommend(batch.detect_batch(hosts, classes, vendors, devices, cmd_line.hosts))
+    rate = rows / (time.monotonic() - start)
+
+    print("batch: {0:.1f} M devices/s over {1} hosts (budget {2} M)".format(
+        rate / 1e6, cmd_line.hosts, cmd_line.budget))
+    if rate < cmd_line.budget * 1e6:
+        print("FAIL: batch detection is slower than budget")
+        return 1
+    return 0
+
+
+def make_fixtures(path, seed=0):
+    """ Writes the suite fixtures to path, the same ones for a given seed
+
+    lspci.txt       lspci -n dump
+    pacman-Q.txt    pacman -Q output
+    local/          pacman local database
+    ids/            pci/*.ids tables
+    """
+    generator = random.Random(seed)
+    vendors = [0x10de, 0x1002, 0x8086, 0x14e4, 0x10ec, 0x1b21, 0x144d]
+    classes = ["0300", "0302", "0280", "0200", "0c03", "0604", "0108", "0403"]
+
+    with open(os.path.join(path, "lspci.txt"), "w") as dump:
+        for number in range(LSPCI_LINES):
+            dump.write("{0:02x}:{1:02x}.{2} {3}: {4:04x}:{5:04x} (rev {6:02x})\n".format(
+                number // 256 % 256, number % 32, number % 8, generator.choice(classes),
+                generator.choice(vendors), generator.randrange(0x10000), generator.randrange(256)))
+
+    names = ["package-{}".format(number) for number in range(LOCAL_PACKAGES)]
+    names[:len(NOUVEAU_CONFLICT_SAMPLE)] = NOUVEAU_CONFLICT_SAMPLE
+    local_path = os.path.join(path, "local")
+    os.mkdir(local_path)
+    with open(os.path.join(local_path, "ALPM_DB_VERSION"), "w") as version_file:
+        version_file.write("9\n")
+    with open(os.path.join(path, "pacman-Q.txt"), "w") as query:
+        for number, name in enumerate(names):
+            version = "{0}.{1}-1".format(number % 7, number % 13)
+            query.write("{0} {1}\n".format(name, version))
+            package_path = os.path.join(local_path, "{0}-{1}".format(name, version))
+            os.mkdir(package_path)
+            with open(os.path.join(package_path, "desc"), "w") as desc:
+                desc.write(LOCAL_DESC.format(
+                    name=name, version=version, provides="lib{0}.so=1-64\n{0}-virtual".format(name)))
+
+    ids_path = os.path.join(path, "ids")
+    os.mkdir(ids_path)
+    ids_files = ("nvidia", "nvidia-390xx", "nvidia-340xx", "amdgpu", "amdgpu_exp", "ati")
+    for name in ids_files:
+        entries = generator.sample(range(0x10000), IDS_ENTRIES // len(ids_files))
+        with open(os.path.join(ids_path, name + ".ids"), "w") as ids_file:
+            ids_file.write(" ".join("{:04x}".format(entry) for entry in entries))
+    return path
+
+
+def suite_cases(path):
+    """ Returns [(name, function)] of the suite on fixtures in path """
+    import devutils
+    import device
+    import localdb
+    import pciids
+    import planner
+    import rules
+
+    with open(os.path.join(path, "lspci.txt")) as dump:
+        lspci_lines = dump.read().splitlines()
+    with open(os.path.join(path, "pacman-Q.txt")) as query:
+        pacman_output = query.read()
+    ids_path = os.path.join(path, "ids")
+    local_path = os.path.join(path, "local")
+    local_cache = os.path.join(path, "localdb.json")
+    index = pciids.PciIdIndex(pciids.build_index(ids_path))
+    table = rules.RuleTable(index)
+
+    generator = random.Random(1)
+    keys = [key for key, _ in struct_records(index)]
+    devices = []
+    for number in range(SNAPSHOT_DEVICES):
+        key = generator.choice(keys)
+        class_id = generator.choice((0x030000, 0x020000, 0x0c0330, 0x060400))
+        devices.append(devutils.PciDevice(
+            "0000:{0:02x}:00.0".format(number), class_id, key >> 16, key & 0xffff, 0, 0))
+    snapshot = devutils.HardwareSnapshot("bench", devices, {})
+    detect_cache = os.path.join(path, "detect.json")
+
+    database = localdb.parse_local_db(local_path)
+    state = planner.SystemState(
+        "x86_64", True, "user", database, ['MODULES="nvidia ext4"\n'], ["linux", "linux-lts"])
+
+    def check_device(cache_path=None):
+        devutils.set_snapshot(snapshot)
+        device.INDEX, device.RULE_TABLE = index, table
+        return device.check_device(cache_path)
+
+    return [
+        ("get_class_vendor_product", lambda: [device.get_class_vendor_product(line) for line in lspci_lines]),
+        ("load_ids_file", lambda: pciids.load_ids_file(os.path.join(ids_path, "nvidia.ids"))),
+        ("build_index", lambda: pciids.build_index(ids_path)),
+        ("check_device", check_device),
+        ("check_device_cached", lambda: check_device(detect_cache)),
+        ("parse_pacman_q", lambda: set(line.split()[0] for line in pacman_output.splitlines())),
+        ("parse_local_db", lambda: localdb.parse_local_db(local_path)),
+        ("get_installed_packages", lambda: localdb.read_local_db(local_path, local_cache).names),
+        ("resolve_conflicts", lambda: planner.make_plan("nouveau", state)),
+    ]
+
+
+def struct_records(index):
+    """ Returns [(key, mask)] of a compiled ids index """
+    records = index.records.cast("I")
+    return list(zip(records[::2], records[1::2]))
+
+
+def measure(function, min_time):
+    """ Returns seconds per call, the best of five rounds taking min_time together
+
+    The best round is the one least disturbed by other processes.
+    """
+    function()
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 5:
+            break
+        calls *= 2
+    rounds = [elapsed / calls]
+    for _ in range(4):
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        rounds.append((time.perf_counter() - start) / calls)
+    return min(rounds)
+
+
+def git_revision():
+    """ Returns commit of the checkout, None outside of git """
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BASE_PATH,
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path):
+    """ Returns list of earlier suite runs, oldest first """
+    try:
+        with open(path) as history_file:
+            return json.load(history_file)
+    except (OSError, ValueError):
+        return []
+
+
+def baseline(history, name, runs):
+    """ Returns median result of name over the last runs, None if never measured """
+    results = [run["results"][name] for run in history[-runs:] if name in run["results"]]
+    if not results:
+        return None
+    return sorted(results)[len(results) // 2]
+
+
+def bench_suite(cmd_line):
+    """ Times the detection and planning hot paths, flags regressions against history """
+    history = load_history(cmd_line.history)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_path:
+        cases = suite_cases(make_fixtures(tmp_path))
+        for name, function in cases:
+            if cmd_line.only and name not in cmd_line.only:
+                continue
+            results[name] = measure(function, cmd_line.min_time)
+
+    failed = False
+    print("{0:26} {1:>12} {2:>12} {3:>8}".format("case", "time", "baseline", "change"))
+    for name, seconds in results.items():
+        reference = baseline(history, name, cmd_line.baseline_runs)
+        if reference is None:
+            print("{0:26} {1:>9.3f} ms {2:>12} {3:>8}".format(name, seconds * 1e3, "-", "-"))
+            continue
+        change = seconds / reference - 1
+        flag = ""
+        if change > cmd_line.threshold:
+            flag = "  REGRESSION"
+            failed = True
+        print("{0:26} {1:>9.3f} ms {2:>9.3f} ms {3:>+7.0%}{4}".format(
+            name, seconds * 1e3, reference * 1e3, change, flag))
+
+    if not cmd_line.no_save:
+        history.append({
+            "time": time.time(), "revision": git_revision(),
+            "python": sys.version.split()[0], "results": results})
+        with open(cmd_line.history, "w") as history_file:
+            json.dump(history[-HISTORY_RUNS:], history_file, indent=1)
+
+    if failed:
+        print("FAIL: slower than {0:.0%} over baseline".format(cmd_line.threshold))
+        return 1
+    return 0
+
+
+def parse_options():
+    """ Parse command line options """
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    startup_parser = subparsers.add_parser("startup", help="Import time of {}".format(STARTUP_MODULE))
+    startup_parser.add_argument("--budget", type=float, default=STARTUP_BUDGET_MS,
+                                help="Maximum startup time in ms")
+    startup_parser.add_argument("--top", type=int, default=10,
+                                help="Number of slowest modules to show")
+    startup_parser.set_defaults(func=bench_startup)
+
+    gui_parser = subparsers.add_parser("gui", help="Time to first paint of the GUI")
+    gui_parser.add_argument("--runs", type=int, default=3,
+                            help="Warm starts after the cold one")
+    gui_parser.add_argument("--budget", type=float, default=FIRST_PAINT_BUDGET_MS,
+                            help="Maximum warm time to first paint in ms")
+    gui_parser.set_defaults(func=bench_gui)
+
+    mkinitcpio_parser = subparsers.add_parser("mkinitcpio", help="Initramfs rebuild of several kernels")
+    mkinitcpio_parser.add_argument("--presets", type=int, default=4,
+                                   help="Number of installed kernels")
+    mkinitcpio_parser.add_argument("--delay", type=float, default=0.5,
+                                   help="Seconds one stub mkinitcpio run takes")
+    mkinitcpio_parser.add_argument("--jobs", type=int, default=None,
+                                   help="Concurrent runs, one per preset by default")
+    mkinitcpio_parser.add_argument("--min-speedup", type=float, default=1.5,
+                                   help="Minimum parallel over serial speedup")
+    mkinitcpio_parser.set_defaults(func=bench_mkinitcpio)
+
+    plan_parser = subparsers.add_parser("plan", help="Driver switch planning throughput")
+    plan_parser.add_argument("--plans", type=int, default=50000,
+                             help="Number of plans to compute")
+    plan_parser.add_argument("--packages", type=int, default=1500,
+                             help="Installed packages of the synthetic host")
+    plan_parser.add_argument("--budget", type=float, default=PLAN_BUDGET,
+                             help="Minimum plans per second")
+    plan_parser.set_defaults(func=bench_plan)
+
+    vendor_parser = subparsers.add_parser("vendor", help="GPU vendor classification")
+    vendor_parser.add_argument("--classifications", type=int, default=500000,
+                               help="Number of classifications per method")
+    vendor_parser.add_argument("--budget", type=float, default=VENDOR_BUDGET,
+                               help="Minimum classifications per second by vendor id")
+    vendor_parser.set_defaults(func=bench_vendor)
+
+    suite_parser = subparsers.add_parser("suite", help="Hot path timings with history and regression check")
+    suite_parser.add_argument("--history", default=HISTORY_PATH,
+                              help="History file, {} by default".format(os.path.basename(HISTORY_PATH)))
+    suite_parser.add_argument("--no-save", action="store_true",
+                              help="Do not add this run to the history")
+    suite_parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                              help="Slowdown over baseline flagged as regression")
+    suite_parser.add_argument("--baseline-runs", type=int, default=5,
+                              help="Earlier runs the baseline is the median of")
+    suite_parser.add_argument("--min-time", type=float, default=0.5,
+                              help="Seconds spent measuring each case")
+    suite_parser.add_argument("only", nargs="*", metavar="CASE",
+                              help="Run only these cases")
+    suite_parser.set_defaults(func=bench_suite)
+
+    batch_parser = subparsers.add_parser("batch", help="Fleet detection throughput")
+    batch_parser.add_argument("--devices", type=int, default=2000000,
+                              help="Rows of the synthetic inventory")
+    batch_parser.add_argument("--hosts", type=int, default=50000,
+                              help="Hosts of the synthetic inventory")
+    batch_parser.add_argument("--budget", type=float, default=1.0,
+                              help="Minimum millions of devices per second")
+    batch_parser.set_defaults(func=bench_batch)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    CMD_LINE = parse_options()
+    sys.exit(CMD_LINE.func(CMD_LINE))
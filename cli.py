@@ -0,0 +1,571 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  cli module
+#
+#  Copyright © 2019 Favourix <vladimir.kokes@favourix.com
+#  This file is part of fx-drivers (Favourix OS Driver manager).
+#
+#  Favourix is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Favourix is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
+
+""" Headless entry point of the driver manager
+
+Only argparse and the device modules are imported at startup. Hardware
+is probed when a command needs it and PyQt5 is loaded by the gui command
+only.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+# Subsystems are imported by the commands using them, see STARTUP_BUDGET_MS of benchmark
+import rules
+
+GUI_SCRIPT = "fx-drivers-qt.py"
+
+
+def parse_options(args=None):
+    """ Parse command line options """
+    parser = argparse.ArgumentParser(prog="drvmanager")
+
+    parser.add_argument(
+        "-q", "--quiet",
+        help="Supress log messages",
+        action="store_true")
+
+    parser.add_argument(
+        "--root", metavar="DIR",
+        help="Change the OS image mounted at DIR instead of the running system")
+
+    subparsers = parser.add_subparsers(dest="command")
+
+    gui_parser = subparsers.add_parser("gui", help="Start graphical driver manager (default)")
+    gui_parser.add_argument(
+        "-t", "--test",
+        help="Only log what would be done",
+        action="store_true")
+
+    detect_parser = subparsers.add_parser("detect", help="Show GPUs and drivers available for them")
+    detect_parser.add_argument(
+        "--no-cache",
+        help="Match devices against the ids files even if the result is cached",
+        action="store_true")
+    detect_parser.add_argument(
+        "--stats",
+        help="Show detection cache hits and misses of this run (totals are exported as metrics)",
+        action="store_true")
+
+    install_parser = subparsers.add_parser("install", help="Install a driver")
+    install_parser.add_argument("driver", choices=rules.DRIVERS)
+    install_parser.add_argument(
+        "-t", "--test",
+        help="Only log what would be done",
+        action="store_true")
+    install_parser.add_argument(
+        "--trace", metavar="FILE",
+        help="Write timing of the driver change to FILE in Chrome trace format")
+
+    subparsers.add_parser("state", help="Print state of this system used for planning")
+
+    status_parser = subparsers.add_parser("status", help="Show kernel drivers in use and their versions")
+    status_parser.add_argument(
+        "--json",
+        help="Print one json object per device",
+        action="store_true")
+
+    plan_parser = subparsers.add_parser("plan", help="Compute driver switch plans")
+    plan_parser.add_argument("driver", choices=rules.DRIVERS)
+    plan_parser.add_argument(
+        "states", nargs="*", metavar="STATE",
+        help="State files written by the state command, this system if none")
+    plan_parser.add_argument(
+        "--previous", metavar="PLANS",
+        help="Plans of an earlier run, print only plans which changed since")
+
+    apply_parser = subparsers.add_parser("apply", help="Execute a plan")
+    apply_parser.add_argument("plan", metavar="PLAN", help="Plan file, - for stdin")
+    apply_parser.add_argument(
+        "-t", "--test",
+        help="Only log what would be done",
+        action="store_true")
+    apply_parser.add_argument(
+        "--trace", metavar="FILE",
+        help="Write timing of the driver change to FILE in Chrome trace format")
+
+    reconcile_parser = subparsers.add_parser(
+        "reconcile", help="Install a driver, changing only what differs from this system")
+    reconcile_parser.add_argument("driver", choices=rules.DRIVERS)
+    reconcile_parser.add_argument(
+        "-t", "--test",
+        help="Only log what would be done",
+        action="store_true")
+    reconcile_parser.add_argument(
+        "--trace", metavar="FILE",
+        help="Write timing of the driver change to FILE in Chrome trace format")
+    reconcile_parser.add_argument(
+        "--json",
+        help="Print report of applied and skipped actions as json",
+        action="store_true")
+
+    batch_parser = subparsers.add_parser("batch", help="Recommend drivers for a fleet inventory")
+    batch_parser.add_argument(
+        "inventory", nargs="+", metavar="INVENTORY",
+        help="Parquet, Arrow or npz inventory, or lspci -n dumps with --lspci")
+    batch_parser.add_argument(
+        "--lspci",
+        help="Inventory files are lspci -n outputs named after their host",
+        action="store_true")
+
+    daemon_parser = subparsers.add_parser("daemon", help="Answer driver queries on a Unix socket")
+    daemon_parser.add_argument(
+        "--socket", default=None,
+        help="Socket path, /run/fx-drivers.sock by default")
+
+    watch_parser = subparsers.add_parser("watch", help="Print changes of drivers offered on PCI hotplug")
+    watch_parser.add_argument(
+        "--record", metavar="LOG",
+        help="Append snapshot and received events to an event log")
+    watch_parser.add_argument(
+        "--replay", metavar="LOG",
+        help="Apply events of a recorded log instead of listening to the kernel")
+
+    query_parser = subparsers.add_parser("query", help="Send a request to the running daemon")
+    query_parser.add_argument(
+        "method",
+        help="status, detect, installed, plan, install, refresh or job")
+    query_parser.add_argument(
+        "params", nargs="*", metavar="NAME=VALUE",
+        help="Request parameters, values are parsed as json when possible")
+    query_parser.add_argument(
+        "--socket", default=None,
+        help="Socket path of the daemon")
+
+    provision_parser = subparsers.add_parser(
+        "provision", help="Install drivers into many OS image roots in parallel")
+    provision_parser.add_argument(
+        "targets", nargs="*", metavar="IMAGE=DRIVER",
+        help="Image root directory and driver to install into it")
+    provision_parser.add_argument(
+        "--manifest", metavar="FILE",
+        help="Read more IMAGE=DRIVER targets from FILE, one per line")
+    provision_parser.add_argument(
+        "--log-dir", default="provision-logs", metavar="DIR",
+        help="Directory with a log directory per image")
+    provision_parser.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="Images provisioned at the same time, number of CPUs by default")
+    provision_parser.add_argument(
+        "--reconcile",
+        help="Change only what differs in every image",
+        action="store_true")
+    provision_parser.add_argument(
+        "-t", "--test",
+        help="Only log what would be done",
+        action="store_true")
+
+    prefetch_parser = subparsers.add_parser(
+        "prefetch", help="Download packages of all drivers to a local repository")
+    prefetch_parser.add_argument(
+        "--mirror", metavar="URL",
+        help="Server URL with $repo and $arch, file:// included, first of the mirrorlist by default")
+    prefetch_parser.add_argument(
+        "--repo-dir", default=None, metavar="DIR",
+        help="Local repository directory, /var/cache/fx-drivers/repo by default")
+    prefetch_parser.add_argument(
+        "--repos", default=None,
+        help="Comma separated sync repositories to resolve packages from, core,extra,multilib by default")
+    prefetch_parser.add_argument(
+        "--arch", default=None,
+        help="Architecture of the packages, the machine's by default")
+
+    subparsers.add_parser(
+        "rollback", help="Restore configuration files changed by the last driver change")
+
+    return parser.parse_args(args)
+
+
+def detect(cmd_line):
+    """ Prints detected GPUs and suitable drivers """
+    import detectcache
+    import device
+    import devutils
+    import tracing
+
+    snapshot = devutils.get_snapshot(devutils.SNAPSHOT_CACHE)
+    print("vendor: {}".format(devutils.get_gpu_vendor()))
+    for pci_device in snapshot.display_devices:
+        print("gpu: {0} {1}".format(pci_device.slot, snapshot.name(pci_device)))
+    drivers = device.check_device(None if cmd_line.no_cache else detectcache.DETECT_CACHE)
+    if drivers is None:
+        return 1
+    print("drivers: {}".format(" ".join(drivers)))
+    if cmd_line.stats:
+        cache = detectcache.DetectionCache.load(detectcache.DETECT_CACHE)
+        print("cache: {0} hits, {1} misses, {2} entries".format(
+            tracing.counter("cache_requests", cache="detection", result="hit"),
+            tracing.counter("cache_requests", cache="detection", result="miss"),
+            len(cache.entries)))
+    return 0
+
+
+def run_steps(steps):
+    """ Runs driver change steps, logging how long each took """
+    import device
+
+    for name, step in steps:
+        start = time.monotonic()
+        result = step()
+        device.log_info("{0} took {1:.1f} s", name, time.monotonic() - start)
+        if result is False:
+            return 1
+    return 0
+
+
+def run_driver_switch(driver, make_steps, trace=None, test=False):
+    """ Runs steps returned by make_steps() in one span
+
+    With trace, all spans are written there as Chrome trace afterwards.
+    Outcomes of real switches are exported as metrics.
+    """
+    import metrics
+    import tracing
+
+    result = 1
+    try:
+        with tracing.span("driver switch", driver=driver):
+            result = run_steps(make_steps())
+        return result
+    finally:
+        if not test:
+            metrics.record_switch(driver, result == 0)
+        if trace:
+            tracing.write_chrome_trace(trace)
+
+
+def install(cmd_line):
+    """ Installs a driver and runs its post installation actions """
+    import device
+    import planner
+
+    device.setup_logging(cmd_line)
+    return run_driver_switch(
+        cmd_line.driver,
+        lambda: planner.driver_change_steps(cmd_line.driver, cmd_line.test),
+        cmd_line.trace, cmd_line.test)
+
+
+def state(cmd_line):
+    """ Prints planning state of this system as json """
+    import planner
+
+    print(json.dumps(planner.read_system_state().to_dict(), sort_keys=True))
+    return 0
+
+
+def status(cmd_line):
+    """ Prints driver bound to every managed device and its module version """
+    import devutils
+    import driverstatus
+
+    snapshot = devutils.get_snapshot(devutils.SNAPSHOT_CACHE)
+    for item in driverstatus.report(snapshot):
+        if cmd_line.json:
+            print(json.dumps(item._asdict(), sort_keys=True))
+        else:
+            print("{0}: {1}".format(item.slot, driverstatus.describe(item)))
+    return 0
+
+
+def plan(cmd_line):
+    """ Prints one json line {"state": ..., "plan": ...} per state """
+    import planner
+
+    previous = {}
+    if cmd_line.previous:
+        with open(cmd_line.previous) as previous_file:
+            for line in previous_file:
+                entry = json.loads(line)
+                previous[entry["state"]] = planner.Plan.from_dict(entry["plan"])
+
+    if cmd_line.states:
+        states = []
+        for path in cmd_line.states:
+            with open(path) as state_file:
+                states.append((path, planner.SystemState.from_dict(json.load(state_file))))
+    else:
+        states = [("-", planner.read_system_state())]
+
+    for name, system_state in states:
+        driver_plan = planner.make_plan(cmd_line.driver, system_state)
+        if name in previous and not planner.diff_plans(previous[name], driver_plan):
+            continue
+        print(json.dumps({"state": name, "plan": driver_plan.to_dict()}, sort_keys=True))
+    return 0
+
+
+def apply(cmd_line):
+    """ Executes a plan printed by the plan command """
+    import device
+    import planner
+
+    device.setup_logging(cmd_line)
+    if cmd_line.plan == "-":
+        entry = json.load(sys.stdin)
+    else:
+        with open(cmd_line.plan) as plan_file:
+            entry = json.load(plan_file)
+    driver_plan = planner.Plan.from_dict(entry.get("plan", entry))
+    return run_driver_switch(
+        driver_plan.driver,
+        lambda: planner.plan_steps(driver_plan, cmd_line.test),
+        cmd_line.trace, cmd_line.test)
+
+
+def reconcile(cmd_line):
+    """ Runs the steps of a driver switch this system differs in, prints what was skipped """
+    import device
+    import planner
+
+    # Reading the state logs already
+    device.setup_logging(cmd_line)
+    steps, report = planner.reconcile_steps(cmd_line.driver, cmd_line.test)
+    result = 0
+    if steps:
+        result = run_driver_switch(cmd_line.driver, lambda: steps, cmd_line.trace, cmd_line.test)
+
+    if cmd_line.json:
+        print(json.dumps({
+            "driver": cmd_line.driver,
+            "test": cmd_line.test,
+            "success": result == 0,
+            "applied": [action for action, applied in report if applied],
+            "skipped": [action for action, applied in report if not applied]}, sort_keys=True))
+    else:
+        label = "would apply:" if cmd_line.test else "applied:"
+        for action, applied in report:
+            print("{0} {1}".format(label if applied else "skipped:", action))
+    return result
+
+
+def gui(cmd_line):
+    """ Starts the Qt user interface """
+    import runpy
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), GUI_SCRIPT)
+    sys.argv = [path]
+    if cmd_line.quiet:
+        sys.argv.append("--quiet")
+    if getattr(cmd_line, "test", False):
+        sys.argv.append("--test")
+    runpy.run_path(path, run_name="__main__")
+    return 0
+
+
+def batch(cmd_line):
+    """ Prints recommended driver of every host in an inventory """
+    import batch as batch_detection
+
+    if cmd_line.lspci:
+        columns = batch_detection.read_lspci_dumps(cmd_line.inventory)
+    elif len(cmd_line.inventory) == 1:
+        columns = batch_detection.read_inventory(cmd_line.inventory[0])
+    else:
+        sys.stderr.write("Only one inventory file can be read at once\n")
+        return 2
+
+    for host, driver in batch_detection.detect_inventory(columns):
+        print("{0} {1}".format(host, driver or "-"))
+    return 0
+
+
+def daemon(cmd_line):
+    """ Runs the driver manager daemon """
+    import daemon as driver_daemon
+    import device
+
+    device.setup_logging(cmd_line)
+    driver_daemon.serve(cmd_line.socket or driver_daemon.SOCKET_PATH)
+    return 0
+
+
+def watch(cmd_line):
+    """ Prints every change of the drivers offered as devices come and go """
+    import devutils
+    import hotplug
+
+    def changed(uevent, old, new):
+        print("{0} {1} {2}: {3} -> {4}".format(
+            time.strftime("%H:%M:%S"), uevent.action, uevent.env["PCI_SLOT_NAME"],
+            " ".join(old) or "-", " ".join(new) or "-"))
+        sys.stdout.flush()
+
+    if cmd_line.replay:
+        snapshot, events = hotplug.read_event_log(cmd_line.replay)
+        if snapshot is None:
+            snapshot = devutils.get_snapshot(devutils.SNAPSHOT_CACHE)
+    else:
+        snapshot = devutils.HardwareSnapshot.probe()
+        events = hotplug.netlink_events()
+
+    state = hotplug.DetectionState(snapshot)
+    print("drivers: {}".format(" ".join(state.drivers)))
+    try:
+        if cmd_line.record:
+            with open(cmd_line.record, "w") as log_file:
+                hotplug.watch(state, hotplug.record_events(events, log_file, snapshot), changed)
+        else:
+            hotplug.watch(state, events, changed)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def query(cmd_line):
+    """ Prints result of one daemon request as json """
+    import daemon as driver_daemon
+
+    params = {}
+    for param in cmd_line.params:
+        name, _, value = param.partition("=")
+        try:
+            params[name] = json.loads(value)
+        except ValueError:
+            params[name] = value
+
+    try:
+        result = driver_daemon.request(
+            cmd_line.method, params, cmd_line.socket or driver_daemon.SOCKET_PATH)
+    except OSError as err:
+        sys.stderr.write("Cannot reach fx-drivers daemon: {}\n".format(err))
+        return 1
+    except RuntimeError as err:
+        sys.stderr.write("{}\n".format(err))
+        return 1
+    print(json.dumps(result, sort_keys=True))
+    return 0
+
+
+def provision_images(cmd_line):
+    """ Installs drivers into image roots, prints one line per image """
+    import provision
+
+    try:
+        targets = [provision.parse_target(text) for text in cmd_line.targets]
+        if cmd_line.manifest:
+            targets += provision.read_manifest(cmd_line.manifest)
+    except (OSError, ValueError) as err:
+        sys.stderr.write("{}\n".format(err))
+        return 1
+    for target in targets:
+        if target.driver not in rules.DRIVERS or not os.path.isdir(target.root):
+            sys.stderr.write("Unknown driver or missing image: {0}={1}\n".format(*target))
+            return 1
+
+    failed = 0
+    results = provision.provision(
+        targets, cmd_line.log_dir, cmd_line.jobs, cmd_line.test, cmd_line.reconcile)
+    try:
+        for result in results:
+            state = "ok" if result.returncode == 0 else "FAILED"
+            print("{0} {1}: {2} in {3:.1f} s, log {4}".format(
+                result.target.root, result.target.driver, state, result.seconds, result.log_dir))
+            failed += result.returncode != 0
+    except ValueError as err:
+        sys.stderr.write("{}\n".format(err))
+        return 1
+    return 1 if failed else 0
+
+
+def prefetch(cmd_line):
+    """ Builds local repository with the packages of all drivers """
+    import pkgrepo
+
+    mirror = cmd_line.mirror
+    if mirror is None:
+        mirrors = pkgrepo.read_mirrors()
+        if not mirrors:
+            sys.stderr.write("No mirror in {}, use --mirror\n".format(pkgrepo.MIRRORLIST))
+            return 1
+        mirror = mirrors[0]
+    try:
+        repo = pkgrepo.prefetch(
+            mirror, cmd_line.repo_dir or pkgrepo.LOCAL_REPO,
+            cmd_line.repos.split(",") if cmd_line.repos else pkgrepo.SYNC_REPOS,
+            cmd_line.arch, log=print)
+    except (pkgrepo.RepoError, OSError) as err:
+        sys.stderr.write("Cannot prefetch packages: {}\n".format(err))
+        return 1
+    print("{0}: {1} packages".format(repo.path, len(repo.files)))
+    return 0
+
+
+def rollback(cmd_line):
+    """ Restores files of the last configuration transaction """
+    import device
+    import fstransaction
+
+    try:
+        paths = fstransaction.rollback(device.ROOT)
+    except OSError as err:
+        sys.stderr.write("Cannot restore configuration: {}\n".format(err))
+        return 1
+    if not paths:
+        print("Nothing to roll back")
+    for path in paths:
+        print("restored: {}".format(path))
+    return 0
+
+
+COMMANDS = {
+    None: gui,
+    "gui": gui,
+    "detect": detect,
+    "install": install,
+    "state": state,
+    "status": status,
+    "plan": plan,
+    "apply": apply,
+    "reconcile": reconcile,
+    "batch": batch,
+    "daemon": daemon,
+    "watch": watch,
+    "query": query,
+    "provision": provision_images,
+    "prefetch": prefetch,
+    "rollback": rollback}
+
+
+def main():
+    """ Runs command given on command line """
+    cmd_line = parse_options()
+    if cmd_line.root:
+        if not os.path.isdir(cmd_line.root):
+            sys.stderr.write("Image root {} is not a directory\n".format(cmd_line.root))
+            return 1
+        import device
+        device.ROOT = os.path.abspath(cmd_line.root)
+    try:
+        return COMMANDS[cmd_line.command](cmd_line)
+    finally:
+        # Test runs change nothing, they are not measured; commands
+        # measuring anything imported tracing
+        if not getattr(cmd_line, "test", False) and "tracing" in sys.modules:
+            import metrics
+            metrics.flush()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
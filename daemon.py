@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  daemon module
+#
+#  Copyright © 2019 Favourix <vladimir.kokes@favourix.com
+#  This file is part of fx-drivers (Favourix OS Driver manager).
+#
+#  Favourix is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Favourix is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
+
+""" Long running driver manager answering queries on a Unix socket
+
+The hardware snapshot, the compiled ids index with the rule table and the
+local package database are loaded once and kept in memory. Detection
+and package queries are answered from them without touching the disk.
+The pacman hook and hotplug events ask for a refresh of the part that
+changed.
+
+Protocol: one json object per line each way. A request is
+    {"id": any, "method": name, "params": {...}}
+and is answered with {"id": ..., "result": ...} or {"id": ..., "error": text}.
+
+Everything that changes the system or the daemon state (installs and
+refreshes) runs as a job on a single worker thread, in submission order.
+Jobs may be submitted by root only.
+"""
+
+import collections
+import itertools
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+import devutils
+import device
+import hotplug
+import metrics
+import planner
+import rules
+
+SOCKET_PATH = "/run/fx-drivers.sock"
+
+# Jobs kept for the job method after they finished
+FINISHED_JOBS = 100
+
+# Driver recommendation changes kept for the changes method
+CHANGES = 100
+
+
+class DaemonState(object):
+    """ Everything queries are answered from
+
+    Attributes are replaced as a whole by refreshes, never modified, so
+    readers need no lock; loaded and changes are only added to.
+    """
+
+    __slots__ = ("detection", "packages", "system", "loaded", "changes")
+
+    def __init__(self):
+        self.detection = None
+        self.packages = None
+        # planner.SystemState, re-read with the packages after every switch
+        self.system = None
+        self.loaded = {}
+        # (time, uevent action, slot, old drivers, new drivers)
+        self.changes = collections.deque(maxlen=CHANGES)
+
+    def refresh_ids(self):
+        """ Reloads ids index and rule table if an .ids file changed """
+        device.load_ids()
+        self.loaded["ids"] = time.time()
+
+    def refresh_hardware(self):
+        """ Probes sysfs again and re-runs detection """
+        snapshot = devutils.HardwareSnapshot.probe()
+        devutils.set_snapshot(snapshot, devutils.SNAPSHOT_CACHE)
+        self.detection = hotplug.DetectionState(snapshot)
+        self.loaded["hardware"] = time.time()
+
+    def apply_uevent(self, uevent):
+        """ Updates detection for the one device a uevent is about """
+        old = self.detection
+        new = old.apply(uevent)
+        if new is old:
+            return
+        self.detection = new
+        # Other processes read the cache, keep it in step with the hardware
+        devutils.set_snapshot(new.snapshot, devutils.SNAPSHOT_CACHE)
+        if new.drivers != old.drivers:
+            device.log_info("Drivers offered changed after {0} of {1}: {2} -> {3}",
+                            uevent.action, uevent.env["PCI_SLOT_NAME"],
+                            " ".join(old.drivers) or "-", " ".join(new.drivers) or "-")
+            self.changes.append((time.time(), uevent.action, uevent.env["PCI_SLOT_NAME"], old.drivers, new.drivers))
+
+    def refresh_packages(self):
+        """ Rereads the local package database if it changed, and the planning state with it """
+        self.packages = device.get_local_db()
+        self.system = planner.read_system_state(self.packages)
+        self.loaded["packages"] = time.time()
+
+    def refresh(self, what=("ids", "hardware", "packages")):
+        """ Refreshes parts of the state, ids before hardware """
+        for part in ("ids", "hardware", "packages"):
+            if part in what:
+                getattr(self, "refresh_" + part)()
+
+
+class Job(object):
+    """ Queued system or state change """
+
+    __slots__ = ("id", "kind", "params", "state", "output", "started", "finished")
+
+    def __init__(self, job_id, kind, params):
+        self.id = job_id
+        self.kind = kind
+        self.params = params
+        self.state = "queued"
+        self.output = []
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        """ Returns job as json serializable dictionary """
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class JobQueue(object):
+    """ Runs jobs one at a time on a worker thread """
+
+    def __init__(self, state):
+        self.state = state
+        self.jobs = {}
+        self.pending = queue.Queue()
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+        self.worker = threading.Thread(target=self.run, name="fx-drivers-jobs", daemon=True)
+
+    def start(self):
+        """ Starts the worker thread """
+        self.worker.start()
+
+    def submit(self, kind, params):
+        """ Queues a job, returns its id """
+        with self.lock:
+            job = Job(next(self.counter), kind, params)
+            self.jobs[job.id] = job
+            finished = [job_id for job_id in sorted(self.jobs)
+                        if self.jobs[job_id].state in ("done", "failed")]
+            for job_id in finished[:-FINISHED_JOBS]:
+                del self.jobs[job_id]
+        self.pending.put(job)
+        return job.id
+
+    def get(self, job_id):
+        """ Returns job of job_id, None if unknown """
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def run(self):
+        """ Worker thread main loop """
+        while True:
+            job = self.pending.get()
+            job.state = "running"
+            job.started = time.time()
+            try:
+                ok = getattr(self, "run_" + job.kind)(job)
+            except Exception as err:
+                device.log_error("Job {0} {1} failed: {2}", job.id, job.kind, err)
+                ok = False
+            job.state = "done" if ok else "failed"
+            job.finished = time.time()
+            if job.kind == "install" and not job.params.get("test", False):
+                metrics.record_switch(job.params["driver"], ok)
+            metrics.flush()
+
+    def run_refresh(self, job):
+        """ Refreshes daemon state """
+        self.state.refresh(job.params.get("what", ("ids", "hardware", "packages")))
+        return True
+
+    def run_hotplug(self, job):
+        """ Applies a PCI uevent """
+        self.state.apply_uevent(hotplug.Uevent(**job.params))
+        return True
+
+    def run_install(self, job):
+        """ Switches driver, then rereads the installed packages """
+        device.OUTPUT = job.output.append
+        try:
+            for _, step in planner.driver_change_steps(job.params["driver"], job.params.get("test", False)):
+                if step() is False:
+                    return False
+            return True
+        finally:
+            device.OUTPUT = None
+            self.state.refresh_packages()
+
+
+def installed_drivers(packages):
+    """ Returns drivers whose packages are all installed """
+    return [rule["driver"] for rule in rules.RULES
+            if rule.get("packages") and all(name in packages for name in rule["packages"])]
+
+
+def peer_uid(connection):
+    """ Returns uid of the process on the other end of a Unix socket """
+    creds = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    return struct.unpack("3i", creds)[1]
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """ Answers json requests of one connection """
+
+    def handle(self):
+        uid = peer_uid(self.connection)
+        for line in self.rfile:
+            request_id = None
+            try:
+                request = json.loads(line.decode())
+                request_id = request.get("id")
+                result = self.server.call(request["method"], request.get("params") or {}, uid)
+                response = {"id": request_id, "result": result}
+            except (ValueError, KeyError, TypeError, AttributeError, OSError) as err:
+                response = {"id": request_id, "error": str(err) or type(err).__name__}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ Unix socket server dispatching requests to query_* methods """
+
+    daemon_threads = True
+
+    # Methods allowed to root only
+    PRIVILEGED = ("install", "refresh")
+
+    def __init__(self, path=SOCKET_PATH):
+        self.state = DaemonState()
+        self.state.refresh()
+        self.jobs = JobQueue(self.state)
+        self.started = time.time()
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+        # Queries are open to everybody, changes are checked per request
+        os.chmod(path, 0o666)
+        # Threads start once the socket is bound, a failed bind leaves none running
+        self.jobs.start()
+        self.watcher = threading.Thread(target=self.watch, name="fx-drivers-hotplug", daemon=True)
+        self.watcher.start()
+
+    def call(self, method, params, uid):
+        """ Runs one request method """
+        handler = getattr(self, "query_" + method, None)
+        if handler is None:
+            raise ValueError("Unknown method: {}".format(method))
+        if method in self.PRIVILEGED and uid != 0:
+            raise PermissionError("{} requires administrative privileges".format(method))
+        return handler(**params)
+
+    def watch(self):
+        """ Queues a hotplug job for every PCI device added or removed """
+        try:
+            for uevent in hotplug.netlink_events():
+                if uevent.env.get("SUBSYSTEM") == "pci" and uevent.action in ("add", "remove"):
+                    self.jobs.submit("hotplug", uevent._asdict())
+        except OSError as err:
+            device.log_warning("Cannot watch PCI hotplug events: {}", err)
+
+    def query_status(self):
+        """ Daemon uptime and state age """
+        return {"pid": os.getpid(), "uptime": time.time() - self.started,
+                "loaded": dict(self.state.loaded)}
+
+    def query_detect(self):
+        """ GPUs and drivers offered for the hardware """
+        detection = self.state.detection
+        snapshot = detection.snapshot
+        return {
+            "vendor": devutils.classify_vendor(
+                snapshot.gpu.vendor_id, snapshot.name(snapshot.gpu)) if snapshot.gpu else "unknown",
+            "gpus": [{"slot": pci_device.slot, "name": snapshot.name(pci_device)}
+                     for pci_device in snapshot.display_devices],
+            "drivers": list(detection.drivers)}
+
+    def query_changes(self):
+        """ Latest changes of the drivers offered, oldest first """
+        return [{"time": when, "action": action, "slot": slot, "old": old, "new": new}
+                for when, action, slot, old, new in list(self.state.changes)]
+
+    def query_installed(self):
+        """ Drivers whose packages are installed """
+        return installed_drivers(self.state.packages)
+
+    def query_plan(self, driver):
+        """ Plan of a driver switch on this system """
+        rules.get_rule(driver)
+        return planner.make_plan(driver, self.state.system).to_dict()
+
+    def query_install(self, driver, test=False):
+        """ Queues a driver switch, returns job id """
+        rules.get_rule(driver)
+        return self.jobs.submit("install", {"driver": driver, "test": bool(test)})
+
+    def query_refresh(self, what=("ids", "hardware", "packages")):
+        """ Queues a state refresh, returns job id """
+        if isinstance(what, str):
+            what = [what]
+        return self.jobs.submit("refresh", {"what": list(what)})
+
+    def query_job(self, job):
+        """ State and output of a job """
+        queued = self.jobs.get(job)
+        if queued is None:
+            raise ValueError("Unknown job: {}".format(job))
+        return queued.to_dict()
+
+
+def serve(path=SOCKET_PATH):
+    """ Runs the daemon until interrupted """
+    server = DaemonServer(path)
+    device.log_info("Listening on {}", path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def request(method, params=None, path=SOCKET_PATH, timeout=10):
+    """ Sends one request to a running daemon, returns its result
+
+    Raises OSError if the daemon does not run and RuntimeError with the
+    daemon's error message if the request failed.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    with client:
+        client.connect(path)
+        client.sendall(json.dumps({"id": 1, "method": method, "params": params or {}}).encode() + b"\n")
+        reply = client.makefile("rb").readline()
+    response = json.loads(reply.decode())
+    if "error" in response:
+        raise RuntimeError(response["error"])
+    return response["result"]
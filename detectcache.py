@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  detectcache module
+#
+#  Copyright © 2019 Favourix <vladimir.kokes@favourix.com
+#  This file is part of fx-drivers (Favourix OS Driver manager).
+#
+#  Favourix is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Favourix is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
+
+""" Persistent cache of detected drivers
+
+Results are keyed on a hardware fingerprint: the sorted PCI ids of all
+devices, the stamp of the pci/*.ids files, the driver rules and the
+kernel release. A warm start therefore needs neither the compiled ids
+index nor the rule table. The least recently used entries are evicted
+when the cache grows beyond max_entries.
+
+The file is written when an entry is added and when a hit finds its
+entry last used more than USED_INTERVAL ago, so most warm starts only
+read it. Hits and misses are counted with tracing.count(), per process.
+"""
+
+import hashlib
+import json
+import os
+import time
+import pciids
+import rules
+import tracing
+
+DETECT_CACHE = "/var/cache/fx-drivers/detect.json"
+
+MAX_ENTRIES = 32
+
+# Seconds a hit may lag behind in the stored use time of its entry
+USED_INTERVAL = 3600
+
+# Digest of the matching part of the rules, see rules_digest()
+_RULES_DIGEST = None
+
+
+def rules_digest():
+    """ Returns digest of everything detection reads from rules.RULES """
+    global _RULES_DIGEST
+    if _RULES_DIGEST is None:
+        matching = [
+            [rule["driver"], rule["class"], rule["vendor"], rule.get("ids"),
+             rule.get("devices"), rule.get("any_device", False)]
+            for rule in rules.RULES]
+        _RULES_DIGEST = hashlib.sha256(json.dumps(matching).encode()).hexdigest()
+    return _RULES_DIGEST
+
+
+def fingerprint(snapshot, ids_path=pciids.IDS_PATH, release=None):
+    """ Returns cache key of the hardware in snapshot """
+    if release is None:
+        release = os.uname().release
+    key = hashlib.sha256()
+    for pci_device in sorted(snapshot.devices, key=lambda item: item[1:4]):
+        key.update("{0}:{1}:{2}\n".format(*pci_device[1:4]).encode())
+    key.update(pciids.compute_stamp(ids_path))
+    key.update(rules_digest().encode())
+    key.update(release.encode())
+    return key.hexdigest()
+
+
+class DetectionCache(object):
+    """ Detected drivers by hardware fingerprint """
+
+    __slots__ = ("path", "max_entries", "entries", "changed")
+
+    def __init__(self, path=DETECT_CACHE, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = {}
+        # Entries differ from the file
+        self.changed = False
+
+    @classmethod
+    def load(cls, path=DETECT_CACHE, max_entries=MAX_ENTRIES):
+        """ Reads cache from path, an unreadable file gives an empty cache """
+        cache = cls(path, max_entries)
+        try:
+            with open(path) as cache_file:
+                data = json.load(cache_file)
+            cache.entries = dict(data["entries"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return cache
+
+    def get(self, key):
+        """ Returns cached drivers of key or None, counting the hit or miss """
+        entry = self.entries.get(key)
+        tracing.count("cache_requests", cache="detection", result="miss" if entry is None else "hit")
+        if entry is None:
+            return None
+        now = time.time()
+        if now - entry["used"] > USED_INTERVAL:
+            entry["used"] = now
+            self.changed = True
+        return list(entry["drivers"])
+
+    def put(self, key, drivers):
+        """ Stores drivers of key, evicting least recently used entries """
+        self.entries[key] = {"drivers": list(drivers), "used": time.time()}
+        self.changed = True
+        if len(self.entries) > self.max_entries:
+            by_use = sorted(self.entries, key=lambda item: self.entries[item]["used"])
+            for old_key in by_use[:len(self.entries) - self.max_entries]:
+                del self.entries[old_key]
+
+    def to_dict(self):
+        """ Returns cache as json serializable dictionary """
+        return {"entries": self.entries}
+
+    def save(self):
+        """ Writes cache atomically, ignoring unwritable locations """
+        tmp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, 'w') as cache_file:
+                json.dump(self.to_dict(), cache_file)
+            os.replace(tmp_path, self.path)
+            self.changed = False
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
@@ -23,78 +23,71 @@
 
 
 import argparse
+import concurrent.futures
 import getpass
 import os
 import logging
+import re
 import subprocess
 import sys
+import time
+import detectcache
 import devutils
+import dkmscache
+import fstransaction
+import localdb
+import pciids
+import pkgbackend
+import pkgrepo
+import rules
+import tracing
 
 LOG_FILE = "installer.log"
 
+LOCAL_DB_CACHE = "/var/cache/fx-drivers/localdb.json"
+
+# Modules built by DKMS, shared by hosts when it is a network mount
+DKMS_CACHE = dkmscache.DKMS_CACHE
+
+NVIDIA_SETTINGS_DESKTOP = "/usr/share/applications/nvidia-settings.desktop"
+NVIDIA_SETTINGS_EXEC = "Exec=/usr/bin/nvidia-settings"
+OPTIRUN_EXEC = "Exec=optirun -b none /usr/bin/nvidia-settings -c :8"
+
+SYSTEMD_UNITS_PATH = "/usr/lib/systemd/system"
+SYSTEMD_CONFIG_PATH = "/etc/systemd/system"
+
+LTS_KERNEL = "/boot/vmlinuz-linux-lts"
+
+MKINITCPIO = "mkinitcpio"
+MKINITCPIO_CONF = "/etc/mkinitcpio.conf"
+MKINITCPIO_D = "/etc/mkinitcpio.d"
+
+# Number of presets rebuilt at the same time
+MKINITCPIO_JOBS = os.cpu_count() or 1
+
+# ALL_config= or <image>_config= line of a mkinitcpio preset
+PRESET_CONFIG = re.compile(r"""^\s*\w+_config=["']?([^"'\s]+)""")
+
 IDS_PATH = "pci"
 
-YELLOW = '\033[93m'
-GREEN = '\033[92m'
-RED = '\033[91m'
-ENDC = '\033[0m'
-BOLD = '\033[1m'
-
-DEVICES = {
-    "nvidia" : [],
-    "nvidia-390xx" : [],
-    "nvidia-340xx" : []
-}
-
-
-CLASS_ID = "0x03"
-VENDOR_ID = str(devutils.get_gpu_vendor_id())
-
-PACKAGES = {
-    "nouveau": ["xf86-video-nouveau", "mesa"],
-    "nvidia": ["nvidia-dkms", "libvdpau"],
-    "nvidia-390xx": ["nvidia-390xx-dkms", "libvdpau"],
-    "nvidia-340xx": ["nvidia-340xx-dkms", "libvdpau"],
-    "bumblebee": ["bumblebee", "mesa", "xf86-video-intel",
-                  "nvidia-dkms", "virtualgl", "nvidia-settings", "bbswitch-dkms"]}
-
-PACKAGES_LTS = {
-    "nouveau": [],
-    "nvidia": ["nvidia-dkms"],
-    "nvidia-390xx": ["nvidia-390xx-dkms"],
-    "nvidia-340xx": ["nvidia-340xx-dkms"],
-    "bumblebee": ["nvidia-dkms", "bbswitch-dkms"]}
-
-PACKAGES_X86_64 = {
-    "nouveau": ["lib32-mesa"],
-    "nvidia": ["lib32-nvidia-utils", "lib32-libvdpau"],
-    "nvidia-390xx": ["lib32-nvidia-390xx-utils", "lib32-libvdpau"],
-    "nvidia-340xx": ["lib32-nvidia-340xx-utils", "lib32-libvdpau"],
-    "bumblebee": ["lib32-nvidia-utils", "lib32-virtualgl", "lib32-mesa"]}
-
-CONFLICTS = {
-    "nouveau": ["nvidia-dkms", "nvidia-dkms", "nvidia-utils",
-                "nvidia-390xx", "nvidia-390xx-dkms", "nvidia-390xx-utils",
-                "nvidia-340xx", "nvidia-340xx-dkms", "nvidia-340xx-utils",
-                "nvidia-304xx", "nvidia-304xx-lts", "nvidia-304xx-utils",
-                "bumblebee", "virtualgl", "nvidia-settings", "bbswitch", "bbswitch-dkms"],
-    "nvidia": ["xf86-video-nouveau"],
-    "nvidia-390xx": ["xf86-video-nouveau"],
-    "nvidia-340xx": ["xf86-video-nouveau"],
-    "bumblebee": ["xf86-video-nouveau",
-                  "nvidia-390xx-utils", "nvidia-340xx-utils", "nvidia-304xx-utils"]}
-
-CONFLICTS_X86_64 = {
-    "nouveau": ["lib32-nvidia-340xx-utils",
-                "lib32-nvidia-304xx-utils", "lib32-nvidia-utils", "lib32-virtualgl"],
-    "nvidia": ["lib32-nvidia-340xx-utils",
-               "lib32-nvidia-304xx-utils"],
-    "nvidia-390xx": ["lib32-nvidia-utils",
-                     "lib32-nvidia-390xx-utils"],
-    "nvidia-340xx": ["lib32-nvidia-utils",
-                     "lib32-nvidia-340xx-utils"],
-    "bumblebee": ["lib32-nvidia-390xx-utils",
-                  "lib32-nvidia-340xx-utils", "lib32-nvidia-304xx-utils"]}
+# Root directory of the system we change, another one is a mounted
+# image: files are resolved below it, pacman runs with --sysroot,
+# systemctl with --root and mkinitcpio through CHROOT
+ROOT = "/"
+
+CHROOT = "chroot"
+
+# Compiled pci ids index, see load_ids()
+INDEX = None
+
+# Driver rules compiled against INDEX, see load_ids()
+RULE_TABLE = None
+
+# Package backend, see get_backend()
+BACKEND = None
+
+# Called with every output line of the commands we run, if set
+OUTPUT = None
 
 def parse_options():
     # Parse command line options
@@ -105,6 +98,20 @@ def parse_options():
         help="Supress log messages",
         action="store_true")
 
+    parser.add_argument(
+        "-t", "--test",
+        help="Only log what would be done",
+        action="store_true")
+
+    parser.add_argument(
+        "--trace", metavar="FILE",
+        help="Write timing of a driver change to FILE in Chrome trace format")
+
+    # Prints first-paint and detected, then quits, see benchmark.py gui
+    parser.add_argument(
+        "--startup-probe",
+        help=argparse.SUPPRESS,
+        action="store_true")
 
     return parser.parse_args()
 
@@ -118,107 +125,177 @@ def get_class_vendor_product(line):
     return (class_id, vendor_id, product_id)
 
 
-def check_device():
-    """ Tries to guess if a device suitable for this driver is present """
+def check_device(cache_path=None):
+    """ Returns drivers offered for the devices present, most preferred first
+
+    With cache_path the result is looked up in and stored to the
+    detection cache, see detectcache.
+    """
     try:
-        cmd = ["/usr/bin/lspci", "-n"]
-        lines = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        lines = lines.decode().split("\n")
-    except subprocess.CalledProcessError as err:
-        log_warning("Cannot detect hardware components : {}".format(err.output.decode()))
+        snapshot = devutils.get_snapshot()
+    except OSError as err:
+        log_warning("Cannot detect hardware components : {}", err)
+        return None
+
+    with tracing.span("detection"):
+        if cache_path:
+            cache = detectcache.DetectionCache.load(cache_path)
+            key = detectcache.fingerprint(snapshot, IDS_PATH)
+            drivers = cache.get(key)
+            if drivers is None:
+                drivers = match_devices(snapshot)
+                cache.put(key, drivers)
+            if cache.changed:
+                cache.save()
+            return drivers
+
+        return match_devices(snapshot)
+
+
+def match_devices(snapshot):
+    """ Returns graphics drivers offered for the devices of a snapshot """
+    if RULE_TABLE is None:
+        load_ids()
+
+    mask = 0
+    for pci_device in snapshot.devices:
+        if None not in (pci_device.class_id, pci_device.vendor_id, pci_device.device_id):
+            mask |= RULE_TABLE.match(pci_device.class_id, pci_device.vendor_id, pci_device.device_id)
+    return RULE_TABLE.drivers(mask & RULE_TABLE.display_mask)
+
+
+def root_path(path):
+    """ Returns location of an absolute path of the system below ROOT """
+    return fstransaction.resolve(ROOT, path)
+
+
+def get_backend():
+    """ Returns package backend, created on first use """
+    global BACKEND
+    if BACKEND is None:
+        BACKEND = pkgbackend.default_backend(root=ROOT)
+    return BACKEND
+
+
+def local_repo_config(packages):
+    """ Returns pacman config of the prefetched repository if it has all packages """
+    if ROOT != "/":
+        # pacman --sysroot reads its config inside the image
+        return None
+    repo = pkgrepo.LocalRepo.load(pkgrepo.LOCAL_REPO)
+    if repo is None:
         return None
+    if not repo.covers(packages):
+        log_info("Local package repository lacks packages, installing from the network")
+        return None
+    if not repo.is_current(packages):
+        log_info("Local package repository is out of date, installing from the network")
+        return None
+    try:
+        return repo.activate()
+    except OSError as err:
+        msg = "Cannot use local package repository: {}"
+        log_warning(msg, err)
+        return None
+
 
-    drivers = []
-    for line in lines:
-        if line:
-            class_id, vendor_id, product_id = get_class_vendor_product(line)
-
-            if class_id == CLASS_ID and vendor_id == VENDOR_ID:
-                for driver in DEVICES:
-                    if product_id in DEVICES[driver]:
-                        drivers.append(driver)
-    return drivers
-
-
-def install(driver, TEST):
-    """ Performs packages installation """
-
-    packages = PACKAGES[driver]
-    conflicts = CONFLICTS[driver]
-
-    if os.uname()[-1] == "x86_64":
-        packages.extend(PACKAGES_X86_64[driver])
-        conflicts.extend(CONFLICTS_X86_64[driver])
-
-    if os.path.exists('/boot/vmlinuz-linux-lts'):
-        packages.extend(PACKAGES_LTS[driver])
-
-    log_info("Removing conflicting packages...")
-    installed_packages = get_installed_packages()
-
-    cmd = ["pacman", "-Rs", "--noconfirm", "--noprogressbar", "--nodeps"]
-    for conflict in conflicts:
-        if conflict in installed_packages:
-            if TEST:
-                log_info(" ".join(cmd + [conflict]))
-            else:
-                try:
-                    subprocess.check_output(cmd + [conflict], stderr=subprocess.STDOUT)
-                except subprocess.CalledProcessError as err:
-                    msg = "Cannot remove conflicting package {0}: {1}"
-                    log_error(msg.format(conflict, err.output.decode()))
-                    return False
-
-    log_info("Downloading and installing driver packages, please wait...")
-    cmd = ["pacman", "-Sqy", "--noconfirm", "--noprogressbar"]
-    cmd.extend(packages)
-    if TEST:
-        log_info(" ".join(cmd))
+def change_packages(remove, packages):
+    """ Removes conflicting and installs driver packages in one transaction
+
+    Packages come from the prefetched repository when it has all of them,
+    the sync databases are refreshed otherwise.
+    """
+    config = local_repo_config(packages)
+    if config is None:
+        log_info("Removing conflicting packages, downloading and installing driver packages, please wait...")
     else:
+        log_info("Removing conflicting packages and installing driver packages from {}...", pkgrepo.LOCAL_REPO)
+    try:
+        backend = get_backend() if config is None else pkgbackend.default_backend(config)
+        dkms = [name for name in packages if name in dkmscache.DKMS_PACKAGES]
+        if dkms:
+            cache, seeded = seed_dkms_modules(backend, dkms)
         try:
-            subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as err:
-            msg = "Cannot install required packages: {}"
-            log_error(msg.format(err.output.decode()))
-            return False
-
+            backend.transaction(remove, packages, refresh=config is None, output=OUTPUT)
+        finally:
+            if dkms:
+                collect_dkms_modules(cache, dkms, seeded)
+    except pkgbackend.PackageError as err:
+        msg = "Cannot change driver packages: {}"
+        log_error(msg, err)
+        return False
     return True
 
 
-def get_installed_packages():
-    """ Gets a list of all installed packages """
-    installed_packages = []
+def installed_versions(names):
+    """ Returns {name: version} of installed packages among names """
+    return localdb.installed_versions(names, root_path(localdb.LOCAL_DB_PATH))
+
+
+def seed_dkms_modules(backend, packages):
+    """ Unpacks cached DKMS builds of packages about to be installed
+
+    Returns the cache and the seeded build directories.
+    """
+    cache = dkmscache.ModuleCache(DKMS_CACHE)
+    gcc_version = installed_versions([dkmscache.COMPILER_PACKAGE]).get(dkmscache.COMPILER_PACKAGE)
+    seeded = []
     try:
-        cmd = ["pacman", "-Q"]
-        res = subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode().split('\n')
-        for line in res:
-            line = line.split()
-            if line:
-                installed_packages.append(line[0])
-    except subprocess.CalledProcessError as err:
-        msg = "Cannot check installed packages (pacman -Q): {}"
-        log_warning(msg.format(err.output.decode()))
+        seeded = dkmscache.seed(cache, backend.target_versions(packages), gcc_version, ROOT)
+    except OSError as err:
+        log_warning("Cannot use prebuilt DKMS modules: {}", err)
+    if seeded:
+        log_info("Reusing {0} prebuilt DKMS modules from {1}", len(seeded), DKMS_CACHE)
+    return cache, seeded
+
+
+def collect_dkms_modules(cache, packages, seeded):
+    """ Stores DKMS builds of installed packages in the cache """
+    versions = installed_versions(list(packages) + [dkmscache.COMPILER_PACKAGE])
+    gcc_version = versions.pop(dkmscache.COMPILER_PACKAGE, None)
+    try:
+        stored = dkmscache.collect(cache, versions, gcc_version, seeded, ROOT)
     except OSError as err:
-        msg = "Cannot check installed packages (pacman -Q): {}"
-        log_warning(msg.format(err))
-    return installed_packages
+        log_warning("Cannot store DKMS modules in {0}: {1}", DKMS_CACHE, err)
+        return
+    if stored:
+        log_info("Stored {0} DKMS module builds in {1}", stored, DKMS_CACHE)
+
+
+def get_local_db():
+    """ Reads local package database, empty one if it cannot be read """
+    try:
+        if ROOT != "/":
+            return localdb.read_local_db(root_path(localdb.LOCAL_DB_PATH))
+        return localdb.read_local_db(localdb.LOCAL_DB_PATH, LOCAL_DB_CACHE)
+    except OSError as err:
+        msg = "Cannot read local package database: {}"
+        log_warning(msg, err)
+        return localdb.LocalDatabase({}, {}, {})
+
+
+def get_installed_packages():
+    """ Gets a set of all installed packages """
+    return get_local_db().names
 
 
-def add_user_to_group(user, group, TEST):
+def add_user_to_group(user, group):
     """ Adds user to group in system """
-    log_info("Adding user {0} to {1} group...".format(user, group))
+    log_info("Adding user {0} to {1} group...", user, group)
     cmd = ["gpasswd", "-a", user, group]
-    log_info(" ".join(cmd))
-    if not TEST:
-        try:
-            subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as err:
-            msg = "Cannot add user {0} to the {1} group: {2}"
-            log_warning(msg.format(user, group, err.output.decode()))
+    if ROOT != "/":
+        cmd[1:1] = ["--root", ROOT]
+    try:
+        devutils.run_command(cmd, OUTPUT)
+    except subprocess.CalledProcessError as err:
+        msg = "Cannot add user {0} to the {1} group: {2}"
+        log_warning(msg, user, group, err.output.decode())
 
 
 def get_user():
-    """ Gets current username """
+    """ Gets current username, root when changing an image """
+    if ROOT != "/":
+        return "root"
     user = None
     try:
         user = os.environ['SUDO_USER']
@@ -227,155 +304,121 @@ def get_user():
     return user
 
 
-def enable_service(service, enable, TEST):
-    """ Enables service using systemctl """
-    if not service.endswith(".service"):
-        service += ".service"
-
-    if os.path.exists("/usr/lib/systemd/system/{}".format(service)):
-        cmd = ["systemctl"]
-        if enable:
-            log_info("Enabling {} service...".format(service))
-            cmd += ["enable", service]
-        else:
-            log_info("Disabling {} service...".format(service))
-            cmd += ["disable", service]
-        log_info(" ".join(cmd))
-        if not TEST:
-            try:
-                subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-            except subprocess.CalledProcessError as err:
-                msg = "Cannot enable/disable {0} service: {1}"
-                log_warning(msg.format(service, err.output.decode()))
-
-
-def patch_nvidia_settings(patch, TEST):
-    """ Fixes nvidia-settings.desktop """
-    desktop_path = "/usr/share/applications/nvidia-settings.desktop"
-    if os.path.exists(desktop_path):
-        exec1 = "Exec=/usr/bin/nvidia-settings"
-        exec2 = "Exec=optirun -b none /usr/bin/nvidia-settings -c :8"
-        if patch:
-            log_info("Patching {}...".format(desktop_path))
-            sed = "s|{0}|{1}|"
-        else:
-            log_info("Unpatching {}...".format(desktop_path))
-            sed = "s|{1}|{0}|"
-        sed = sed.format(exec1, exec2)
-        cmd = ["/usr/bin/sed", "-i", sed, desktop_path]
-        if TEST:
-            log_info(" ".join(cmd))
-        else:
-            try:
-                subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-            except subprocess.CalledProcessError as err:
-                msg = "Cannot modify {0} file : {1}"
-                log_warning(msg.format(desktop_path, err.output.decode()))
-
-
-def remove_file(path, TEST):
-    """ Removes file if exists """
-    if os.path.exists(path):
-        log_info("Removing {} file...".format(path))
-        if not TEST:
-            os.remove(path)
-    else:
-        log_info("{} not found. That's ok.".format(path))
-
-
-def create_nvidia_conf(path, TEST):
-    """ Creates specific Xorg nvidia setup """
-    log_info("Creating {} file...".format(path))
-    if not TEST:
-        with open(path, 'w') as nvidia:
-            nvidia.write('Section "Device"\n')
-            nvidia.write('    Identifier "Nvidia Card"\n')
-            nvidia.write('    Driver "nvidia"\n')
-            nvidia.write('    VendorName "NVIDIA Corporation"\n')
-            nvidia.write('    Option "NoLogo" "true"\n')
-            nvidia.write('EndSection\n')
-
-
-def post_install(driver, TEST):
-    """ Run post installation actions here """
-
-    nvidia_conf_path = "/etc/X11/xorg.conf.d/20-nvidia.conf"
-
-    if driver == "bumblebee":
-        user = get_user()
-        if user != "root":
-            add_user_to_group(user, "bumblebee", TEST)
-            add_user_to_group(user, "video", TEST)
-        else:
-            msg = "NOT adding user 'root' to bumblebee or video groups! " \
-                "Remember to add your users to those groups"
-            log_warning(msg)
-
-        enable_service("bumblebeed.service", True, TEST)
-        patch_nvidia_settings(True, TEST)
+def service_installed(service):
+    """ Tells whether the unit file of service exists """
+    return os.path.exists(root_path(os.path.join(SYSTEMD_UNITS_PATH, service)))
+
+
+def enable_service(service, enable):
+    """ Enables service using systemctl, if it is installed """
+    if not service_installed(service):
+        return
+
+    cmd = ["systemctl"]
+    if ROOT != "/":
+        cmd += ["--root", ROOT]
+    if enable:
+        log_info("Enabling {} service...", service)
+        cmd += ["enable", service]
     else:
-        # not bumblebee
-        enable_service("bumblebeed.service", False, TEST)
-        patch_nvidia_settings(False, TEST)
+        log_info("Disabling {} service...", service)
+        cmd += ["disable", service]
+    try:
+        devutils.run_command(cmd, OUTPUT)
+    except subprocess.CalledProcessError as err:
+        msg = "Cannot enable/disable {0} service: {1}"
+        log_warning(msg, service, err.output.decode())
+
+
+def edit_file(transaction, path, old, new):
+    """ Stages replacement of old text with new in file, if both exist """
+    if transaction.edit(path, old, new):
+        log_info("Changing {0} to {1} in {2}...", old.strip("\n"), new.strip("\n"), path)
 
-    if driver.startswith("nvidia"):
-        create_nvidia_conf(nvidia_conf_path, TEST)
+
+def remove_file(transaction, path):
+    """ Stages removal of file if exists """
+    if transaction.delete(path):
+        log_info("Removing {} file...", path)
     else:
-        # bumblebee and nouveau
-        remove_file(nvidia_conf_path, TEST)
-
-    fix_mkinitcpio(TEST)
-
-
-def fix_mkinitcpio(TEST):
-    """ Removes nouveau and nvidia from MODULES line in mkinitcpio.conf """
-
-    mkinitcpio_path = "/etc/mkinitcpio.conf"
-
-    # Read mkinitcpio.conf
-    with open(mkinitcpio_path) as mkinitcpio_file:
-        mklines = mkinitcpio_file.readlines()
-
-    modified = False
-    new_mklines = []
-    for line in mklines:
-        # Remove nouveau and nvidia from MODULES line (just in case)
-        if line.startswith("MODULES"):
-            if "nouveau" in line or "nvidia" in line:
-                old_line = line
-                line = line.replace("nouveau", "")
-                line = line.replace("nvidia", "")
-                line = line.replace(",,", ",")
-                line = line.replace('",', '"')
-                line = line.replace(',"', '"')
-                msg = "{0} will be changed to {1} in {2}"
-                log_info(msg.format(old_line.strip("\n"), line.strip("\n"), mkinitcpio_path))
-                modified = True
-        new_mklines.append(line)
-
-    if modified and not TEST:
+        log_info("{} not found. That's ok.", path)
+
+
+def write_file(transaction, path, content):
+    """ Stages file with given content """
+    log_info("Creating {} file...", path)
+    transaction.write(path, content)
+
+
+def find_presets():
+    """ Returns names of all mkinitcpio presets, one per installed kernel """
+    try:
+        items = os.listdir(root_path(MKINITCPIO_D))
+    except OSError:
+        return []
+    return sorted(item[:-7] for item in items if item.endswith(".preset"))
+
+
+def preset_configs(preset):
+    """ Returns set of mkinitcpio config files a preset builds from """
+    configs = set()
+    try:
+        with open(root_path(os.path.join(MKINITCPIO_D, preset + ".preset"))) as preset_file:
+            for line in preset_file:
+                match = PRESET_CONFIG.match(line)
+                if match:
+                    configs.add(match.group(1))
+    except OSError:
+        pass
+    return configs or {MKINITCPIO_CONF}
+
+
+def run_mkinitcpio(preset):
+    """ Builds initramfs images of one preset, returns (success, seconds) """
+    output = OUTPUT
+    if output is not None:
+        output = lambda line: OUTPUT("{0}: {1}".format(preset, line))
+
+    cmd = [MKINITCPIO, "-p", preset]
+    if ROOT != "/":
+        cmd = [CHROOT, ROOT] + cmd
+    start = time.monotonic()
+    with tracing.span("mkinitcpio", preset=preset):
         try:
-            with open(mkinitcpio_path, "w") as mkinitcpio_file:
-                for line in new_mklines:
-                    mkinitcpio_file.write(line)
-
-            cmd = ["mkinitcpio", "-p", "linux"]
-            res = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-            res = res.decode().split('\n')
-
-            if os.path.exists('/boot/vmlinuz-linux-lts'):
-                cmd = ["mkinitcpio", "-p", "linux-lts"]
-                res = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-                res = res.decode().split('\n')
-        except subprocess.CalledProcessError as err:
+            devutils.run_command(cmd, output)
+            success = True
+        except (subprocess.CalledProcessError, OSError) as err:
             msg = "Cannot run {0}: {1}, please run it manually before rebooting!"
-            log_warning(msg.format(' '.join(cmd), err))
-        except PermissionError:
-            log_error("This script must be run with administrative privileges!")
+            log_warning(msg, ' '.join(cmd), err)
+            success = False
+    return success, time.monotonic() - start
+
+
+def rebuild_initramfs(presets, jobs=None):
+    """ Runs mkinitcpio for all presets concurrently
+
+    Returns True if all presets were rebuilt, results are logged per kernel.
+    """
+    if not presets:
+        return True
+
+    jobs = min(jobs or MKINITCPIO_JOBS, len(presets))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = dict(zip(presets, executor.map(run_mkinitcpio, presets)))
+
+    for preset in presets:
+        success, seconds = results[preset]
+        state = "rebuilt" if success else "FAILED"
+        log_info("Initramfs of {0} {1} in {2:.1f} s", preset, state, seconds)
+
+    return all(success for success, _ in results.values())
 
 
 def setup_logging(cmd_line):
-    """ Configure our logger """
+    """ Configure our logger
+
+    The log file gets json lines, the terminal colored text.
+    """
     logger = logging.getLogger()
 
     logger.handlers = []
@@ -384,73 +427,48 @@ def setup_logging(cmd_line):
 
     logger.setLevel(log_level)
 
-    #context_filter = ContextFilter()
-    #logger.addFilter(context_filter.filter)
-
-    # Log format
-    formatter = logging.Formatter(
-        fmt="%(asctime)s [%(levelname)s]: %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S")
+    span_filter = tracing.SpanFilter()
 
     # File logger
     try:
-        file_handler = logging.FileHandler(LOG_FILE, mode='w')
+        file_handler = logging.FileHandler(LOG_FILE, mode='a')
         file_handler.setLevel(log_level)
-        file_handler.setFormatter(formatter)
+        file_handler.setFormatter(tracing.JsonFormatter())
+        file_handler.addFilter(span_filter)
         logger.addHandler(file_handler)
     except PermissionError as permission_error:
-        log_error("Can't open {0} : {1}".format(LOG_FILE, permission_error))
+        log_error("Can't open {0} : {1}", LOG_FILE, permission_error)
 
     # Stdout logger
     if not cmd_line.quiet:
         stream_handler = logging.StreamHandler()
         stream_handler.setLevel(log_level)
-        stream_handler.setFormatter(formatter)
+        stream_handler.setFormatter(tracing.ColorFormatter(
+            fmt="%(asctime)s [%(levelname)s]: %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S"))
+        stream_handler.addFilter(span_filter)
         logger.addHandler(stream_handler)
 
-        log_info("All logs will be stored in {}".format(LOG_FILE))
-
-
-def log_error(msg):
-    """ Log error message """
-    msg = RED + msg + ENDC
-    logging.error(msg)
-
-
-def log_warning(msg):
-    """ Log warning message """
-    msg = YELLOW + msg + ENDC
-    logging.warning(msg)
-
-
-def log_info(msg):
-    """ Log information message """
-    msg = GREEN + msg + ENDC
-    logging.info(msg)
+        log_info("All logs will be stored in {}", LOG_FILE)
 
 
-def load_ids_file(path):
-    """ Loads pci device numbers from a ids file """
-    with open(path, 'r') as ids_file:
-        lines = ids_file.readlines()
+def log_error(msg, *args):
+    """ Log error message, args are formatted into msg only when it is emitted """
+    logging.error(tracing.Message(msg, args))
 
-    for index, line in enumerate(lines):
-        lines[index] = line.lower()
 
-    ids = []
-    for line in lines:
-        ids.extend(line.split())
+def log_warning(msg, *args):
+    """ Log warning message, args are formatted into msg only when it is emitted """
+    logging.warning(tracing.Message(msg, args))
 
-    for index, pci_id in enumerate(ids):
-        ids[index] = "0x" + pci_id
 
-    return ids
+def log_info(msg, *args):
+    """ Log information message, args are formatted into msg only when it is emitted """
+    logging.info(tracing.Message(msg, args))
 
 
 def load_ids():
-    """ Load all nvidia devices pci ids """
-    for item in os.listdir(IDS_PATH):
-        if item.endswith('.ids') and "nvidia" in item:
-            key = item[:-4]
-            path = os.path.join(IDS_PATH, item)
-            DEVICES[key] = load_ids_file(path)
+    """ Load compiled pci ids index, rebuilding it if any ids file changed """
+    global INDEX, RULE_TABLE
+    INDEX = pciids.load_index(IDS_PATH)
+    RULE_TABLE = rules.RuleTable(INDEX)
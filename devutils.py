@@ -21,66 +21,356 @@
 #  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
 
 
+import collections
+import json
+import os
+import re
 import subprocess
+import types
+import tracing
 
+SYSFS_ROOT = "/sys"
+
+BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
+
+SNAPSHOT_CACHE = "/var/cache/fx-drivers/hardware.json"
+
+PCI_IDS_PATHS = ("/usr/share/hwdata/pci.ids", "/usr/share/misc/pci.ids")
+
+DISPLAY_CLASS = 0x03
+
+# Vendors whose GPU is preferred when a machine has several (hybrid laptops)
+PREFERRED_VENDORS = (0x10de, 0x1002)
+
+# Vendor names by PCI vendor id, names match the src/*.svg logos
+VENDORS = {
+    0x10de: "nvidia",
+    0x12d2: "nvidia",
+    0x1002: "amd",
+    0x1022: "amd",
+    0x8086: "intel",
+    0x80ee: "virtualbox",
+    0x15ad: "vmware",
+    0x1af4: "virtio",
+    0x1234: "qemu",
+    0x14e4: "broadcom",
+    0x1a03: "aspeed",
+    0x102b: "matrox"}
+
+# Fallback for device descriptions without a vendor id, first match wins
+VENDOR_TEXT = re.compile(
+    r"\b(nvidia|advanced micro devices|amd|ati|intel|virtualbox|innotek|"
+    r"vmware|broadcom|aspeed|matrox)\b", re.IGNORECASE)
+
+VENDOR_TEXT_NAMES = {
+    "advanced micro devices": "amd",
+    "innotek": "virtualbox"}
+
+PciDevice = collections.namedtuple(
+    "PciDevice",
+    ["slot", "class_id", "vendor_id", "device_id",
+     "subsystem_vendor_id", "subsystem_device_id"])
+PciDevice.__doc__ = """ PCI device as read from sysfs, all ids are integers """
+
+
+def read_hex(path):
+    """ Reads a hexadecimal sysfs attribute, None if it is missing """
+    try:
+        with open(path) as attr:
+            return int(attr.read(), 16)
+    except (OSError, ValueError):
+        return None
+
+
+def scan_pci_devices(root=SYSFS_ROOT):
+    """ Reads all PCI devices from sysfs in one pass """
+    devices_path = os.path.join(root, "bus/pci/devices")
+    devices = []
+    for slot in sorted(os.listdir(devices_path)):
+        path = os.path.join(devices_path, slot)
+        devices.append(PciDevice(
+            slot,
+            read_hex(os.path.join(path, "class")),
+            read_hex(os.path.join(path, "vendor")),
+            read_hex(os.path.join(path, "device")),
+            read_hex(os.path.join(path, "subsystem_vendor")),
+            read_hex(os.path.join(path, "subsystem_device"))))
+    return devices
+
+
+# Names looked up by this process, (vendor_id, device_id) to name
+_PCI_NAMES = {}
+
+
+def read_pci_names(ids, path):
+    """ Returns {(vendor_id, device_id): name} of ids found in one pci.ids file
+
+    The file is read up to the end of the last vendor needed.
+    """
+    wanted = {}
+    for vendor_id, device_id in ids:
+        wanted.setdefault("{:04x}".format(vendor_id), {})["{:04x}".format(device_id)] = (vendor_id, device_id)
+    names = {}
+    vendor_name = None
+    devices = {}
+    with open(path, encoding="utf-8", errors="replace") as pci_ids:
+        for line in pci_ids:
+            if line.startswith("#") or not line.strip():
+                continue
+            if not line.startswith("\t"):
+                # Next vendor, devices of the previous one without a name get a generic one
+                for device_key, pair in devices.items():
+                    names[pair] = "{0} Device {1}".format(vendor_name, device_key)
+                if not wanted:
+                    devices = {}
+                    break
+                vendor_name = line[4:].strip()
+                devices = wanted.pop(line[:4], {})
+            elif devices and not line.startswith("\t\t") and line[1:5] in devices:
+                names[devices.pop(line[1:5])] = "{0} {1}".format(vendor_name, line[6:].strip())
+    for device_key, pair in devices.items():
+        names[pair] = "{0} Device {1}".format(vendor_name, device_key)
+    return names
+
+
+def get_pci_names(ids, paths=PCI_IDS_PATHS):
+    """ Looks up vendor and device names of (vendor_id, device_id) pairs in pci.ids
+
+    All pairs not looked up before are found in one pass over the file.
+    """
+    missing = set(ids) - _PCI_NAMES.keys()
+    for path in paths:
+        if not missing:
+            break
+        try:
+            found = read_pci_names(missing, path)
+        except OSError:
+            continue
+        _PCI_NAMES.update(found)
+        missing -= found.keys()
+    for vendor_id, device_id in missing:
+        _PCI_NAMES[(vendor_id, device_id)] = "Device {0:04x}:{1:04x}".format(vendor_id, device_id)
+    return [_PCI_NAMES[pair] for pair in ids]
+
+
+def get_pci_name(vendor_id, device_id, paths=PCI_IDS_PATHS):
+    """ Looks up vendor and device names in the pci.ids database """
+    return get_pci_names([(vendor_id, device_id)], paths)[0]
+
+
+def run_command(cmd, output=None):
+    """ Runs cmd like subprocess.check_output, stderr included
+
+    When output is given, it is called with every line as soon as the
+    command prints it.
+    """
+    tracing.count("forks", command=os.path.basename(cmd[0]))
+    if output is None:
+        return subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+
+    lines = []
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    with process:
+        for line in process.stdout:
+            lines.append(line)
+            output(line.decode(errors="replace").rstrip("\n"))
+    res = b"".join(lines)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd, res)
+    return res
+
+
+def get_boot_id(path=BOOT_ID_PATH):
+    """ Returns id of the running boot, None if unknown """
+    try:
+        with open(path) as boot_id:
+            return boot_id.read().strip()
+    except OSError:
+        return None
+
+
+class HardwareSnapshot(object):
+    """ Immutable view of the PCI hardware, taken once per process """
+
+    __slots__ = ("boot_id", "devices", "display_devices", "names")
+
+    def __init__(self, boot_id, devices, names):
+        devices = tuple(devices)
+        display_devices = [
+            device for device in devices
+            if device.class_id is not None and device.class_id >> 16 == DISPLAY_CLASS]
+        display_devices.sort(key=lambda device: (
+            PREFERRED_VENDORS.index(device.vendor_id)
+            if device.vendor_id in PREFERRED_VENDORS else len(PREFERRED_VENDORS),
+            device.slot))
+        object.__setattr__(self, "boot_id", boot_id)
+        object.__setattr__(self, "devices", devices)
+        object.__setattr__(self, "display_devices", tuple(display_devices))
+        object.__setattr__(self, "names", types.MappingProxyType(dict(names)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("HardwareSnapshot is read-only")
+
+    @property
+    def gpu(self):
+        """ Display device drivers are managed for, None if there is none """
+        return self.display_devices[0] if self.display_devices else None
+
+    def name(self, device):
+        """ Returns human readable name of a display device """
+        return self.names.get(device.slot, "")
+
+    @classmethod
+    def probe(cls, root=SYSFS_ROOT):
+        """ Takes a new snapshot of the running system """
+        devices = scan_pci_devices(root)
+        display_devices = [
+            device for device in devices
+            if device.class_id is not None and device.class_id >> 16 == DISPLAY_CLASS]
+        names = get_pci_names([(device.vendor_id, device.device_id) for device in display_devices])
+        return cls(get_boot_id(), devices, zip((device.slot for device in display_devices), names))
+
+    def with_device(self, slot, device=None):
+        """ Returns snapshot with the device in slot replaced, removed if device is None """
+        devices = [item for item in self.devices if item.slot != slot]
+        names = dict((item, name) for item, name in self.names.items() if item != slot)
+        if device is not None:
+            devices.append(device)
+            devices.sort(key=lambda item: item.slot)
+            if device.class_id is not None and device.class_id >> 16 == DISPLAY_CLASS:
+                names[slot] = get_pci_name(device.vendor_id, device.device_id)
+        return HardwareSnapshot(self.boot_id, devices, names)
+
+    def to_dict(self):
+        """ Returns snapshot as json serializable dictionary """
+        return {
+            "boot_id": self.boot_id,
+            "devices": [list(device) for device in self.devices],
+            "names": dict(self.names)}
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Rebuilds snapshot stored with to_dict() """
+        devices = [PciDevice(*device) for device in data["devices"]]
+        return cls(data["boot_id"], devices, data["names"])
+
+
+_SNAPSHOT = None
+
+
+def load_snapshot(cache_path, root=SYSFS_ROOT):
+    """ Loads snapshot from cache_path if it was taken during this boot
+
+    Adding or removing a PCI device bumps the mtime of the sysfs devices
+    directory, a cache written before that is stale.
+    """
+    try:
+        with open(cache_path) as cache_file:
+            cache_mtime = os.fstat(cache_file.fileno()).st_mtime_ns
+            snapshot = HardwareSnapshot.from_dict(json.load(cache_file))
+        devices_mtime = os.stat(os.path.join(root, "bus/pci/devices")).st_mtime_ns
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if devices_mtime > cache_mtime:
+        return None
+    boot_id = get_boot_id()
+    if boot_id is None or snapshot.boot_id != boot_id:
+        return None
+    return snapshot
+
+
+def save_snapshot(snapshot, cache_path):
+    """ Stores snapshot to cache_path, ignoring unwritable locations """
+    tmp_path = "{0}.{1}.tmp".format(cache_path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(snapshot.to_dict(), cache_file)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+
+
+def get_snapshot(cache_path=None):
+    """ Returns the hardware snapshot, probing sysfs only once per process
+
+    When cache_path is given the snapshot is also shared between processes
+    started during the same boot.
+    """
+    global _SNAPSHOT
+    if _SNAPSHOT is None:
+        snapshot = load_snapshot(cache_path) if cache_path else None
+        if cache_path:
+            tracing.count("cache_requests", cache="hardware", result="miss" if snapshot is None else "hit")
+        if snapshot is None:
+            snapshot = HardwareSnapshot.probe()
+            if cache_path:
+                save_snapshot(snapshot, cache_path)
+        _SNAPSHOT = snapshot
+    return _SNAPSHOT
+
+
+def set_snapshot(snapshot, cache_path=None):
+    """ Replaces the hardware snapshot of this process, stored to cache_path if given """
+    global _SNAPSHOT
+    _SNAPSHOT = snapshot
+    if cache_path:
+        save_snapshot(snapshot, cache_path)
 
 
 """
-Returns string with information about GPU and kernel driver in use
+Returns name of the GPU, see driverstatus for the kernel driver in use
 """
 def get_gpu():
-    from subprocess import check_output
-    gpu = check_output('lspci | grep VGA | cut -d ":" -f3', shell=True)
-    return gpu 
+    snapshot = get_snapshot()
+    if snapshot.gpu is None:
+        return ""
+    return snapshot.name(snapshot.gpu)
+
+
+def classify_vendor(vendor_id=None, text=""):
+    """ Returns vendor name of a PCI vendor id
+
+    The device description is searched for a vendor name only when the
+    id is missing or unknown.
+    """
+    vendor = VENDORS.get(vendor_id)
+    if vendor is not None:
+        return vendor
+    match = VENDOR_TEXT.search(text)
+    if match is None:
+        return "unknown"
+    name = match.group(1).lower()
+    return VENDOR_TEXT_NAMES.get(name, name)
+
 
 """
 Returns string with name of GPU vendor
 """
 def get_gpu_vendor():
-    gpu=get_gpu()
-    gpu=gpu.lower()
-    
-    if ("nvidia" in str(gpu)):
-        vendor="nvidia"
-    elif ("amd" or "advanced micro devices" in str(gpu)):
-        vendor="amd"
-    elif ("ati" in str(gpu)):
-        vendor= "ati"
-    elif ("intel" in str(gpu)):
-        vendor="intel"
-    elif ("virtualbox" in str(gpu)):
-        vendor="virtualbox"
-    else :
-        vendor="unknown"
-
-    return vendor
+    snapshot = get_snapshot()
+    if snapshot.gpu is None:
+        return "unknown"
+    return classify_vendor(snapshot.gpu.vendor_id, snapshot.name(snapshot.gpu))
 
+"""
+Returns PCI vendor id of the GPU as hexadecimal string
+"""
 def get_gpu_vendor_id():
-    gpu=get_gpu()
-    gpu=gpu.lower()
-    
-    if ("nvidia" in str(gpu)):
-        vendor_id="0x10de"
-    elif ("amd" or "advanced micro devices" in str(gpu)):
-        vendor_id="amd"
-    elif ("ati" in str(gpu)):
-        vendor_id= "ati"
-    elif ("intel" in str(gpu)):
-        vendor_id="intel"
-    elif ("virtualbox" in str(gpu)):
-        vendor_id="virtualbox"
-    else :
-        vendor_id="unknown"
-
-    return vendor_id    
+    snapshot = get_snapshot()
+    if snapshot.gpu is None or snapshot.gpu.vendor_id is None:
+        return "unknown"
+    return "0x{:04x}".format(snapshot.gpu.vendor_id)
 
 def get_gpu_name():
-    from subprocess import check_output
-    gpu_name=str(get_gpu())
-    
-    gpu_name = gpu_name.replace("b' ", "")
-    gpu_name = gpu_name.replace("\\n'", "")
-    return gpu_name
+    return get_gpu()
+
+"""
+Returns names of all display devices, preferred GPU first
+"""
+def get_gpu_names():
+    snapshot = get_snapshot()
+    return [snapshot.name(device) for device in snapshot.display_devices]
          
 
 
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  dkmscache module
+#
+#  Copyright © 2019 Favourix <vladimir.kokes@favourix.com
+#  This file is part of fx-drivers (Favourix OS Driver manager).
+#
+#  Favourix is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Favourix is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
+
+""" Cache of modules built by DKMS
+
+The pacman hook of a -dkms package runs dkms install for every kernel
+with headers, which compiles the module unless its build directory
+/var/lib/dkms/<module>/<version>/<kernel>/<arch> already exists.
+
+Before the package transaction seed() unpacks cached build directories
+for the package version about to be installed; after it collect()
+archives the build directories DKMS had to compile. Entries are keyed on
+module, version, kernel release and compiler (the compiler the kernel
+was built with and the installed gcc), checked against their SHA-256
+before use and evicted least recently used first above MAX_SIZE.
+
+The cache directory can be shared by many hosts, entries are written
+with a temporary file and a rename.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import time
+import fstransaction
+import localdb
+import tracing
+
+DKMS_CACHE = "/var/cache/fx-drivers/dkms"
+
+# Total size of cached archives
+MAX_SIZE = 2 * 1024 ** 3
+
+DKMS_TREE = "/var/lib/dkms"
+MODULES_PATH = "/usr/lib/modules"
+
+# DKMS module name of every -dkms package rules install
+DKMS_PACKAGES = {
+    "nvidia-dkms": "nvidia",
+    "nvidia-390xx-dkms": "nvidia",
+    "nvidia-340xx-dkms": "nvidia",
+    "bbswitch-dkms": "bbswitch",
+    "broadcom-wl-dkms": "broadcom-wl"}
+
+COMPILER_PACKAGE = "gcc"
+
+# Line of the kernel .config naming its compiler
+CC_VERSION_TEXT = "CONFIG_CC_VERSION_TEXT="
+
+
+def kernels(root="/"):
+    """ Returns releases of installed kernels with headers, DKMS builds for those """
+    path = fstransaction.resolve(root, MODULES_PATH)
+    try:
+        entries = os.listdir(path)
+    except OSError:
+        return []
+    return sorted(entry for entry in entries if os.path.isdir(os.path.join(path, entry, "build")))
+
+
+def compiler(kernel, gcc_version, root="/"):
+    """ Returns compiler identification for modules of kernel """
+    text = ""
+    try:
+        with open(fstransaction.resolve(root, os.path.join(MODULES_PATH, kernel, "build/.config"))) as config:
+            for line in config:
+                if line.startswith(CC_VERSION_TEXT):
+                    text = line[len(CC_VERSION_TEXT):].strip().strip('"')
+                    break
+    except OSError:
+        pass
+    return "{0}; gcc {1}".format(text, gcc_version or "?")
+
+
+def cache_key(module, version, kernel, compiler_id, arch):
+    """ Returns name of the cache entry of one build """
+    data = "\0".join((module, version, kernel, compiler_id, arch))
+    return hashlib.sha256(data.encode()).hexdigest()[:32]
+
+
+def build_dir(module, version, kernel, arch, root="/"):
+    """ Returns DKMS build directory of module for kernel """
+    return fstransaction.resolve(root, os.path.join(DKMS_TREE, module, version, kernel, arch))
+
+
+def file_sha256(path):
+    """ Returns hex SHA-256 of file """
+    digest = hashlib.sha256()
+    with open(path, "rb") as data:
+        for block in iter(lambda: data.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ModuleCache(object):
+    """ Directory of <key>.tar.gz build archives with <key>.json metadata """
+
+    __slots__ = ("path", "max_size", "hits", "misses")
+
+    def __init__(self, path=DKMS_CACHE, max_size=MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def archive(self, key):
+        """ Returns path of archive of key """
+        return os.path.join(self.path, key + ".tar.gz")
+
+    def read_meta(self, key):
+        """ Returns metadata of key, None if there is no entry """
+        try:
+            with open(os.path.join(self.path, key + ".json")) as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+
+    def write_meta(self, key, meta):
+        """ Writes metadata of key """
+        path = os.path.join(self.path, key + ".json")
+        tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w") as meta_file:
+            json.dump(meta, meta_file, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def remove(self, key):
+        """ Removes entry of key """
+        for path in (self.archive(key), os.path.join(self.path, key + ".json")):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def get(self, key):
+        """ Returns archive of key if it is intact, corrupt entries are removed """
+        meta = self.read_meta(key)
+        try:
+            if meta is None or file_sha256(self.archive(key)) != meta["sha256"]:
+                raise ValueError(key)
+        except (OSError, ValueError, KeyError):
+            if meta is not None:
+                self.remove(key)
+            self.misses += 1
+            tracing.count("cache_requests", cache="dkms", result="miss")
+            return None
+        tracing.count("cache_requests", cache="dkms", result="hit")
+        meta["used"] = time.time()
+        try:
+            self.write_meta(key, meta)
+        except OSError:
+            # Read-only shared cache
+            pass
+        self.hits += 1
+        return self.archive(key)
+
+    def put(self, key, source, meta):
+        """ Archives build directory source as key """
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = "{0}.{1}.tmp".format(self.archive(key), os.getpid())
+        with tarfile.open(tmp_path, "w:gz") as archive:
+            archive.add(source, arcname=".")
+        meta = dict(meta, sha256=file_sha256(tmp_path), size=os.path.getsize(tmp_path), used=time.time())
+        os.replace(tmp_path, self.archive(key))
+        self.write_meta(key, meta)
+        self.evict()
+
+    def entries(self):
+        """ Returns [(key, metadata)] of all entries """
+        entries = []
+        for entry in os.listdir(self.path):
+            if entry.endswith(".json"):
+                meta = self.read_meta(entry[:-len(".json")])
+                if meta is not None:
+                    entries.append((entry[:-len(".json")], meta))
+        return entries
+
+    def evict(self):
+        """ Removes least recently used entries until the cache fits max_size """
+        entries = sorted(self.entries(), key=lambda entry: entry[1].get("used", 0))
+        size = sum(meta.get("size", 0) for _, meta in entries)
+        for key, meta in entries:
+            if size <= self.max_size:
+                break
+            self.remove(key)
+            size -= meta.get("size", 0)
+
+
+def extract(archive_path, target):
+    """ Unpacks archive into target, refusing members outside of it """
+    tmp_target = target + ".fx-drivers-tmp"
+    shutil.rmtree(tmp_target, ignore_errors=True)
+    with tarfile.open(archive_path, "r:gz") as archive:
+        for member in archive.getmembers():
+            name = os.path.normpath(member.name)
+            if name.startswith("..") or os.path.isabs(name) or not (member.isfile() or member.isdir()):
+                raise ValueError("Unsafe member {0} in {1}".format(member.name, archive_path))
+        archive.extractall(tmp_target)
+    os.replace(tmp_target, target)
+
+
+def builds(versions, gcc_version, root="/", arch=None):
+    """ Yields (key, build directory, metadata) of every build DKMS will make
+
+    versions maps -dkms package names to the package versions.
+    """
+    arch = arch or os.uname().machine
+    kernel_list = kernels(root)
+    for package, package_version in sorted(versions.items()):
+        module = DKMS_PACKAGES.get(package)
+        if module is None:
+            continue
+        version = localdb.upstream_version(package_version)
+        for kernel in kernel_list:
+            compiler_id = compiler(kernel, gcc_version, root)
+            meta = {"module": module, "version": version, "kernel": kernel,
+                    "compiler": compiler_id, "arch": arch}
+            yield (cache_key(module, version, kernel, compiler_id, arch),
+                   build_dir(module, version, kernel, arch, root), meta)
+
+
+def seed(cache, versions, gcc_version, root="/", arch=None):
+    """ Unpacks cached builds of the package versions, returns seeded directories """
+    seeded = []
+    for key, path, _ in builds(versions, gcc_version, root, arch):
+        if os.path.isdir(path):
+            continue
+        archive_path = cache.get(key)
+        if archive_path is None:
+            continue
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            extract(archive_path, path)
+        except (OSError, ValueError, tarfile.TarError):
+            cache.remove(key)
+            continue
+        seeded.append(path)
+    return seeded
+
+
+def collect(cache, versions, gcc_version, seeded=(), root="/", arch=None):
+    """ Archives builds of the installed versions, returns number stored
+
+    Seeded directories of versions that were not installed are removed.
+    """
+    stored = 0
+    expected = set()
+    for key, path, meta in builds(versions, gcc_version, root, arch):
+        expected.add(path)
+        module_path = os.path.join(path, "module")
+        if path in seeded or cache.read_meta(key) is not None:
+            continue
+        if not os.path.isdir(module_path) or not any(name.endswith(".ko") or ".ko." in name
+                                                     for name in os.listdir(module_path)):
+            continue
+        try:
+            cache.put(key, path, meta)
+            stored += 1
+        except OSError:
+            pass
+    for path in seeded:
+        if path not in expected:
+            shutil.rmtree(path, ignore_errors=True)
+    return stored
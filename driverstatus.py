@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  driverstatus module
+#
+#  Copyright © 2019 Favourix <vladimir.kokes@favourix.com
+#  This file is part of fx-drivers (Favourix OS Driver manager).
+#
+#  Favourix is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Favourix is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
+
+""" Kernel drivers in use by the devices we manage drivers for
+
+Everything is read from sysfs symlinks and small files: the driver
+bound to a device, the module providing it, the version of a loaded
+out-of-tree module and the package that built it. Installed versions
+come from the names of the pacman local database directories, no desc
+file is parsed, so a report takes about a millisecond and can be taken
+on every monitoring scrape.
+"""
+
+import collections
+import os
+import localdb
+import rules
+
+SYSFS_ROOT = "/sys"
+PROC_MODULES = "/proc/modules"
+
+# Device classes rules exist for
+CLASSES = frozenset(rule["class"] for rule in rules.RULES)
+
+# Packages a module can come from, the first installed one is reported
+MODULE_PACKAGES = {
+    "nvidia": ("nvidia-dkms", "nvidia", "nvidia-lts", "nvidia-open-dkms", "nvidia-open",
+               "nvidia-390xx-dkms", "nvidia-340xx-dkms"),
+    "wl": ("broadcom-wl-dkms", "broadcom-wl"),
+    "bbswitch": ("bbswitch-dkms", "bbswitch"),
+    "vboxguest": ("virtualbox-guest-modules-arch", "virtualbox-guest-dkms")}
+
+DeviceStatus = collections.namedtuple(
+    "DeviceStatus",
+    ["slot", "vendor_id", "device_id", "driver", "module", "loaded",
+     "version", "package", "package_version", "matches"])
+DeviceStatus.__doc__ = """ Driver state of one PCI device
+
+driver and module are None when no driver is bound or it is built in,
+version is the version of a loaded out-of-tree module, matches compares
+it with package_version and is None when either is unknown.
+"""
+
+
+def read_link_name(path):
+    """ Returns last component of a symlink target, None if it is missing """
+    try:
+        return os.path.basename(os.readlink(path))
+    except OSError:
+        return None
+
+
+def read_text(path):
+    """ Returns stripped content of a small file, None if it is missing """
+    try:
+        with open(path) as text_file:
+            return text_file.read().strip() or None
+    except OSError:
+        return None
+
+
+def loaded_modules(path=PROC_MODULES):
+    """ Returns names of loaded modules """
+    try:
+        with open(path) as modules:
+            return set(line.split(" ", 1)[0] for line in modules)
+    except OSError:
+        return set()
+
+
+def device_status(device, sysfs_root, modules, versions):
+    """ Returns DeviceStatus of a devutils.PciDevice """
+    driver_path = os.path.join(sysfs_root, "bus/pci/devices", device.slot, "driver")
+    driver = read_link_name(driver_path)
+    module = read_link_name(os.path.join(driver_path, "module")) if driver else None
+    loaded = module in modules if module else driver is not None
+    version = read_text(os.path.join(sysfs_root, "module", module, "version")) if loaded and module else None
+
+    package = package_version = None
+    for name in MODULE_PACKAGES.get(module, ()):
+        if name in versions:
+            package, package_version = name, versions[name]
+            break
+
+    matches = None
+    if version is not None and package_version is not None:
+        matches = localdb.upstream_version(package_version) == version
+    return DeviceStatus(
+        device.slot, device.vendor_id, device.device_id, driver, module, loaded,
+        version, package, package_version, matches)
+
+
+def report(snapshot, sysfs_root=SYSFS_ROOT, proc_modules=PROC_MODULES, local_db=localdb.LOCAL_DB_PATH):
+    """ Returns DeviceStatus of every device of a class rules exist for """
+    modules = loaded_modules(proc_modules)
+    versions = localdb.installed_versions(
+        set(name for names in MODULE_PACKAGES.values() for name in names), local_db)
+    return [device_status(device, sysfs_root, modules, versions)
+            for device in snapshot.devices
+            if device.class_id is not None and device.class_id >> 16 in CLASSES]
+
+
+def describe(status):
+    """ Returns one line summary of a DeviceStatus """
+    if status.driver is None:
+        return "no driver"
+    text = status.driver
+    if status.module is not None and status.module != status.driver:
+        text += " ({})".format(status.module)
+    if status.version is not None:
+        text += " {}".format(status.version)
+    if status.package is not None:
+        text += ", {0} {1}".format(status.package, status.package_version)
+    if status.matches is False:
+        text += ", reboot to load the installed version"
+    return text
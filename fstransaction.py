@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  fstransaction module
+#
+#  Copyright © 2019 Favourix <vladimir.kokes@favourix.com
+#  This file is part of fx-drivers (Favourix OS Driver manager).
+#
+#  Favourix is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Favourix is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
+
+""" All or nothing changes of configuration files
+
+A FileTransaction stages writes, edits and deletions in memory. commit()
+then
+    1. writes the journal, listing each target and whether it existed
+    2. writes every new content to a temporary file next to its target
+    3. hard links (or, on deletion, renames) every original to its backup
+       and renames the temporary files over the targets
+If any of this fails, the originals are renamed back. The journal of the
+last commit is kept, so rollback() restores the previous configuration
+with one rename per file, also after a crash in the middle of step 3.
+A commit without changes keeps it.
+
+Paths are absolute paths of the managed system, resolved below root, so
+everything can be run against a fake root directory.
+"""
+
+import json
+import os
+
+JOURNAL = "/var/lib/fx-drivers/journal.json"
+
+BACKUP_SUFFIX = ".fx-drivers-orig"
+TMP_SUFFIX = ".fx-drivers-new"
+
+
+class TransactionError(Exception):
+    """ Commit failed, the files were restored """
+
+
+def resolve(root, path):
+    """ Returns location of absolute path below root """
+    return os.path.join(root, path.lstrip("/"))
+
+
+def write_atomic(path, content):
+    """ Writes file through a temporary file and rename """
+    tmp_path = path + TMP_SUFFIX
+    with open(tmp_path, 'w') as tmp_file:
+        tmp_file.write(content)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_path, path)
+
+
+class FileTransaction(object):
+    """ Staged file changes, see module documentation """
+
+    def __init__(self, root="/", journal=JOURNAL):
+        self.root = root
+        self.journal = resolve(root, journal)
+        # Path to new content, None to delete, in order of staging
+        self.staged = {}
+
+    def read(self, path):
+        """ Returns content of path as staged so far, None if it does not exist """
+        if path in self.staged:
+            return self.staged[path]
+        try:
+            with open(resolve(self.root, path)) as current:
+                return current.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, path, content):
+        """ Stages creation or replacement of path """
+        self.staged[path] = content
+
+    def delete(self, path):
+        """ Stages removal of path, returns False if it does not exist """
+        if self.read(path) is None:
+            return False
+        self.staged[path] = None
+        return True
+
+    def edit(self, path, old, new):
+        """ Stages replacement of old text with new, returns False if path or old is missing """
+        content = self.read(path)
+        if content is None or old not in content:
+            return False
+        self.staged[path] = content.replace(old, new)
+        return True
+
+    def changes(self):
+        """ Returns paths whose staged content differs from the disk """
+        changed = []
+        for path, content in self.staged.items():
+            try:
+                with open(resolve(self.root, path)) as current:
+                    if current.read() == content:
+                        continue
+            except FileNotFoundError:
+                if content is None:
+                    continue
+            except OSError:
+                # Unreadable target, commit reports the error
+                pass
+            changed.append(path)
+        return changed
+
+    def commit(self):
+        """ Applies all staged changes or none, raises TransactionError """
+        data = read_journal(self.journal)
+        if data is not None and data.get("state") == "applying":
+            # Interrupted commit, changes are computed against the restored files
+            discard(self.root, self.journal)
+        paths = self.changes()
+        if not paths:
+            return []
+        discard(self.root, self.journal)
+
+        # The journal lists every temporary file before it is created,
+        # new contents are complete on disk before anything is replaced
+        try:
+            entries = [{"path": path, "existed": os.path.lexists(resolve(self.root, path))}
+                       for path in paths]
+            os.makedirs(os.path.dirname(self.journal), exist_ok=True)
+            write_atomic(self.journal, json.dumps({"state": "applying", "entries": entries}))
+            for path in paths:
+                if self.staged[path] is not None:
+                    target = resolve(self.root, path)
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    with open(target + TMP_SUFFIX, 'w') as tmp_file:
+                        tmp_file.write(self.staged[path])
+                        copy_mode(target, tmp_file.fileno())
+                        tmp_file.flush()
+                        os.fsync(tmp_file.fileno())
+        except OSError as err:
+            self.cleanup(paths)
+            remove(self.journal)
+            raise TransactionError("Cannot stage changes: {}".format(err)) from err
+
+        applied = []
+        try:
+            for entry in entries:
+                target = resolve(self.root, entry["path"])
+                if entry["existed"]:
+                    if self.staged[entry["path"]] is None:
+                        os.replace(target, target + BACKUP_SUFFIX)
+                    else:
+                        backup(target)
+                applied.append(entry)
+                if self.staged[entry["path"]] is not None:
+                    os.replace(target + TMP_SUFFIX, target)
+            write_atomic(self.journal, json.dumps({"state": "committed", "entries": entries}))
+        except OSError as err:
+            restore(self.root, applied)
+            self.cleanup(paths)
+            remove(self.journal)
+            raise TransactionError("Cannot apply changes: {}".format(err)) from err
+        return paths
+
+    def cleanup(self, paths):
+        """ Removes temporary files of paths """
+        for path in paths:
+            remove(resolve(self.root, path) + TMP_SUFFIX)
+
+
+def copy_mode(target, fd):
+    """ Gives open file fd the mode and owner of target, if target exists """
+    try:
+        info = os.stat(target)
+    except FileNotFoundError:
+        return
+    os.fchmod(fd, info.st_mode & 0o7777)
+    current = os.fstat(fd)
+    if (current.st_uid, current.st_gid) != (info.st_uid, info.st_gid):
+        os.fchown(fd, info.st_uid, info.st_gid)
+
+
+def backup(target):
+    """ Links target to its backup name, copying where links are not possible """
+    remove(target + BACKUP_SUFFIX)
+    try:
+        os.link(target, target + BACKUP_SUFFIX)
+    except OSError:
+        with open(target) as original:
+            write_atomic(target + BACKUP_SUFFIX, original.read())
+
+
+def remove(path):
+    """ Removes path if it exists """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def restore(root, entries):
+    """ Puts originals of journal entries back in place """
+    for entry in reversed(entries):
+        target = resolve(root, entry["path"])
+        if entry["existed"]:
+            if os.path.lexists(target + BACKUP_SUFFIX):
+                os.replace(target + BACKUP_SUFFIX, target)
+        else:
+            remove(target)
+
+
+def read_journal(journal):
+    """ Returns journal dictionary, None if there is none """
+    try:
+        with open(journal) as journal_file:
+            return json.load(journal_file)
+    except (OSError, ValueError):
+        return None
+
+
+def discard(root, journal):
+    """ Forgets last commit, removing its backups """
+    data = read_journal(journal)
+    if data is None:
+        return
+    if data.get("state") == "applying":
+        # Interrupted commit, finish the rollback first
+        restore(root, data["entries"])
+    else:
+        for entry in data["entries"]:
+            remove(resolve(root, entry["path"]) + BACKUP_SUFFIX)
+    for entry in data["entries"]:
+        remove(resolve(root, entry["path"]) + TMP_SUFFIX)
+    remove(journal)
+
+
+def rollback(root="/", journal=JOURNAL):
+    """ Restores files changed by the last commit, returns their paths """
+    journal = resolve(root, journal)
+    data = read_journal(journal)
+    if data is None:
+        return []
+    restore(root, data["entries"])
+    for entry in data["entries"]:
+        remove(resolve(root, entry["path"]) + TMP_SUFFIX)
+    remove(journal)
+    return [entry["path"] for entry in data["entries"]]
+
@@ -20,43 +20,226 @@
 #  You should have received a copy of the GNU General Public License
 #  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
 
-from PyQt5 import QtWidgets, QtGui, QtCore
-from PyQt5.QtWidgets import QMessageBox, QRadioButton
+import logging
+import os
 import sys
+import time
+import detectcache
 import devutils
 import device
+import driverstatus
+import metrics
+import planner
+import tracing
 
-class MainForm(QtWidgets.QMainWindow):
+# Command line options, parsed before PyQt5 is loaded so --help stays fast
+CMD_LINE = device.parse_options()
 
-        def __init__(self, **kwargs):
-                super(MainForm, self).__init__(**kwargs)
+from PyQt5 import QtWidgets, QtGui, QtCore
+from PyQt5.QtWidgets import QMessageBox, QRadioButton
+import iconcache
+
+class LogSignalHandler(logging.Handler):
+        """ Forwards log records to a Qt signal """
+
+        def __init__(self, signal):
+                super(LogSignalHandler, self).__init__()
+                self.signal = signal
+
+        def emit(self, record):
+                self.signal.emit(record.getMessage())
+
+class DriverChangeWorker(QtCore.QThread):
+        """ Runs the steps of a driver change outside of the UI thread """
+
+        line = QtCore.pyqtSignal(str)
+        stepStarted = QtCore.pyqtSignal(str)
+        stepFinished = QtCore.pyqtSignal(str, float, bool)
+        done = QtCore.pyqtSignal(bool)
 
-                # Command line options
-                cmd_line = device.parse_options()
-                device.setup_logging(cmd_line)
+        def __init__(self, driver, test, parent=None):
+                super(DriverChangeWorker, self).__init__(parent)
+                self.driver = driver
+                self.test = test
 
-                # Check for loading of ids files
+        def run(self):
+                handler = LogSignalHandler(self.line)
+                logging.getLogger().addHandler(handler)
+                device.OUTPUT = self.line.emit
+
+                success = False
                 try:
-                        device.load_ids()
+                        with tracing.span("driver switch", driver=self.driver):
+                                success = self.run_steps()
+                except Exception as err:
+                        device.log_error("Driver change failed: {}", err)
+                finally:
+                        device.OUTPUT = None
+                        logging.getLogger().removeHandler(handler)
+                        if CMD_LINE.trace:
+                                tracing.write_chrome_trace(CMD_LINE.trace)
+
+                if not self.test:
+                        metrics.record_switch(self.driver, success)
+                        metrics.flush()
+                self.done.emit(success)
+
+        def run_steps(self):
+                """ Runs steps of the driver change, returns False if one failed or was cancelled """
+                for name, step in planner.driver_change_steps(self.driver, self.test):
+                        # Steps are not interrupted, cancel takes effect between them
+                        if self.isInterruptionRequested():
+                                self.line.emit("Cancelled before: {}".format(name))
+                                return False
+                        self.stepStarted.emit(name)
+                        start = time.monotonic()
+                        result = step()
+                        self.stepFinished.emit(name, time.monotonic() - start, result is not False)
+                        if result is False:
+                                return False
+                return True
+
+class ProgressDialog(QtWidgets.QDialog):
+        """ Shows output and step timings of a running driver change """
+
+        def __init__(self, driver, test, parent=None):
+                super(ProgressDialog, self).__init__(parent)
+                self.setWindowTitle("Installing {}".format(driver))
+                self.setMinimumWidth(600)
+                self.setMinimumHeight(400)
+
+                layout = QtWidgets.QVBoxLayout()
+                self.setLayout(layout)
+
+                self.stepLabel = QtWidgets.QLabel("Starting...")
+                self.output = QtWidgets.QPlainTextEdit()
+                self.output.setReadOnly(True)
+                self.output.setMaximumBlockCount(5000)
+                self.cancelButton = QtWidgets.QPushButton("Cancel")
+                self.cancelButton.clicked.connect(self.cancel_clicked)
+
+                buttonLayout = QtWidgets.QHBoxLayout()
+                buttonLayout.addStretch()
+                buttonLayout.addWidget(self.cancelButton)
+
+                layout.addWidget(self.stepLabel)
+                layout.addWidget(self.output)
+                layout.addLayout(buttonLayout)
+
+                self.worker = DriverChangeWorker(driver, test, self)
+                self.worker.line.connect(self.output.appendPlainText)
+                self.worker.stepStarted.connect(self.step_started)
+                self.worker.stepFinished.connect(self.step_finished)
+                self.worker.done.connect(self.done_changing)
+                self.worker.start()
+
+        def step_started(self, name):
+                self.stepLabel.setText("{}...".format(name))
+                self.output.appendPlainText("==> {}".format(name))
+
+        def step_finished(self, name, seconds, success):
+                state = "done" if success else "FAILED"
+                self.output.appendPlainText("==> {0} {1} in {2:.1f} s".format(name, state, seconds))
+
+        def done_changing(self, success):
+                if success:
+                        self.stepLabel.setText("Driver installed, please reboot.")
+                else:
+                        self.stepLabel.setText("Driver was not installed, see the log below.")
+                self.cancelButton.setText("Close")
+                self.cancelButton.setEnabled(True)
+
+        def cancel_clicked(self):
+                if self.worker.isRunning():
+                        self.worker.requestInterruption()
+                        self.cancelButton.setEnabled(False)
+                        self.stepLabel.setText("Cancelling after current step...")
+                else:
+                        self.accept()
+
+        def reject(self):
+                # Escape or window close must not leave a running worker behind
+                if self.worker.isRunning():
+                        self.cancel_clicked()
+                else:
+                        super(ProgressDialog, self).reject()
+
+class DetectionWorker(QtCore.QThread):
+        """ Probes hardware and detects drivers outside of the UI thread """
+
+        detected = QtCore.pyqtSignal(str, str, object, str)
+        failed = QtCore.pyqtSignal(str)
+
+        def run(self):
+                try:
+                        # Hardware is probed once and shared with device module
+                        snapshot = devutils.get_snapshot(devutils.SNAPSHOT_CACHE)
+                        vendor = str(devutils.get_gpu_vendor())
+                        gpuName = "\n".join(devutils.get_gpu_names())
+                        driverText = ""
+                        for status in driverstatus.report(snapshot):
+                                if snapshot.gpu is not None and status.slot == snapshot.gpu.slot:
+                                        driverText = "Driver in use: {}".format(driverstatus.describe(status))
+                        drivers = device.check_device(detectcache.DETECT_CACHE)
                 except FileNotFoundError:
                         device.log_error("Cannot load ids files")
-                        no_ids = QMessageBox.critical(self, 'Error', "Cannot load ids files", QMessageBox.Ok , QMessageBox.Ok)
-                        if no_ids == QMessageBox.Ok:
-                                sys.exit()
-
+                        self.failed.emit("Cannot load ids files")
+                        return
+                except Exception as err:
+                        # The window waits for one of the signals
+                        device.log_error("Detection failed: {}", err)
+                        self.failed.emit(str(err) or type(err).__name__)
                         return
+                else:
+                        self.detected.emit(vendor, gpuName, drivers or [], driverText)
+                metrics.flush()
+
+class MainForm(QtWidgets.QMainWindow):
+
+        def __init__(self, **kwargs):
+                super(MainForm, self).__init__(**kwargs)
 
-                # Inicializing GPU vendor
-                vendor=str(devutils.get_gpu_vendor())
-                #vendor="virtualbox"
-                gpuName = str(devutils.get_gpu_name())
+                device.setup_logging(CMD_LINE)
+
+                self.firstPaint = None
+                self.pixelRatio = max(1, round(self.devicePixelRatioF()))
 
                 # Title, icon, window width
                 self.setWindowTitle("Favourix Driver manager")
-                self.setWindowIcon(QtGui.QIcon("src/drivers.svg"))
+                self.setWindowIcon(iconcache.icon("drivers", self.pixelRatio))
                 self.setMinimumWidth(450)
                 self.setMinimumHeight(200)
 
+                # Placeholder shown while hardware is detected in background
+                placeholder = QtWidgets.QLabel("Detecting hardware...")
+                placeholder.setAlignment(QtCore.Qt.AlignCenter)
+                self.setCentralWidget(placeholder)
+
+                self.detection = DetectionWorker(self)
+                self.detection.detected.connect(self.build_form)
+                self.detection.failed.connect(self.detection_failed)
+                self.detection.start()
+
+                self.show()
+
+        def paintEvent(self, event):
+                super(MainForm, self).paintEvent(event)
+                if self.firstPaint is None:
+                        self.firstPaint = time.monotonic()
+                        if CMD_LINE.startup_probe:
+                                print("first-paint", flush=True)
+
+        def closeEvent(self, event):
+                # Detection takes a moment at most, it is not interrupted
+                self.detection.wait()
+                super(MainForm, self).closeEvent(event)
+
+        def detection_failed(self, message):
+                no_ids = QMessageBox.critical(self, 'Error', message, QMessageBox.Ok , QMessageBox.Ok)
+                if no_ids == QMessageBox.Ok:
+                        sys.exit()
+
+        def build_form(self, vendor, gpuName, drivers, driverText):
                 # Main widget and BoxLayout
                 form = QtWidgets.QWidget()
                 formLayout = QtWidgets.QVBoxLayout()
@@ -67,7 +250,8 @@ class MainForm(QtWidgets.QMainWindow):
                 vendorLayout = QtWidgets.QHBoxLayout()
                 gpuNameLayout = QtWidgets.QHBoxLayout()
                 self.vendorLabel = QtWidgets.QLabel()
-                self.vendorLabel.setPixmap(QtGui.QPixmap("src/{0}.svg".format(vendor)).scaledToWidth(75))
+                logo = vendor if os.path.exists(iconcache.svg_path(vendor)) else "generic"
+                self.vendorLabel.setPixmap(iconcache.pixmap(logo, iconcache.LOGO_WIDTH, self.pixelRatio))
                 vendorLayout.addStretch()
                 vendorLayout.addWidget(self.vendorLabel)
                 vendorLayout.addStretch()
@@ -78,8 +262,16 @@ class MainForm(QtWidgets.QMainWindow):
                 formLayout.addLayout(vendorLayout)
                 formLayout.addLayout(gpuNameLayout)
 
+                # Kernel driver bound to the GPU
+                if driverText:
+                        driverLayout = QtWidgets.QHBoxLayout()
+                        driverLayout.addStretch()
+                        driverLayout.addWidget(QtWidgets.QLabel(driverText))
+                        driverLayout.addStretch()
+                        formLayout.addLayout(driverLayout)
+
                 # Driver menu
-                if (vendor != "nvidia" and vendor != "unknown"):
+                if not drivers and vendor != "unknown":
                         # first label layout
                         flLayout = QtWidgets.QHBoxLayout()
                         # second label layout
@@ -111,7 +303,7 @@ class MainForm(QtWidgets.QMainWindow):
                         formLayout.addLayout(slLayout)
                         formLayout.addLayout(buttonLayout)
 
-                elif vendor == "unknown":
+                elif not drivers:
                         # first label layout
                         flLayout = QtWidgets.QHBoxLayout()
                         # second label layout
@@ -144,9 +336,6 @@ class MainForm(QtWidgets.QMainWindow):
                         formLayout.addLayout(buttonLayout)
 
                 else:
-                        # Getting list of drivers
-                        drivers = device.check_device()
-
                         # Label layout
                         labelLayout = QtWidgets.QHBoxLayout()
                         # Choose layout
@@ -168,15 +357,19 @@ class MainForm(QtWidgets.QMainWindow):
                         self.dropButton.setIcon(QtGui.QIcon("src/drop.png"))
                         self.dropButton.setIconSize(QtCore.QSize(24,24))
                         self.dropButton.clicked.connect(self.drop_clicked)
-                        self.dropButton.setEnabled(False)
+                        self.dropButton.setToolTip("Switch back to the open source nouveau driver")
+                        self.dropButton.setVisible(vendor == "nvidia")
 
                         # Widgets including to layouts
                         labelLayout.addWidget(QtWidgets.QLabel("Available drivers"))
                         labelLayout.addStretch()
 
-                        index=0
-                        for index, driver in enumerate(drivers):
-                                chooseLayout.addWidget(QRadioButton("{}".format(driver)))
+                        self.driverButtons = []
+                        for driver in drivers:
+                                driverButton = QRadioButton("{}".format(driver))
+                                driverButton.toggled.connect(self.driver_toggled)
+                                self.driverButtons.append(driverButton)
+                                chooseLayout.addWidget(driverButton)
 
                         buttonLayout.addStretch()
                         buttonLayout.addWidget(self.dropButton)
@@ -189,7 +382,9 @@ class MainForm(QtWidgets.QMainWindow):
                         formLayout.addLayout(chooseLayout)
                         formLayout.addLayout(buttonLayout)
 
-                self.show()
+                if CMD_LINE.startup_probe:
+                        print("detected", flush=True)
+                        QtCore.QTimer.singleShot(0, self.close)
 
                 
 
@@ -199,11 +394,34 @@ class MainForm(QtWidgets.QMainWindow):
         def close_clicked(self):
                 sys.exit()
 
+        def driver_toggled(self):
+                self.applyButton.setEnabled(self.selected_driver() is not None)
+
+        def selected_driver(self):
+                for driverButton in self.driverButtons:
+                        if driverButton.isChecked():
+                                return driverButton.text()
+                return None
+
+        def change_driver(self, driver):
+                answer = QMessageBox.question(
+                        self, 'Install driver',
+                        "Install {} driver? This can take several minutes.".format(driver),
+                        QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+                if answer != QMessageBox.Yes:
+                        return
+
+                self.progress = ProgressDialog(driver, CMD_LINE.test, self)
+                self.progress.setModal(True)
+                self.progress.show()
+
         def apply_clicked(self):
-                pass
+                driver = self.selected_driver()
+                if driver is not None:
+                        self.change_driver(driver)
 
         def drop_clicked(self):
-                pass
+                self.change_driver("nouveau")
 
 class App(QtWidgets.QApplication):
 
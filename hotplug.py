@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  hotplug module
+#
+#  Copyright © 2019 Favourix <vladimir.kokes@favourix.com
+#  This file is part of fx-drivers (Favourix OS Driver manager).
+#
+#  Favourix is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Favourix is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
+
+""" Incremental re-detection on PCI hotplug
+
+Kernel uevents are read from a NETLINK_KOBJECT_UEVENT socket. A PCI add
+or remove event carries the slot, class and ids of the device, so only
+that device is matched against the rule table and sysfs is not rescanned.
+
+Events can be recorded to a json lines log, which starts with the
+snapshot the events apply to, and replayed later without the hardware.
+"""
+
+import collections
+import json
+import socket
+import time
+import devutils
+import device
+
+NETLINK_KOBJECT_UEVENT = 15
+
+# Multicast group of uevents sent by the kernel, udev resends on group 2
+KERNEL_GROUP = 1
+
+RECEIVE_BUFFER = 256 * 1024
+
+Uevent = collections.namedtuple("Uevent", ["action", "devpath", "env"])
+Uevent.__doc__ = """ Kernel uevent, env holds its KEY=VALUE pairs """
+
+
+def parse_uevent(data):
+    """ Parses a kernel uevent datagram, None for anything else """
+    fields = data.split(b"\0")
+    header = fields[0].decode(errors="replace")
+    if "@" not in header:
+        # udev messages start with a libudev header instead
+        return None
+    action, devpath = header.split("@", 1)
+    env = {}
+    for field in fields[1:]:
+        name, sep, value = field.decode(errors="replace").partition("=")
+        if sep:
+            env[name] = value
+    return Uevent(action, devpath, env)
+
+
+def pci_device(uevent):
+    """ Builds PciDevice from the variables of a PCI uevent """
+    env = uevent.env
+    vendor_id, _, device_id = env.get("PCI_ID", ":").partition(":")
+    subsystem_vendor_id, _, subsystem_device_id = env.get("PCI_SUBSYS_ID", ":").partition(":")
+
+    def read(value):
+        try:
+            return int(value, 16)
+        except ValueError:
+            return None
+
+    return devutils.PciDevice(
+        env["PCI_SLOT_NAME"], read(env.get("PCI_CLASS", "")), read(vendor_id), read(device_id),
+        read(subsystem_vendor_id), read(subsystem_device_id))
+
+
+def device_mask(pci_device):
+    """ Returns rules bitmask of one device """
+    if None in (pci_device.class_id, pci_device.vendor_id, pci_device.device_id):
+        return 0
+    return device.RULE_TABLE.match(pci_device.class_id, pci_device.vendor_id, pci_device.device_id)
+
+
+class DetectionState(object):
+    """ Snapshot and the drivers detected for it
+
+    States are not modified, apply() returns a new one, so a reader holding
+    a state always sees a snapshot and drivers that belong together.
+    """
+
+    __slots__ = ("snapshot", "masks", "drivers")
+
+    def __init__(self, snapshot, masks=None):
+        if device.RULE_TABLE is None:
+            device.load_ids()
+        if masks is None:
+            masks = dict((pci_device.slot, device_mask(pci_device)) for pci_device in snapshot.devices)
+        self.snapshot = snapshot
+        self.masks = masks
+        self.drivers = device.RULE_TABLE.drivers(self.mask() & device.RULE_TABLE.display_mask)
+
+    def mask(self):
+        """ Returns rules bitmask of all devices """
+        mask = 0
+        for slot_mask in self.masks.values():
+            mask |= slot_mask
+        return mask
+
+    def apply(self, uevent):
+        """ Returns state after a uevent, self if the uevent does not change devices """
+        if uevent.env.get("SUBSYSTEM") != "pci" or "PCI_SLOT_NAME" not in uevent.env:
+            return self
+
+        slot = uevent.env["PCI_SLOT_NAME"]
+        masks = dict(self.masks)
+        if uevent.action == "add":
+            added = pci_device(uevent)
+            masks[slot] = device_mask(added)
+        elif uevent.action == "remove":
+            added = None
+            masks.pop(slot, None)
+        else:
+            return self
+        return DetectionState(self.snapshot.with_device(slot, added), masks)
+
+
+def open_netlink():
+    """ Opens socket receiving kernel uevents """
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+    sock.bind((0, KERNEL_GROUP))
+    return sock
+
+
+def netlink_events(sock=None):
+    """ Yields uevents as the kernel sends them """
+    if sock is None:
+        sock = open_netlink()
+    with sock:
+        while True:
+            uevent = parse_uevent(sock.recv(RECEIVE_BUFFER))
+            if uevent is not None:
+                yield uevent
+
+
+def record_events(events, log_file, snapshot):
+    """ Writes snapshot and then every event to log_file, yields the events """
+    log_file.write(json.dumps({"snapshot": snapshot.to_dict()}) + "\n")
+    log_file.flush()
+    for uevent in events:
+        log_file.write(json.dumps({
+            "time": time.time(), "action": uevent.action,
+            "devpath": uevent.devpath, "env": uevent.env}) + "\n")
+        log_file.flush()
+        yield uevent
+
+
+def read_event_log(path):
+    """ Returns (snapshot or None, [uevent]) of the last session of a recorded log """
+    snapshot = None
+    events = []
+    with open(path) as log_file:
+        for line in log_file:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if "snapshot" in entry:
+                # Events of earlier sessions belong to their own snapshot
+                snapshot = devutils.HardwareSnapshot.from_dict(entry["snapshot"])
+                events = []
+            else:
+                events.append(Uevent(entry["action"], entry["devpath"], entry["env"]))
+    return snapshot, events
+
+
+def watch(state, events, changed):
+    """ Applies events starting from state, calling changed(uevent, old, new) on changes """
+    for uevent in events:
+        new_state = state.apply(uevent)
+        if new_state.drivers != state.drivers:
+            changed(uevent, state.drivers, new_state.drivers)
+        state = new_state
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  iconcache module
+#
+#  Copyright © 2019 Favourix <vladimir.kokes@favourix.com
+#  This file is part of fx-drivers (Favourix OS Driver manager).
+#
+#  Favourix is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Favourix is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
+
+""" On-disk cache of rasterized SVG icons
+
+Rendering the SVGs in src/ costs tens of milliseconds each at startup.
+Every (icon, width, device pixel ratio) is rendered once to a PNG whose
+name contains the size and mtime of the SVG, so an updated SVG is
+rendered again and its old PNGs are removed.
+
+Run as a script to render every icon at the sizes the GUI uses.
+"""
+
+import os
+import sys
+
+from PyQt5 import QtCore, QtGui, QtSvg
+
+ICONS_PATH = "src"
+
+CACHE_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "fx-drivers", "icons")
+
+# Logo width in the main window
+LOGO_WIDTH = 75
+
+# Sizes of the window icon
+WINDOW_ICON_SIZES = (16, 24, 32, 48, 64)
+
+DEVICE_PIXEL_RATIOS = (1, 2)
+
+
+def svg_path(name, icons_path=ICONS_PATH):
+    """ Returns path of icon name """
+    return os.path.join(icons_path, name + ".svg")
+
+
+def cache_file(name, width, ratio, icons_path=ICONS_PATH, cache_path=CACHE_PATH):
+    """ Returns path of the PNG of an icon, named after the state of its SVG """
+    stat = os.stat(svg_path(name, icons_path))
+    return os.path.join(cache_path, "{0}-{1}@{2}x-{3:x}-{4:x}.png".format(
+        name, width, ratio, stat.st_size, stat.st_mtime_ns))
+
+
+def render(name, width, ratio, icons_path=ICONS_PATH):
+    """ Renders icon to an image width logical pixels wide """
+    renderer = QtSvg.QSvgRenderer(svg_path(name, icons_path))
+    size = renderer.defaultSize()
+    height = max(1, round(width * size.height() / max(1, size.width())))
+    image = QtGui.QImage(width * ratio, height * ratio, QtGui.QImage.Format_ARGB32_Premultiplied)
+    image.fill(QtCore.Qt.transparent)
+    painter = QtGui.QPainter(image)
+    renderer.render(painter)
+    painter.end()
+    return image
+
+
+def remove_stale(name, path, cache_path=CACHE_PATH):
+    """ Removes PNGs of icon name rendered from another version of its SVG """
+    prefix = name + "-"
+    current = os.path.basename(path).rsplit("-", 2)[1:]
+    try:
+        entries = os.listdir(cache_path)
+    except OSError:
+        return
+    for entry in entries:
+        if entry.startswith(prefix) and entry.rsplit("-", 2)[1:] != current:
+            try:
+                os.remove(os.path.join(cache_path, entry))
+            except OSError:
+                pass
+
+
+def pixmap(name, width, ratio=1, icons_path=ICONS_PATH, cache_path=CACHE_PATH):
+    """ Returns icon as pixmap width logical pixels wide, from cache if possible """
+    path = cache_file(name, width, ratio, icons_path, cache_path)
+    image = QtGui.QImage(path)
+    if image.isNull():
+        image = render(name, width, ratio, icons_path)
+        try:
+            os.makedirs(cache_path, exist_ok=True)
+            tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+            if image.save(tmp_path, "PNG"):
+                os.replace(tmp_path, path)
+                remove_stale(name, path, cache_path)
+        except OSError:
+            pass
+    image.setDevicePixelRatio(ratio)
+    return QtGui.QPixmap.fromImage(image)
+
+
+def icon(name, ratio=1, icons_path=ICONS_PATH, cache_path=CACHE_PATH):
+    """ Returns window icon with all WINDOW_ICON_SIZES """
+    result = QtGui.QIcon()
+    for size in WINDOW_ICON_SIZES:
+        result.addPixmap(pixmap(name, size, ratio, icons_path, cache_path))
+    return result
+
+
+def prerender(icons_path=ICONS_PATH, cache_path=CACHE_PATH):
+    """ Renders all icons at the sizes the GUI uses, returns number of images """
+    count = 0
+    for entry in sorted(os.listdir(icons_path)):
+        if not entry.endswith(".svg"):
+            continue
+        name = entry[:-len(".svg")]
+        widths = WINDOW_ICON_SIZES if name == "drivers" else (LOGO_WIDTH,)
+        for width in widths:
+            for ratio in DEVICE_PIXEL_RATIOS:
+                pixmap(name, width, ratio, icons_path, cache_path)
+                count += 1
+    return count
+
+
+if __name__ == '__main__':
+    APP = QtGui.QGuiApplication(sys.argv[:1])
+    CACHE_DIR = sys.argv[1] if len(sys.argv) > 1 else CACHE_PATH
+    print("{0}: {1} icons".format(CACHE_DIR, prerender(cache_path=CACHE_DIR)))
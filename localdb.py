@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  localdb module
+#
+#  Copyright © 2019 Favourix <vladimir.kokes@favourix.com
+#  This file is part of fx-drivers (Favourix OS Driver manager).
+#
+#  Favourix is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Favourix is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
+
+""" Reader of the pacman local package database
+
+Parses <dbpath>/local/*/desc directly instead of forking pacman -Q. The
+parsed database can be cached in a json file that stays valid as long as
+the mtime of the local directory does not change, which pacman bumps
+whenever a package is installed or removed.
+"""
+
+import json
+import os
+import tracing
+
+LOCAL_DB_PATH = "/var/lib/pacman/local"
+
+# desc sections we keep
+FIELDS = ("%NAME%", "%VERSION%", "%PROVIDES%", "%REPLACES%")
+
+
+def strip_version(depend):
+    """ Returns package name of a dependency string like libgl=1.0 """
+    for separator in "<>=":
+        depend = depend.split(separator, 1)[0]
+    return depend
+
+
+def upstream_version(version):
+    """ Strips epoch and pkgrel of a package version """
+    return version.split(":", 1)[-1].rsplit("-", 1)[0]
+
+
+def parse_sections(lines, fields=FIELDS):
+    """ Parses lines of a desc file, returns dict of section name to list of values
+
+    Sections not in fields are skipped, all are kept if fields is None.
+    """
+    sections = {}
+    values = None
+    for line in lines:
+        line = line.strip()
+        if not line:
+            values = None
+        elif values is None and line.startswith("%") and line.endswith("%"):
+            keep = fields is None or line in fields
+            values = sections.setdefault(line, []) if keep else []
+        elif values is not None:
+            values.append(line)
+    return sections
+
+
+def parse_desc(path):
+    """ Parses a desc file, returns dict of section name to list of values """
+    with open(path, encoding="utf-8", errors="replace") as desc:
+        return parse_sections(desc)
+
+
+class LocalDatabase(object):
+    """ Installed packages with their versions, provides and replaces """
+
+    __slots__ = ("versions", "names", "provides", "replaces", "providers")
+
+    def __init__(self, versions, provides, replaces):
+        self.versions = dict(versions)
+        self.names = frozenset(self.versions)
+        self.provides = dict((name, frozenset(items)) for name, items in provides.items())
+        self.replaces = dict((name, frozenset(items)) for name, items in replaces.items())
+        providers = {}
+        for name, items in self.provides.items():
+            for item in items:
+                providers.setdefault(item, set()).add(name)
+        self.providers = dict((item, frozenset(names)) for item, names in providers.items())
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def satisfiers(self, names):
+        """ Returns installed packages called or providing any of names """
+        names = frozenset(names)
+        found = set(names & self.names)
+        for name in names & self.providers.keys():
+            found |= self.providers[name]
+        return found
+
+    def to_dict(self):
+        """ Returns database as json serializable dictionary """
+        return {
+            "versions": self.versions,
+            "provides": dict((name, sorted(items)) for name, items in self.provides.items()),
+            "replaces": dict((name, sorted(items)) for name, items in self.replaces.items())}
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Rebuilds database stored with to_dict() """
+        return cls(data["versions"], data["provides"], data["replaces"])
+
+
+def parse_local_db(path=LOCAL_DB_PATH):
+    """ Parses all desc files of a local database directory """
+    versions = {}
+    provides = {}
+    replaces = {}
+    for entry in os.listdir(path):
+        try:
+            sections = parse_desc(os.path.join(path, entry, "desc"))
+        except (NotADirectoryError, FileNotFoundError):
+            # ALPM_DB_VERSION and friends
+            continue
+        if not sections.get("%NAME%"):
+            continue
+        name = sections["%NAME%"][0]
+        versions[name] = sections.get("%VERSION%", [""])[0]
+        if "%PROVIDES%" in sections:
+            provides[name] = [strip_version(item) for item in sections["%PROVIDES%"]]
+        if "%REPLACES%" in sections:
+            replaces[name] = [strip_version(item) for item in sections["%REPLACES%"]]
+    return LocalDatabase(versions, provides, replaces)
+
+
+def installed_versions(names, path=LOCAL_DB_PATH):
+    """ Returns {name: version} of the installed packages among names
+
+    Entries of the local database are <name>-<pkgver>-<pkgrel>.
+    """
+    names = set(names)
+    versions = {}
+    try:
+        entries = os.listdir(path)
+    except OSError:
+        return versions
+    for entry in entries:
+        parts = entry.rsplit("-", 2)
+        if len(parts) == 3 and parts[0] in names:
+            versions[parts[0]] = parts[1] + "-" + parts[2]
+    return versions
+
+
+def read_local_db(path=LOCAL_DB_PATH, cache_path=None):
+    """ Returns parsed local database, from cache_path while it is current """
+    mtime = os.stat(path).st_mtime_ns
+
+    if cache_path:
+        try:
+            with open(cache_path) as cache_file:
+                data = json.load(cache_file)
+            if data.get("path") == path and data.get("mtime") == mtime:
+                database = LocalDatabase.from_dict(data)
+                tracing.count("cache_requests", cache="localdb", result="hit")
+                return database
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        tracing.count("cache_requests", cache="localdb", result="miss")
+
+    database = parse_local_db(path)
+
+    if cache_path:
+        data = database.to_dict()
+        data["path"] = path
+        data["mtime"] = mtime
+        tmp_path = "{0}.{1}.tmp".format(cache_path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(tmp_path, 'w') as cache_file:
+                json.dump(data, cache_file)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+
+    return database
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  metrics module
+#
+#  Copyright © 2019 Favourix <vladimir.kokes@favourix.com
+#  This file is part of fx-drivers (Favourix OS Driver manager).
+#
+#  Favourix is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Favourix is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
+
+""" Prometheus metrics for the node exporter textfile collector
+
+Every run adds its finished spans and counters (see tracing) to totals
+kept in METRICS_STATE and rewrites METRICS_FILE from them with a
+temporary file and a rename, so the collector never reads half a file.
+Spans become histograms: detection latency, every phase of a driver
+switch and every mkinitcpio preset. Counters become forks per command
+and cache requests per cache and result. The outcome of the last switch
+to every driver is kept as gauges.
+
+Writing needs root, runs of ordinary users skip it silently.
+"""
+
+import fcntl
+import json
+import os
+import threading
+import time
+import tracing
+
+METRICS_FILE = "/var/lib/prometheus/node-exporter/fx-drivers.prom"
+METRICS_STATE = "/var/lib/fx-drivers/metrics.json"
+
+# Upper bounds of histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600)
+
+# Span name to (metric, phase label)
+SPAN_METRICS = {
+    "detection": ("fx_drivers_detection_duration_seconds", None),
+    "planning": ("fx_drivers_phase_duration_seconds", "planning"),
+    "remove conflicts": ("fx_drivers_phase_duration_seconds", "conflict_removal"),
+    "install packages": ("fx_drivers_phase_duration_seconds", "package_install"),
+    "refresh databases": ("fx_drivers_phase_duration_seconds", "database_refresh"),
+    "resolve transaction": ("fx_drivers_phase_duration_seconds", "transaction_resolve"),
+    "remove conflicts and install packages": ("fx_drivers_phase_duration_seconds", "package_install"),
+    "post-install": ("fx_drivers_phase_duration_seconds", "post_install"),
+    "initramfs": ("fx_drivers_phase_duration_seconds", "initramfs"),
+    "mkinitcpio": ("fx_drivers_mkinitcpio_duration_seconds", None),
+    "driver switch": ("fx_drivers_switch_duration_seconds", None)}
+
+# Counter name of tracing.count() to metric
+COUNTER_METRICS = {
+    "forks": "fx_drivers_subprocess_forks_total",
+    "cache_requests": "fx_drivers_cache_requests_total"}
+
+HELP = {
+    "fx_drivers_detection_duration_seconds": "Time to detect drivers for the hardware",
+    "fx_drivers_phase_duration_seconds": "Time of a phase of a driver switch",
+    "fx_drivers_mkinitcpio_duration_seconds": "Time to build the initramfs of a preset",
+    "fx_drivers_switch_duration_seconds": "Time of a whole driver switch",
+    "fx_drivers_subprocess_forks_total": "Commands run, by command",
+    "fx_drivers_cache_requests_total": "Cache lookups, by cache and result",
+    "fx_drivers_last_switch_success": "1 if the last switch to the driver succeeded",
+    "fx_drivers_last_switch_timestamp_seconds": "Time of the last switch to the driver"}
+
+TYPES = {
+    "fx_drivers_subprocess_forks_total": "counter",
+    "fx_drivers_cache_requests_total": "counter",
+    "fx_drivers_last_switch_success": "gauge",
+    "fx_drivers_last_switch_timestamp_seconds": "gauge"}
+
+# Switch outcomes of this process, driver to (success, time)
+_SWITCHES = {}
+
+# Number of spans of this process already added to the totals
+_FLUSHED = 0
+
+_LOCK = threading.Lock()
+
+
+def record_switch(driver, success):
+    """ Remembers outcome of a switch to driver """
+    with _LOCK:
+        _SWITCHES[driver] = (bool(success), time.time())
+
+
+def series_key(metric, labels):
+    """ Returns key of one time series in the state """
+    return json.dumps([metric, sorted(labels.items())])
+
+
+def span_series(item):
+    """ Returns (metric, labels) of a finished span, None for unexported spans """
+    if item.name not in SPAN_METRICS:
+        return None
+    metric, phase = SPAN_METRICS[item.name]
+    labels = {}
+    if phase is not None:
+        labels["phase"] = phase
+    for name in ("preset", "driver"):
+        if name in item.args:
+            labels[name] = str(item.args[name])
+    return metric, labels
+
+
+def observe(state, metric, labels, value):
+    """ Adds value to a histogram of the state """
+    histogram = state["histograms"].setdefault(series_key(metric, labels), {
+        "metric": metric, "labels": labels, "buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0})
+    for index, bound in enumerate(BUCKETS):
+        if value <= bound:
+            histogram["buckets"][index] += 1
+    histogram["sum"] += value
+    histogram["count"] += 1
+
+
+def update(state, spans, counters, switches):
+    """ Adds spans, counters and switch outcomes of this process to state """
+    for item in spans:
+        series = span_series(item)
+        if series is not None:
+            observe(state, series[0], series[1], item.duration)
+    for (name, label_items), value in counters.items():
+        if name not in COUNTER_METRICS:
+            continue
+        labels = dict(label_items)
+        counter = state["counters"].setdefault(series_key(COUNTER_METRICS[name], labels), {
+            "metric": COUNTER_METRICS[name], "labels": labels, "value": 0})
+        counter["value"] += value
+    for driver, (success, timestamp) in switches.items():
+        state["switches"][driver] = {"success": success, "time": timestamp}
+
+
+def format_labels(labels, extra=None):
+    """ Returns {name="value",...} label set, empty without labels """
+    items = sorted(labels.items()) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(
+        name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in items) + "}"
+
+
+def render(state):
+    """ Returns state in Prometheus text exposition format """
+    families = {}
+    for _, histogram in sorted(state["histograms"].items()):
+        lines = families.setdefault(histogram["metric"], [])
+        for bound, count in zip(BUCKETS, histogram["buckets"]):
+            lines.append("{0}_bucket{1} {2}".format(
+                histogram["metric"], format_labels(histogram["labels"], ("le", repr(float(bound)))), count))
+        lines.append("{0}_bucket{1} {2}".format(
+            histogram["metric"], format_labels(histogram["labels"], ("le", "+Inf")), histogram["count"]))
+        lines.append("{0}_sum{1} {2!r}".format(
+            histogram["metric"], format_labels(histogram["labels"]), histogram["sum"]))
+        lines.append("{0}_count{1} {2}".format(
+            histogram["metric"], format_labels(histogram["labels"]), histogram["count"]))
+    for _, counter in sorted(state["counters"].items()):
+        families.setdefault(counter["metric"], []).append("{0}{1} {2}".format(
+            counter["metric"], format_labels(counter["labels"]), counter["value"]))
+    for driver, switch in sorted(state["switches"].items()):
+        labels = format_labels({"driver": driver})
+        families.setdefault("fx_drivers_last_switch_success", []).append(
+            "fx_drivers_last_switch_success{0} {1}".format(labels, int(switch["success"])))
+        families.setdefault("fx_drivers_last_switch_timestamp_seconds", []).append(
+            "fx_drivers_last_switch_timestamp_seconds{0} {1!r}".format(labels, switch["time"]))
+
+    output = []
+    for metric in sorted(families):
+        output.append("# HELP {0} {1}".format(metric, HELP.get(metric, metric)))
+        output.append("# TYPE {0} {1}".format(metric, TYPES.get(metric, "histogram")))
+        output.extend(families[metric])
+    return "\n".join(output) + "\n"
+
+
+def write_atomic(path, content):
+    """ Writes file through a temporary file in the same directory and rename """
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as tmp_file:
+        tmp_file.write(content)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+def flush(metrics_file=METRICS_FILE, state_path=METRICS_STATE):
+    """ Adds what this process measured since the last flush to the metrics file
+
+    Returns False when the files cannot be written.
+    """
+    global _FLUSHED
+    with _LOCK:
+        spans, finished = tracing.finished_spans(_FLUSHED)
+        counters = tracing.take_counters()
+        switches = dict(_SWITCHES)
+        if not spans and not counters and not switches:
+            _FLUSHED = finished
+            return True
+        try:
+            os.makedirs(os.path.dirname(state_path), exist_ok=True)
+            os.makedirs(os.path.dirname(metrics_file), exist_ok=True)
+            # Runs of the daemon and the command line share the totals
+            with open(state_path + ".lock", "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    with open(state_path) as state_file:
+                        state = json.load(state_file)
+                except (OSError, ValueError):
+                    state = {}
+                for name in ("histograms", "counters", "switches"):
+                    state.setdefault(name, {})
+                update(state, spans, counters, switches)
+                write_atomic(state_path, json.dumps(state))
+                write_atomic(metrics_file, render(state))
+        except OSError:
+            # Counted again by the next flush
+            for (name, label_items), value in counters.items():
+                tracing.count(name, value, **dict(label_items))
+            return False
+        _FLUSHED = finished
+        _SWITCHES.clear()
+        return True
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  pciids module
+#
+#  Copyright © 2019 Favourix <vladimir.kokes@favourix.com
+#  This file is part of fx-drivers (Favourix OS Driver manager).
+#
+#  Favourix is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Favourix is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
+
+""" Compiled index of the pci/*.ids driver tables
+
+All .ids files are compiled into one binary file of sorted
+(vendor << 16 | device, driver bitmask) records, so a lookup is a binary
+search over an mmap instead of a scan over lists of strings.
+
+File layout (little endian):
+    header   magic, version, number of drivers, number of records
+    stamp    sha256 over name, size and mtime of every .ids file
+    drivers  driver names, one per bit, newline separated
+    records  (uint32 key, uint32 mask) pairs sorted by key
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import sys
+
+IDS_PATH = "pci"
+INDEX_FILE = "ids.idx"
+
+MAGIC = b"FXID"
+VERSION = 1
+
+HEADER = struct.Struct("<4sHHI32sI")
+RECORD = struct.Struct("<II")
+
+# Vendor of the devices listed in an .ids file, by file name prefix
+IDS_VENDORS = (
+    ("nvidia", 0x10de),
+    ("amdgpu", 0x1002),
+    ("ati", 0x1002),
+    ("catalyst", 0x1002))
+
+
+def ids_vendor(name):
+    """ Returns PCI vendor id of devices listed in an .ids file """
+    for prefix, vendor_id in IDS_VENDORS:
+        if name.startswith(prefix):
+            return vendor_id
+    return None
+
+
+def list_ids_files(ids_path=IDS_PATH):
+    """ Returns sorted names of all .ids files in ids_path """
+    return sorted(item for item in os.listdir(ids_path) if item.endswith('.ids'))
+
+
+def compute_stamp(ids_path=IDS_PATH):
+    """ Hashes name, size and mtime of all .ids files """
+    stamp = hashlib.sha256()
+    for item in list_ids_files(ids_path):
+        stat = os.stat(os.path.join(ids_path, item))
+        stamp.update("{0}:{1}:{2}\n".format(item, stat.st_size, stat.st_mtime_ns).encode())
+    return stamp.digest()
+
+
+def load_ids_file(path):
+    """ Loads pci device numbers from a ids file """
+    with open(path, 'r') as ids_file:
+        return [int(pci_id, 16) for pci_id in ids_file.read().split()]
+
+
+def build_index(ids_path=IDS_PATH):
+    """ Compiles all .ids files into index bytes """
+    stamp = compute_stamp(ids_path)
+
+    drivers = []
+    records = {}
+    for item in list_ids_files(ids_path):
+        vendor_id = ids_vendor(item)
+        if vendor_id is None:
+            continue
+        bit = 1 << len(drivers)
+        drivers.append(item[:-4])
+        for device_id in load_ids_file(os.path.join(ids_path, item)):
+            key = vendor_id << 16 | device_id
+            records[key] = records.get(key, 0) | bit
+
+    names = "\n".join(drivers).encode()
+    data = [HEADER.pack(MAGIC, VERSION, len(drivers), len(records), stamp, len(names)), names]
+    for key in sorted(records):
+        data.append(RECORD.pack(key, records[key]))
+    return b"".join(data)
+
+
+def write_index(data, index_path):
+    """ Atomically writes index bytes to index_path """
+    tmp_path = "{0}.{1}.tmp".format(index_path, os.getpid())
+    with open(tmp_path, 'wb') as index_file:
+        index_file.write(data)
+    os.replace(tmp_path, index_path)
+
+
+class PciIdIndex(object):
+    """ Read-only view of a compiled ids index """
+
+    __slots__ = ("drivers", "stamp", "_buf", "_count", "_offset")
+
+    def __init__(self, buf):
+        magic, version, ndrivers, count, stamp, names_len = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a fx-drivers ids index")
+        names = bytes(buf[HEADER.size:HEADER.size + names_len]).decode()
+        self.drivers = tuple(names.split("\n")) if ndrivers else ()
+        self.stamp = stamp
+        self._buf = buf
+        self._count = count
+        self._offset = HEADER.size + names_len
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def records(self):
+        """ Buffer of all (key, mask) records, for bulk readers like numpy """
+        return memoryview(self._buf)[self._offset:self._offset + self._count * RECORD.size]
+
+    def bit(self, driver):
+        """ Returns mask bit of driver, 0 if the index does not know it """
+        try:
+            return 1 << self.drivers.index(driver)
+        except ValueError:
+            return 0
+
+    def lookup(self, vendor_id, device_id):
+        """ Returns driver bitmask for a (vendor, device) pair """
+        key = vendor_id << 16 | device_id
+        buf = self._buf
+        offset = self._offset
+        unpack_from = RECORD.unpack_from
+        low = 0
+        high = self._count
+        while low < high:
+            middle = (low + high) >> 1
+            found, mask = unpack_from(buf, offset + middle * RECORD.size)
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return mask
+        return 0
+
+    def drivers_for(self, vendor_id, device_id):
+        """ Returns names of drivers listing a (vendor, device) pair """
+        mask = self.lookup(vendor_id, device_id)
+        return [driver for bit, driver in enumerate(self.drivers) if mask & (1 << bit)]
+
+    def close(self):
+        """ Releases the underlying mmap """
+        if isinstance(self._buf, mmap.mmap):
+            self._buf.close()
+
+
+def open_index(index_path):
+    """ Maps an index file into memory """
+    with open(index_path, 'rb') as index_file:
+        return PciIdIndex(mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def load_index(ids_path=IDS_PATH, index_path=None):
+    """ Opens the compiled index, rebuilding it when an .ids file changed """
+    if index_path is None:
+        index_path = os.path.join(ids_path, INDEX_FILE)
+
+    stamp = compute_stamp(ids_path)
+    try:
+        index = open_index(index_path)
+        if index.stamp == stamp:
+            return index
+        index.close()
+    except (OSError, ValueError, struct.error):
+        pass
+
+    data = build_index(ids_path)
+    try:
+        write_index(data, index_path)
+        return open_index(index_path)
+    except OSError:
+        # Read-only installation, keep the index in memory
+        return PciIdIndex(data)
+
+
+if __name__ == '__main__':
+    IDS_DIR = sys.argv[1] if len(sys.argv) > 1 else IDS_PATH
+    INDEX_PATH = os.path.join(IDS_DIR, INDEX_FILE)
+    write_index(build_index(IDS_DIR), INDEX_PATH)
+    INDEX = open_index(INDEX_PATH)
+    print("{0}: {1} drivers, {2} devices".format(INDEX_PATH, len(INDEX.drivers), len(INDEX)))
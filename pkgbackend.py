@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  pkgbackend module
+#
+#  Copyright © 2019 Favourix <vladimir.kokes@favourix.com
+#  This file is part of fx-drivers (Favourix OS Driver manager).
+#
+#  Favourix is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Favourix is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
+
+""" Package manager backends
+
+A driver switch is one transaction: the conflicting packages are removed
+and the driver packages installed together. AlpmBackend does that in
+process with pyalpm, SubprocessBackend falls back to the pacman command
+and FakeBackend keeps the package set in memory.
+"""
+
+import subprocess
+import devutils
+import tracing
+
+PACMAN = "pacman"
+PACMAN_CONF = "/etc/pacman.conf"
+
+# alpm_question_type_t of provider selection, answered with a provider index
+QUESTION_SELECT_PROVIDER = 1 << 5
+
+
+class PackageError(Exception):
+    """ Package query or transaction failed """
+    pass
+
+
+def pacman_options(config=PACMAN_CONF, root="/"):
+    """ Returns pacman options selecting config and root """
+    options = [] if config == PACMAN_CONF else ["--config", config]
+    if root != "/":
+        options += ["--sysroot", root]
+    return options
+
+
+def pacman_commands(remove, install, refresh=True, config=PACMAN_CONF, root="/"):
+    """ Returns pacman commands removing and installing packages """
+    options = pacman_options(config, root)
+    cmds = []
+    if remove:
+        cmds.append([PACMAN, "-Rs", "--noconfirm", "--noprogressbar", "--nodeps"] + options + list(remove))
+    if install:
+        sync = "-Sqy" if refresh else "-Sq"
+        cmds.append([PACMAN, sync, "--noconfirm", "--noprogressbar"] + options + list(install))
+    return cmds
+
+
+class PackageBackend(object):
+    """ Interface of all package backends """
+
+    # pacman.conf the backend reads
+    config = PACMAN_CONF
+
+    # Root of the system packages are changed in
+    root = "/"
+
+    def installed_packages(self):
+        """ Returns set of installed package names """
+        raise NotImplementedError
+
+    def target_versions(self, names):
+        """ Returns {name: version} of the sync packages installing names would pick
+
+        Versions are those of the current sync databases, unknown packages
+        are left out.
+        """
+        return {}
+
+    def commands(self, remove, install, refresh=True):
+        """ Returns pacman commands equivalent to a transaction """
+        return pacman_commands(remove, install, refresh, self.config, self.root)
+
+    def transaction(self, remove, install, refresh=True, output=None):
+        """ Removes and installs packages, raises PackageError on failure
+
+        Progress messages are passed line by line to output if given.
+        """
+        raise NotImplementedError
+
+
+class SubprocessBackend(PackageBackend):
+    """ Runs the pacman command, one run for removals and one for installs """
+
+    def __init__(self, config=PACMAN_CONF, root="/"):
+        self.config = config
+        self.root = root
+
+    def installed_packages(self):
+        cmd = [PACMAN, "-Qq"] + pacman_options(self.config, self.root)
+        tracing.count("forks", command=PACMAN)
+        try:
+            res = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as err:
+            raise PackageError(err.output.decode())
+        except OSError as err:
+            raise PackageError(str(err))
+        return set(res.decode().split())
+
+    def target_versions(self, names):
+        cmd = [PACMAN, "-Sp", "--print-format", "%n %v"] + pacman_options(self.config, self.root) + list(names)
+        tracing.count("forks", command=PACMAN)
+        try:
+            res = subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
+        except (subprocess.CalledProcessError, OSError):
+            return {}
+        versions = {}
+        for line in res.decode().splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[0] in names:
+                versions[fields[0]] = fields[1]
+        return versions
+
+    def transaction(self, remove, install, refresh=True, output=None):
+        for cmd in self.commands(remove, install, refresh):
+            try:
+                with tracing.span("remove conflicts" if cmd[1].startswith("-R") else "install packages"):
+                    devutils.run_command(cmd, output)
+            except subprocess.CalledProcessError as err:
+                raise PackageError(err.output.decode())
+            except OSError as err:
+                raise PackageError(str(err))
+
+
+def answer_question(question, *args):
+    """ Answers libalpm questions as pacman --noconfirm does in SubprocessBackend
+
+    Replacements, conflicts and key imports are accepted, the first
+    provider is selected.
+    """
+    return 0 if question == QUESTION_SELECT_PROVIDER else 1
+
+
+class AlpmBackend(PackageBackend):
+    """ Uses libalpm through pyalpm, the sync databases are loaded once """
+
+    def __init__(self, config=PACMAN_CONF):
+        from pycman import config as pycman_config
+        self.config = config
+        self.handle = pycman_config.init_with_config(config)
+        self.handle.questioncb = answer_question
+
+    def installed_packages(self):
+        return set(pkg.name for pkg in self.handle.get_localdb().pkgcache)
+
+    def target_versions(self, names):
+        versions = {}
+        for name in names:
+            try:
+                versions[name] = self.find_sync_package(name).version
+            except PackageError:
+                pass
+        return versions
+
+    def find_sync_package(self, name):
+        """ Returns first package called name in the sync databases """
+        for database in self.handle.get_syncdbs():
+            pkg = database.get_pkg(name)
+            if pkg is not None:
+                return pkg
+        raise PackageError("target not found: {}".format(name))
+
+    def transaction(self, remove, install, refresh=True, output=None):
+        import pyalpm
+
+        if output is not None:
+            self.handle.logcb = lambda level, line: output(line.rstrip("\n"))
+        trans = None
+        try:
+            if refresh:
+                with tracing.span("refresh databases"):
+                    for database in self.handle.get_syncdbs():
+                        database.update(False)
+            localdb = self.handle.get_localdb()
+            # Same as pacman -Rs --nodeps of SubprocessBackend
+            trans = self.handle.init_transaction(nodeps=True, recurse=True)
+            for name in remove:
+                pkg = localdb.get_pkg(name)
+                if pkg is not None:
+                    trans.remove_pkg(pkg)
+            for name in install:
+                trans.add_pkg(self.find_sync_package(name))
+            with tracing.span("resolve transaction"):
+                trans.prepare()
+            with tracing.span("remove conflicts and install packages"):
+                trans.commit()
+        except pyalpm.error as err:
+            raise PackageError(str(err))
+        finally:
+            if trans is not None:
+                trans.release()
+            if output is not None:
+                self.handle.logcb = lambda level, line: None
+
+
+class FakeBackend(PackageBackend):
+    """ Keeps installed packages in memory, records every transaction """
+
+    def __init__(self, installed=(), available=None):
+        self.installed = set(installed)
+        self.available = None if available is None else set(available)
+        self.transactions = []
+
+    def installed_packages(self):
+        return set(self.installed)
+
+    def transaction(self, remove, install, refresh=True, output=None):
+        if self.available is not None:
+            missing = [name for name in install if name not in self.available]
+            if missing:
+                raise PackageError("target not found: {}".format(", ".join(missing)))
+        self.transactions.append((list(remove), list(install)))
+        self.installed.difference_update(remove)
+        self.installed.update(install)
+
+
+def default_backend(config=PACMAN_CONF, root="/"):
+    """ Returns AlpmBackend when pyalpm is installed, SubprocessBackend otherwise
+
+    Other roots than / always get SubprocessBackend, pacman --sysroot
+    runs in the image with its own config, keys and hooks.
+    """
+    if root != "/":
+        return SubprocessBackend(config, root)
+    try:
+        return AlpmBackend(config)
+    except ImportError:
+        return SubprocessBackend(config)
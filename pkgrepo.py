@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  pkgrepo module
+#
+#  Copyright © 2019 Favourix <vladimir.kokes@favourix.com
+#  This file is part of fx-drivers (Favourix OS Driver manager).
+#
+#  Favourix is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Favourix is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
+
+""" Local repository of driver packages
+
+prefetch() downloads the sync databases of a mirror, resolves the
+dependency closure of the packages of every driver rule, downloads the
+packages and writes them with a repository database of their own.
+
+A driver switch then installs from that repository: its database is
+copied to the pacman sync directory and pacman runs with a config
+listing it first, without refreshing the databases or touching the
+network. Mirrors are pacman Server URLs with $repo and $arch, file://
+URLs included.
+
+The repository is skipped, and the switch installs from the network,
+when a package it needs was not found on the mirror, when the sync
+databases of the system offer other versions than it has or when the
+installed kernels changed since the prefetch.
+"""
+
+import concurrent.futures
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tarfile
+import time
+import localdb
+import rules
+
+LOCAL_REPO = "/var/cache/fx-drivers/repo"
+
+REPO_NAME = "fx-drivers"
+
+# Repositories driver packages come from
+SYNC_REPOS = ("core", "extra", "multilib")
+
+# Kernels modules of driver packages are built for
+KERNEL_PACKAGES = ("linux", "linux-lts", "linux-zen", "linux-hardened")
+
+PACMAN_CONF = "/etc/pacman.conf"
+MIRRORLIST = "/etc/pacman.d/mirrorlist"
+DB_PATH = "/var/lib/pacman/"
+
+# Packages downloaded at the same time
+DOWNLOAD_JOBS = 4
+
+# Lists packages and provides of the local repository, see LocalRepo
+MANIFEST = "repo.json"
+
+# Repository section name in pacman.conf
+SECTION = re.compile(r"^\s*\[([^\]]+)\]")
+
+# Server = line of pacman.conf or mirrorlist
+SERVER = re.compile(r"^\s*Server\s*=\s*(\S+)")
+
+
+class RepoError(Exception):
+    """ Mirror cannot be read or packages are missing """
+    pass
+
+
+class SyncPackage(object):
+    """ Package of a sync database with its desc file """
+
+    __slots__ = ("repo", "name", "version", "filename", "sha256", "depends", "provides", "desc")
+
+    def __init__(self, repo, desc):
+        sections = localdb.parse_sections(desc.splitlines(), None)
+        self.repo = repo
+        self.name = sections["%NAME%"][0]
+        self.version = sections["%VERSION%"][0]
+        self.filename = sections["%FILENAME%"][0]
+        self.sha256 = sections.get("%SHA256SUM%", [None])[0]
+        self.depends = [localdb.strip_version(item) for item in sections.get("%DEPENDS%", [])]
+        self.provides = [localdb.strip_version(item) for item in sections.get("%PROVIDES%", [])]
+        self.desc = desc
+
+
+def server_url(server, repo, arch):
+    """ Expands $repo and $arch of a Server URL """
+    return server.replace("$repo", repo).replace("$arch", arch).rstrip("/")
+
+
+def read_mirrors(path=MIRRORLIST):
+    """ Returns Server URLs of a mirrorlist in order """
+    try:
+        with open(path) as mirrorlist:
+            return [match.group(1) for match in map(SERVER.match, mirrorlist) if match]
+    except OSError:
+        return []
+
+
+def fetch(url):
+    """ Returns content of url """
+    # urllib.request alone doubles the import time of the driver switch
+    import urllib.request
+    try:
+        with urllib.request.urlopen(url) as response:
+            return response.read()
+    except (OSError, ValueError) as err:
+        raise RepoError("Cannot download {0}: {1}".format(url, err))
+
+
+def parse_sync_db(repo, data):
+    """ Returns packages of a repository database tarball """
+    packages = []
+    try:
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r:*") as archive:
+            for member in archive:
+                if member.isfile() and member.name.endswith("/desc"):
+                    desc = archive.extractfile(member).read().decode("utf-8", "replace")
+                    packages.append(SyncPackage(repo, desc))
+    except (tarfile.TarError, KeyError, IndexError) as err:
+        raise RepoError("Cannot read {0} database: {1}".format(repo, err))
+    return packages
+
+
+def load_sync_dbs(server, repos=SYNC_REPOS, arch=None):
+    """ Downloads sync databases, returns {name: package} with the first repository winning """
+    arch = arch or os.uname().machine
+    packages = {}
+    for repo in repos:
+        url = server_url(server, repo, arch)
+        for package in parse_sync_db(repo, fetch("{0}/{1}.db".format(url, repo))):
+            packages.setdefault(package.name, package)
+    return packages
+
+
+def driver_packages(arch=None):
+    """ Returns names of packages of every driver rule """
+    arch = arch or os.uname().machine
+    names = set()
+    for rule in rules.RULES:
+        names.update(rule.get("packages", ()))
+        names.update(rule.get("packages_lts", ()))
+        if arch == "x86_64":
+            names.update(rule.get("packages_x86_64", ()))
+    return names
+
+
+def resolve_closure(names, packages):
+    """ Returns ({name: package} needed to install names with dependencies, [missing name]) """
+    providers = {}
+    for package in packages.values():
+        for item in package.provides:
+            providers.setdefault(item, package)
+
+    closure = {}
+    missing = []
+    pending = sorted(names)
+    while pending:
+        name = pending.pop()
+        package = packages.get(name) or providers.get(name)
+        if package is None:
+            missing.append(name)
+            continue
+        if package.name in closure:
+            continue
+        closure[package.name] = package
+        pending.extend(package.depends)
+    return closure, sorted(set(missing))
+
+
+def file_sha256(path):
+    """ Returns hex SHA-256 of file, None if it does not exist """
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as package_file:
+            for block in iter(lambda: package_file.read(1 << 20), b""):
+                digest.update(block)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+def download_package(server, package, arch, repo_dir):
+    """ Downloads package and its signature into repo_dir, returns False if it was there """
+    path = os.path.join(repo_dir, package.filename)
+    if package.sha256 is not None and file_sha256(path) == package.sha256:
+        return False
+    url = "{0}/{1}".format(server_url(server, package.repo, arch), package.filename)
+    data = fetch(url)
+    if package.sha256 is not None and hashlib.sha256(data).hexdigest() != package.sha256:
+        raise RepoError("Checksum of {} does not match".format(url))
+    write_bytes(path, data)
+    try:
+        write_bytes(path + ".sig", fetch(url + ".sig"))
+    except RepoError:
+        # Unsigned mirror, pacman checks the database checksum only
+        pass
+    return True
+
+
+def write_bytes(path, data):
+    """ Writes file through a temporary file and rename """
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as tmp_file:
+        tmp_file.write(data)
+    os.replace(tmp_path, path)
+
+
+def build_repo_db(packages, path):
+    """ Writes repository database of packages, as repo-add does """
+    data = io.BytesIO()
+    mtime = int(time.time())
+    with tarfile.open(fileobj=data, mode="w:gz") as archive:
+        for package in sorted(packages, key=lambda package: package.name):
+            directory = "{0}-{1}".format(package.name, package.version)
+            info = tarfile.TarInfo(directory)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            info.mtime = mtime
+            archive.addfile(info)
+            desc = package.desc.encode("utf-8")
+            info = tarfile.TarInfo(directory + "/desc")
+            info.size = len(desc)
+            info.mode = 0o644
+            info.mtime = mtime
+            archive.addfile(info, io.BytesIO(desc))
+    write_bytes(path, data.getvalue())
+
+
+def sync_versions(names, db_path=DB_PATH, repos=SYNC_REPOS):
+    """ Returns {name: version} of names in the sync databases on disk, the first repository winning
+
+    Versions come from the directory names of the database tarballs, no
+    desc file is read.
+    """
+    names = set(names)
+    versions = {}
+    for repo in repos:
+        try:
+            with tarfile.open(os.path.join(db_path, "sync", repo + ".db"), mode="r:*") as archive:
+                for member in archive:
+                    if not member.isdir():
+                        continue
+                    parts = member.name.rstrip("/").rsplit("-", 2)
+                    if len(parts) == 3 and parts[0] in names:
+                        versions.setdefault(parts[0], parts[1] + "-" + parts[2])
+        except (OSError, tarfile.TarError):
+            continue
+    return versions
+
+
+def prefetch(server, repo_dir=LOCAL_REPO, repos=SYNC_REPOS, arch=None, names=None, log=None,
+             local_db=localdb.LOCAL_DB_PATH):
+    """ Builds local repository of driver packages, returns LocalRepo
+
+    names defaults to the packages of all driver rules. log is called with
+    a message for every downloaded package and every package not found,
+    drivers needing those keep installing from the network.
+    """
+    arch = arch or os.uname().machine
+    packages = load_sync_dbs(server, repos, arch)
+    closure, missing = resolve_closure(driver_packages(arch) if names is None else names, packages)
+    if missing and log is not None:
+        log("Not found in {0}: {1}".format(", ".join(repos), " ".join(missing)))
+    os.makedirs(repo_dir, exist_ok=True)
+
+    def download(package):
+        if download_package(server, package, arch, repo_dir) and log is not None:
+            log("Downloaded {}".format(package.filename))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=DOWNLOAD_JOBS) as executor:
+        # list() raises the first download error
+        list(executor.map(download, closure.values()))
+
+    build_repo_db(closure.values(), os.path.join(repo_dir, REPO_NAME + ".db"))
+    repo = LocalRepo(repo_dir, arch,
+                     dict((name, package.filename) for name, package in closure.items()),
+                     dict((name, package.provides) for name, package in closure.items() if package.provides),
+                     dict((name, package.version) for name, package in closure.items()),
+                     dict((name, package.depends) for name, package in closure.items() if package.depends),
+                     missing, localdb.installed_versions(KERNEL_PACKAGES, local_db))
+    repo.save()
+    repo.prune()
+    return repo
+
+
+def add_repo_section(config, repo_dir):
+    """ Returns pacman.conf text with the local repository before all others """
+    section = "[{0}]\nSigLevel = Optional TrustedOnly\nServer = file://{1}\n\n".format(
+        REPO_NAME, os.path.abspath(repo_dir))
+    lines = config.splitlines(True)
+    for index, line in enumerate(lines):
+        match = SECTION.match(line)
+        if match and match.group(1) not in ("options", REPO_NAME):
+            return "".join(lines[:index]) + section + "".join(lines[index:])
+    return config + "\n" + section
+
+
+def pacman_option(config, name, default):
+    """ Returns value of an [options] setting of pacman.conf text """
+    pattern = re.compile(r"^\s*{}\s*=\s*(\S+)".format(name))
+    for line in config.splitlines():
+        match = pattern.match(line)
+        if match:
+            return match.group(1)
+    return default
+
+
+class LocalRepo(object):
+    """ Prefetched repository, see prefetch() """
+
+    __slots__ = ("path", "arch", "files", "provides", "versions", "depends", "missing", "kernels")
+
+    def __init__(self, path, arch, files, provides, versions, depends, missing, kernels):
+        self.path = path
+        self.arch = arch
+        self.files = files
+        self.provides = provides
+        self.versions = versions
+        self.depends = depends
+        self.missing = missing
+        self.kernels = kernels
+
+    def closure(self, names):
+        """ Returns (packages of the repository needed by names, [names it lacks]) """
+        providers = {}
+        for name, items in self.provides.items():
+            for item in items:
+                providers.setdefault(item, name)
+        needed = set()
+        lacking = []
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            package = name if name in self.files else providers.get(name)
+            if package is None:
+                lacking.append(name)
+            elif package not in needed:
+                needed.add(package)
+                pending.extend(self.depends.get(package, ()))
+        return needed, lacking
+
+    def covers(self, names):
+        """ Checks that names and all their dependencies are in the repository
+
+        A dependency prefetch did not find on the mirror is among missing.
+        """
+        return not self.closure(names)[1]
+
+    def is_current(self, names, db_path=DB_PATH, local_db=localdb.LOCAL_DB_PATH):
+        """ Checks that the sync databases and the installed kernels are those of the prefetch """
+        if localdb.installed_versions(KERNEL_PACKAGES, local_db) != self.kernels:
+            return False
+        needed, _ = self.closure(names)
+        versions = sync_versions(needed, db_path)
+        return all(versions.get(name, self.versions.get(name)) == self.versions.get(name) for name in needed)
+
+    def to_dict(self):
+        """ Returns repository as json serializable dictionary """
+        return {"arch": self.arch, "files": self.files, "provides": self.provides,
+                "versions": self.versions, "depends": self.depends,
+                "missing": self.missing, "kernels": self.kernels}
+
+    def save(self):
+        """ Writes manifest of the repository """
+        write_bytes(os.path.join(self.path, MANIFEST), json.dumps(self.to_dict()).encode())
+
+    @classmethod
+    def load(cls, path=LOCAL_REPO):
+        """ Returns repository prefetched to path, None if there is none """
+        try:
+            with open(os.path.join(path, MANIFEST)) as manifest:
+                data = json.load(manifest)
+            if data["arch"] != os.uname().machine:
+                return None
+            return cls(path, data["arch"], data["files"], data["provides"], data["versions"],
+                       data["depends"], data["missing"], data["kernels"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def prune(self):
+        """ Removes packages no longer in the repository """
+        keep = set(self.files.values())
+        keep.update(name + ".sig" for name in list(keep))
+        for entry in os.listdir(self.path):
+            if entry not in keep and ".pkg.tar" in entry:
+                os.remove(os.path.join(self.path, entry))
+
+    def activate(self, pacman_conf=PACMAN_CONF):
+        """ Installs repository database without a refresh, returns pacman config using it """
+        with open(pacman_conf) as config_file:
+            config = config_file.read()
+        sync_path = os.path.join(pacman_option(config, "DBPath", DB_PATH), "sync")
+        os.makedirs(sync_path, exist_ok=True)
+        tmp_path = os.path.join(sync_path, REPO_NAME + ".db.tmp")
+        shutil.copyfile(os.path.join(self.path, REPO_NAME + ".db"), tmp_path)
+        os.replace(tmp_path, os.path.join(sync_path, REPO_NAME + ".db"))
+        path = os.path.join(self.path, "pacman.conf")
+        write_bytes(path, add_repo_section(config, self.path).encode())
+        return path
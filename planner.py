@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  planner module
+#
+#  Copyright © 2019 Favourix <vladimir.kokes@favourix.com
+#  This file is part of fx-drivers (Favourix OS Driver manager).
+#
+#  Favourix is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Favourix is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
+
+""" Driver switch planner and executor
+
+read_system_state() collects everything a driver switch depends on,
+make_plan() turns it into a Plan without touching the system and the
+execute_* functions apply a plan. States and plans are plain json, so
+plans for many hosts can be computed and compared offline.
+"""
+
+import glob
+import grp
+import hashlib
+import os
+import pwd
+import device
+import fstransaction
+import localdb
+import pkgbackend
+import rules
+import tracing
+
+
+class SystemState(object):
+    """ Inputs of a driver switch plan, read once from a host """
+
+    __slots__ = ("arch", "lts", "user", "packages", "mkinitcpio_modules", "presets")
+
+    def __init__(self, arch, lts, user, packages, mkinitcpio_modules, presets):
+        self.arch = arch
+        self.lts = lts
+        self.user = user
+        self.packages = packages
+        self.mkinitcpio_modules = tuple(mkinitcpio_modules)
+        self.presets = tuple(presets)
+
+    def to_dict(self):
+        """ Returns state as json serializable dictionary """
+        return {
+            "arch": self.arch,
+            "lts": self.lts,
+            "user": self.user,
+            "packages": self.packages.to_dict(),
+            "mkinitcpio_modules": list(self.mkinitcpio_modules),
+            "presets": list(self.presets)}
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Rebuilds state stored with to_dict() """
+        return cls(
+            data["arch"], data["lts"], data["user"],
+            localdb.LocalDatabase.from_dict(data["packages"]),
+            data["mkinitcpio_modules"], data["presets"])
+
+
+def read_system_state(local_db=None):
+    """ Reads state of the running system, local_db is read unless given """
+    try:
+        with open(device.root_path(device.MKINITCPIO_CONF)) as mkinitcpio_file:
+            modules = [line for line in mkinitcpio_file if line.startswith("MODULES")]
+    except OSError:
+        modules = []
+
+    presets = [preset for preset in device.find_presets()
+               if device.MKINITCPIO_CONF in device.preset_configs(preset)]
+
+    return SystemState(
+        os.uname()[-1],
+        os.path.exists(device.root_path(device.LTS_KERNEL)),
+        device.get_user(),
+        device.get_local_db() if local_db is None else local_db,
+        modules,
+        presets)
+
+
+class Plan(object):
+    """ Complete description of a driver switch """
+
+    __slots__ = ("driver", "remove", "install", "groups", "services",
+                 "write", "delete", "edits", "initramfs", "warnings")
+
+    def __init__(self, driver, remove=(), install=(), groups=(), services=None,
+                 write=None, delete=(), edits=(), initramfs=(), warnings=()):
+        self.driver = driver
+        # Packages removed and installed in one transaction
+        self.remove = list(remove)
+        self.install = list(install)
+        # (user, group) pairs
+        self.groups = [list(group) for group in groups]
+        # Service name to enabled, installed services only are changed
+        self.services = dict(services or {})
+        # Path to content of created files
+        self.write = dict(write or {})
+        self.delete = list(delete)
+        # (path, old text, new text), existing files only are changed
+        self.edits = [list(edit) for edit in edits]
+        # mkinitcpio presets to rebuild
+        self.initramfs = list(initramfs)
+        self.warnings = list(warnings)
+
+    def __eq__(self, other):
+        return isinstance(other, Plan) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def to_dict(self):
+        """ Returns plan as json serializable dictionary """
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Rebuilds plan stored with to_dict() """
+        return cls(**data)
+
+
+def strip_modules(line):
+    """ Removes nouveau and nvidia from a mkinitcpio.conf MODULES line """
+    line = line.replace("nouveau", "")
+    line = line.replace("nvidia", "")
+    line = line.replace(",,", ",")
+    line = line.replace('",', '"')
+    line = line.replace(',"', '"')
+    return line
+
+
+def make_plan(driver, state):
+    """ Computes driver switch plan, has no side effects """
+    rule = rules.get_rule(driver)
+    packages = list(rule.get("packages", ()))
+    conflicts = list(rule.get("conflicts", ()))
+
+    if state.arch == "x86_64":
+        packages.extend(rule.get("packages_x86_64", ()))
+        conflicts.extend(rule.get("conflicts_x86_64", ()))
+
+    if state.lts:
+        packages.extend(rule.get("packages_lts", ()))
+
+    # Drop duplicates, a libalpm transaction refuses them
+    packages = sorted(set(packages), key=packages.index)
+
+    # Conflicts are removed by name, also when installed under another
+    # package providing them
+    remove = sorted(state.packages.satisfiers(conflicts) - set(packages))
+
+    groups = []
+    warnings = []
+    if rule.get("groups"):
+        if state.user != "root":
+            groups = [(state.user, group) for group in rule["groups"]]
+        else:
+            warnings.append(
+                "NOT adding user 'root' to {} groups! "
+                "Remember to add your users to those groups".format(" or ".join(rule["groups"])))
+
+    edits = []
+    if driver == "bumblebee":
+        edits.append((device.NVIDIA_SETTINGS_DESKTOP, device.NVIDIA_SETTINGS_EXEC, device.OPTIRUN_EXEC))
+    elif rule["vendor"] == rules.NVIDIA:
+        edits.append((device.NVIDIA_SETTINGS_DESKTOP, device.OPTIRUN_EXEC, device.NVIDIA_SETTINGS_EXEC))
+
+    # Files and services of the drivers replaced are removed and disabled
+    write = dict(rule.get("files", {}))
+    delete = []
+    services = {}
+    for other in rules.VENDOR_RULES[driver]:
+        for path in other.get("files", ()):
+            if path not in write and path not in delete:
+                delete.append(path)
+        for service in other.get("services", ()):
+            services[service] = service in rule.get("services", ())
+
+    # Remove nouveau and nvidia from MODULES line (just in case)
+    initramfs = []
+    for line in state.mkinitcpio_modules:
+        if "nouveau" in line or "nvidia" in line:
+            edits.append((device.MKINITCPIO_CONF, line, strip_modules(line)))
+            initramfs = state.presets
+
+    return Plan(
+        driver, remove, packages, groups, services,
+        write, delete, edits, initramfs, warnings)
+
+
+def diff_plans(old, new):
+    """ Returns {field: (old value, new value)} of fields that differ """
+    old = old.to_dict() if old is not None else {}
+    new = new.to_dict()
+    return dict((name, (old.get(name), new[name]))
+                for name in Plan.__slots__ if old.get(name) != new[name])
+
+
+def file_matches(path, content):
+    """ Checks that file exists with content, comparing SHA-256 digests """
+    try:
+        with open(device.root_path(path), "rb") as current:
+            digest = hashlib.sha256(current.read()).digest()
+    except OSError:
+        return False
+    return digest == hashlib.sha256(content.encode()).digest()
+
+
+def file_contains(path, text):
+    """ Checks that file exists and contains text """
+    try:
+        with open(device.root_path(path)) as current:
+            return text in current.read()
+    except OSError:
+        return False
+
+
+def service_enabled(service):
+    """ Checks for a symlink to service in a .wants directory, like systemctl is-enabled """
+    return any(os.path.lexists(os.path.join(path, service))
+               for path in glob.glob(os.path.join(device.root_path(device.SYSTEMD_CONFIG_PATH), "*.wants")))
+
+
+def user_in_group(user, group):
+    """ Checks that user is a member of group """
+    try:
+        entry = grp.getgrnam(group)
+    except KeyError:
+        return False
+    if user in entry.gr_mem:
+        return True
+    try:
+        return pwd.getpwnam(user).pw_gid == entry.gr_gid
+    except KeyError:
+        return False
+
+
+def pending_plan(plan, state):
+    """ Returns (plan of the actions this system still needs, report)
+
+    The report lists (action, applied) for every action of plan, applied
+    is False for actions skipped because the system already matches.
+    """
+    report = []
+
+    def check(action, needed):
+        report.append((action, needed))
+        return needed
+
+    remove = [name for name in plan.remove if check("remove package " + name, name in state.packages)]
+    install = [name for name in plan.install if check("install " + name, name not in state.packages)]
+    groups = [(user, group) for user, group in plan.groups
+              if check("gpasswd -a {0} {1}".format(user, group), not user_in_group(user, group))]
+
+    services = {}
+    for service, enable in sorted(plan.services.items()):
+        action = "systemctl {0} {1}".format("enable" if enable else "disable", service)
+        if check(action, device.service_installed(service) and service_enabled(service) != enable):
+            services[service] = enable
+
+    edits = [(path, old, new) for path, old, new in plan.edits
+             if check("edit {0}: {1}".format(path, new.strip("\n")), file_contains(path, old))]
+    write = dict((path, content) for path, content in sorted(plan.write.items())
+                 if check("create " + path, not file_matches(path, content)))
+    delete = [path for path in plan.delete
+              if check("remove " + path, os.path.lexists(device.root_path(path)))]
+
+    # Images are rebuilt only with the MODULES line they are built from
+    modules_edited = any(path == device.MKINITCPIO_CONF for path, _, _ in edits)
+    initramfs = [preset for preset in plan.initramfs if check("mkinitcpio -p " + preset, modules_edited)]
+
+    pending = Plan(
+        plan.driver, remove, install, groups, services,
+        write, delete, edits, initramfs, plan.warnings)
+    return pending, report
+
+
+def describe_packages(plan):
+    """ Returns commands equivalent to package part of the plan """
+    cmds = pkgbackend.pacman_commands(plan.remove, plan.install, root=device.ROOT)
+    return [" ".join(cmd) for cmd in cmds]
+
+
+def describe_configuration(plan):
+    """ Returns human readable configuration changes """
+    lines = []
+    for user, group in plan.groups:
+        lines.append("gpasswd -a {0} {1}".format(user, group))
+    for service, enable in sorted(plan.services.items()):
+        # Like execute_configuration, units that are not installed are left alone
+        if device.service_installed(service):
+            lines.append("systemctl {0} {1}".format("enable" if enable else "disable", service))
+    for path, old, new in plan.edits:
+        lines.append("{0}: {1} -> {2}".format(path, old.strip("\n"), new.strip("\n")))
+    for path in sorted(plan.write):
+        lines.append("create {}".format(path))
+    for path in plan.delete:
+        lines.append("remove {}".format(path))
+    return lines
+
+
+def describe_initramfs(plan):
+    """ Returns mkinitcpio commands of the plan """
+    prefix = [] if device.ROOT == "/" else [device.CHROOT, device.ROOT]
+    return [" ".join(prefix + [device.MKINITCPIO, "-p", preset]) for preset in plan.initramfs]
+
+
+def describe(plan):
+    """ Returns every action of the plan, one line each """
+    return describe_packages(plan) + describe_configuration(plan) + describe_initramfs(plan)
+
+
+def execute_packages(plan, TEST):
+    """ Runs package transaction of the plan """
+    with tracing.span("packages", remove=len(plan.remove), install=len(plan.install)):
+        if TEST:
+            for line in describe_packages(plan):
+                device.log_info(line)
+            return True
+        return device.change_packages(plan.remove, plan.install)
+
+
+def execute_configuration(plan, TEST):
+    """ Applies groups, services and file changes of the plan """
+    with tracing.span("post-install"):
+        for warning in plan.warnings:
+            device.log_warning(warning)
+
+        if TEST:
+            for line in describe_configuration(plan):
+                device.log_info(line)
+            return True
+
+        # Files change all at once, a failure leaves the old configuration
+        transaction = fstransaction.FileTransaction(device.ROOT)
+        for path, old, new in plan.edits:
+            device.edit_file(transaction, path, old, new)
+        for path in sorted(plan.write):
+            device.write_file(transaction, path, plan.write[path])
+        for path in plan.delete:
+            device.remove_file(transaction, path)
+        try:
+            transaction.commit()
+        except fstransaction.TransactionError as err:
+            if isinstance(err.__cause__, PermissionError):
+                device.log_error("This script must be run with administrative privileges!")
+            else:
+                device.log_error("Cannot configure {0} driver: {1}", plan.driver, err)
+            return False
+
+        for user, group in plan.groups:
+            device.add_user_to_group(user, group)
+        for service, enable in sorted(plan.services.items()):
+            device.enable_service(service, enable)
+        return True
+
+
+def execute_initramfs(plan, TEST):
+    """ Rebuilds initramfs images listed in the plan """
+    with tracing.span("initramfs", presets=len(plan.initramfs)):
+        if TEST:
+            for line in describe_initramfs(plan):
+                device.log_info(line)
+            return True
+        return device.rebuild_initramfs(plan.initramfs)
+
+
+def plan_steps(plan, TEST, skip_empty=False):
+    """ Returns (description, function) of every step executing the plan
+
+    A step returning False failed and the following steps must not run.
+    With skip_empty, steps the plan has nothing for are left out.
+    """
+    steps = [
+        ("Installing driver packages", plan.remove or plan.install,
+         lambda: execute_packages(plan, TEST)),
+        ("Configuring system", plan.groups or plan.services or plan.edits or plan.write or plan.delete,
+         lambda: execute_configuration(plan, TEST)),
+        ("Rebuilding initramfs", plan.initramfs,
+         lambda: execute_initramfs(plan, TEST))]
+    return [(description, step) for description, work, step in steps if work or not skip_empty]
+
+
+def execute_plan(plan, TEST):
+    """ Executes all steps of the plan, returns False if one failed """
+    for _, step in plan_steps(plan, TEST):
+        if step() is False:
+            return False
+    return True
+
+
+def driver_change_steps(driver, TEST):
+    """ Plans a switch to driver on this system, returns its steps """
+    with tracing.span("planning", driver=driver):
+        return plan_steps(make_plan(driver, read_system_state()), TEST)
+
+
+def reconcile_steps(driver, TEST):
+    """ Returns (steps, report) bringing this system to driver, only what differs
+
+    See pending_plan() for the report.
+    """
+    with tracing.span("planning", driver=driver):
+        state = read_system_state()
+        plan, report = pending_plan(make_plan(driver, state), state)
+        return plan_steps(plan, TEST, skip_empty=True), report
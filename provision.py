@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  provision module
+#
+#  Copyright © 2019 Favourix <vladimir.kokes@favourix.com
+#  This file is part of fx-drivers (Favourix OS Driver manager).
+#
+#  Favourix is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Favourix is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
+
+""" Driver installation into many OS image roots
+
+Every image is handled by its own drvmanager --root process, the
+planner and backends keep per-process state. At most jobs processes run
+at the same time. Each image gets a log directory with the json
+installer.log of its run and output.log with everything it printed.
+"""
+
+import collections
+import concurrent.futures
+import hashlib
+import os
+import subprocess
+import sys
+import time
+
+CLI_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cli.py")
+
+# Images provisioned at the same time
+JOBS = os.cpu_count() or 1
+
+Target = collections.namedtuple("Target", ["root", "driver"])
+Target.__doc__ = """ Image root directory and driver installed into it """
+
+Result = collections.namedtuple("Result", ["target", "returncode", "seconds", "log_dir"])
+Result.__doc__ = """ Finished provisioning of one image """
+
+
+def parse_target(text):
+    """ Parses IMAGE=DRIVER into Target """
+    root, sep, driver = text.rpartition("=")
+    if not sep or not root or not driver:
+        raise ValueError("expected IMAGE=DRIVER, got {}".format(text))
+    return Target(os.path.abspath(root), driver)
+
+
+def read_manifest(path):
+    """ Returns targets of a manifest file, one IMAGE=DRIVER per line """
+    targets = []
+    with open(path) as manifest:
+        for line in manifest:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                targets.append(parse_target(line))
+    return targets
+
+
+def log_dir_name(target):
+    """ Returns log directory name of an image, unique for distinct roots
+
+    The readable part alone is ambiguous, /a/b_c and /a_b/c both give
+    a_b_c, a hash of the root tells them apart.
+    """
+    digest = hashlib.sha256(target.root.encode()).hexdigest()[:8]
+    return "{0}-{1}".format(target.root.strip("/").replace("/", "_") or "root", digest)
+
+
+def command(target, test=False, reconcile=False):
+    """ Returns drvmanager command line provisioning one image """
+    cmd = [sys.executable, CLI_SCRIPT, "--root", target.root,
+           "reconcile" if reconcile else "install", target.driver]
+    if test:
+        cmd.append("--test")
+    return cmd
+
+
+def run_target(target, log_root, test=False, reconcile=False):
+    """ Provisions one image, returns Result """
+    log_dir = os.path.join(log_root, log_dir_name(target))
+    os.makedirs(log_dir, exist_ok=True)
+    start = time.monotonic()
+    # installer.log is written to the working directory
+    with open(os.path.join(log_dir, "output.log"), "w") as output:
+        try:
+            returncode = subprocess.call(
+                command(target, test, reconcile), cwd=log_dir,
+                stdin=subprocess.DEVNULL, stdout=output, stderr=subprocess.STDOUT)
+        except OSError as err:
+            output.write("Cannot run drvmanager: {}\n".format(err))
+            returncode = 1
+    return Result(target, returncode, time.monotonic() - start, log_dir)
+
+
+def provision(targets, log_root, jobs=None, test=False, reconcile=False):
+    """ Provisions all targets, at most jobs at once, yields Results as they finish """
+    roots = [target.root for target in targets]
+    if len(set(roots)) != len(roots):
+        raise ValueError("every image may be listed once")
+    jobs = max(1, min(jobs or JOBS, len(targets) or 1))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(run_target, target, log_root, test, reconcile) for target in targets]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  rules module
+#
+#  Copyright © 2019 Favourix <vladimir.kokes@favourix.com
+#  This file is part of fx-drivers (Favourix OS Driver manager).
+#
+#  Favourix is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Favourix is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
+
+""" Driver rule table
+
+Every rule describes one driver: the devices it is offered for and what
+installing it means. Devices are matched by PCI base class and vendor
+plus one of
+    ids         names of pci/*.ids files listing the device ids
+    devices     device ids listed inline
+    any_device  every device of that class and vendor
+Rules without any of them are never detected, only installed on request.
+Rules are listed in order of preference.
+
+Installation is described by packages, packages_x86_64, packages_lts,
+conflicts, conflicts_x86_64, files written (path: content), services
+enabled and groups the user is added to. Files and services of the other
+rules of the same vendor are removed and disabled.
+
+RuleTable compiles the rules into one dictionary keyed on (class, vendor),
+so detection costs one dictionary lookup per PCI device however many
+vendors are listed.
+"""
+
+DISPLAY_CLASS = 0x03
+NETWORK_CLASS = 0x02
+
+NVIDIA = 0x10de
+AMD = 0x1002
+INTEL = 0x8086
+VIRTUALBOX = 0x80ee
+BROADCOM = 0x14e4
+
+NVIDIA_CONF = "/etc/X11/xorg.conf.d/20-nvidia.conf"
+
+NVIDIA_CONF_CONTENT = (
+    'Section "Device"\n'
+    '    Identifier "Nvidia Card"\n'
+    '    Driver "nvidia"\n'
+    '    VendorName "NVIDIA Corporation"\n'
+    '    Option "NoLogo" "true"\n'
+    'EndSection\n')
+
+# Southern Islands and Sea Islands GPUs default to radeon
+AMDGPU_CONF = "/etc/modprobe.d/amdgpu.conf"
+
+AMDGPU_CONF_CONTENT = (
+    "options amdgpu si_support=1 cik_support=1\n"
+    "options radeon si_support=0 cik_support=0\n")
+
+NVIDIA_CONFLICTS = [
+    "nvidia-dkms", "nvidia-utils",
+    "nvidia-390xx", "nvidia-390xx-dkms", "nvidia-390xx-utils",
+    "nvidia-340xx", "nvidia-340xx-dkms", "nvidia-340xx-utils",
+    "nvidia-304xx", "nvidia-304xx-lts", "nvidia-304xx-utils",
+    "bumblebee", "virtualgl", "nvidia-settings", "bbswitch", "bbswitch-dkms"]
+
+RULES = (
+    {"driver": "nvidia",
+     "class": DISPLAY_CLASS, "vendor": NVIDIA, "ids": ["nvidia"],
+     "packages": ["nvidia-dkms", "libvdpau"],
+     "packages_x86_64": ["lib32-nvidia-utils", "lib32-libvdpau"],
+     "packages_lts": ["nvidia-dkms"],
+     "conflicts": ["xf86-video-nouveau"],
+     "conflicts_x86_64": ["lib32-nvidia-340xx-utils", "lib32-nvidia-304xx-utils"],
+     "files": {NVIDIA_CONF: NVIDIA_CONF_CONTENT}},
+
+    {"driver": "nvidia-390xx",
+     "class": DISPLAY_CLASS, "vendor": NVIDIA, "ids": ["nvidia-390xx"],
+     "packages": ["nvidia-390xx-dkms", "libvdpau"],
+     "packages_x86_64": ["lib32-nvidia-390xx-utils", "lib32-libvdpau"],
+     "packages_lts": ["nvidia-390xx-dkms"],
+     "conflicts": ["xf86-video-nouveau"],
+     "conflicts_x86_64": ["lib32-nvidia-utils", "lib32-nvidia-390xx-utils"],
+     "files": {NVIDIA_CONF: NVIDIA_CONF_CONTENT}},
+
+    {"driver": "nvidia-340xx",
+     "class": DISPLAY_CLASS, "vendor": NVIDIA, "ids": ["nvidia-340xx"],
+     "packages": ["nvidia-340xx-dkms", "libvdpau"],
+     "packages_x86_64": ["lib32-nvidia-340xx-utils", "lib32-libvdpau"],
+     "packages_lts": ["nvidia-340xx-dkms"],
+     "conflicts": ["xf86-video-nouveau"],
+     "conflicts_x86_64": ["lib32-nvidia-utils", "lib32-nvidia-340xx-utils"],
+     "files": {NVIDIA_CONF: NVIDIA_CONF_CONTENT}},
+
+    {"driver": "amdgpu",
+     "class": DISPLAY_CLASS, "vendor": AMD, "ids": ["amdgpu"],
+     "packages": ["xf86-video-amdgpu", "mesa", "vulkan-radeon"],
+     "packages_x86_64": ["lib32-mesa", "lib32-vulkan-radeon"]},
+
+    {"driver": "amdgpu-experimental",
+     "class": DISPLAY_CLASS, "vendor": AMD, "ids": ["amdgpu_exp"],
+     "packages": ["xf86-video-amdgpu", "mesa", "vulkan-radeon"],
+     "packages_x86_64": ["lib32-mesa", "lib32-vulkan-radeon"],
+     "files": {AMDGPU_CONF: AMDGPU_CONF_CONTENT}},
+
+    # Catalyst is no longer packaged, catalyst.ids devices get ati
+    {"driver": "ati",
+     "class": DISPLAY_CLASS, "vendor": AMD, "ids": ["ati", "catalyst", "amdgpu_exp"],
+     "packages": ["xf86-video-ati", "mesa"],
+     "packages_x86_64": ["lib32-mesa"]},
+
+    {"driver": "intel",
+     "class": DISPLAY_CLASS, "vendor": INTEL, "any_device": True,
+     "packages": ["mesa", "vulkan-intel"],
+     "packages_x86_64": ["lib32-mesa", "lib32-vulkan-intel"]},
+
+    {"driver": "virtualbox",
+     "class": DISPLAY_CLASS, "vendor": VIRTUALBOX, "any_device": True,
+     "packages": ["virtualbox-guest-utils"],
+     "conflicts": ["virtualbox-guest-utils-nox"],
+     "services": ["vboxservice.service"]},
+
+    # Wireless chips supported by the proprietary wl driver
+    {"driver": "broadcom-wl",
+     "class": NETWORK_CLASS, "vendor": BROADCOM,
+     "devices": [0x4311, 0x4312, 0x4313, 0x4315, 0x4328, 0x4329, 0x432a, 0x432b,
+                 0x432c, 0x432d, 0x4331, 0x4353, 0x4357, 0x4358, 0x4359, 0x4360,
+                 0x4365, 0x43a0, 0x43b1],
+     "packages": ["broadcom-wl-dkms"],
+     "conflicts": ["broadcom-wl"]},
+
+    {"driver": "nouveau",
+     "class": DISPLAY_CLASS, "vendor": NVIDIA,
+     "packages": ["xf86-video-nouveau", "mesa"],
+     "packages_x86_64": ["lib32-mesa"],
+     "conflicts": NVIDIA_CONFLICTS,
+     "conflicts_x86_64": ["lib32-nvidia-340xx-utils", "lib32-nvidia-304xx-utils",
+                          "lib32-nvidia-utils", "lib32-virtualgl"]},
+
+    {"driver": "bumblebee",
+     "class": DISPLAY_CLASS, "vendor": NVIDIA,
+     "packages": ["bumblebee", "mesa", "xf86-video-intel",
+                  "nvidia-dkms", "virtualgl", "nvidia-settings", "bbswitch-dkms"],
+     "packages_x86_64": ["lib32-nvidia-utils", "lib32-virtualgl", "lib32-mesa"],
+     "packages_lts": ["nvidia-dkms", "bbswitch-dkms"],
+     "conflicts": ["xf86-video-nouveau",
+                   "nvidia-390xx-utils", "nvidia-340xx-utils", "nvidia-304xx-utils"],
+     "conflicts_x86_64": ["lib32-nvidia-390xx-utils",
+                          "lib32-nvidia-340xx-utils", "lib32-nvidia-304xx-utils"],
+     "services": ["bumblebeed.service"],
+     "groups": ["bumblebee", "video"]},
+)
+
+DRIVERS = tuple(rule["driver"] for rule in RULES)
+
+RULES_BY_DRIVER = dict((rule["driver"], rule) for rule in RULES)
+
+# Rules sharing the vendor of each driver, itself included
+VENDOR_RULES = dict(
+    (rule["driver"], [other for other in RULES if other["vendor"] == rule["vendor"]])
+    for rule in RULES)
+
+
+def get_rule(driver):
+    """ Returns rule of driver, raises KeyError for unknown drivers """
+    return RULES_BY_DRIVER[driver]
+
+
+def is_detected(rule):
+    """ Tells whether a rule is offered for detected devices """
+    return "ids" in rule or "devices" in rule or rule.get("any_device", False)
+
+
+DETECTED_DRIVERS = tuple(rule["driver"] for rule in RULES if is_detected(rule))
+
+
+class RuleTable(object):
+    """ Rules compiled against a pci ids index
+
+    A match is a bitmask with bit n set for rule n of the table's rules.
+    display_mask has the bits of the graphics driver rules, drivers
+    offered for GPUs are those of a match masked with it.
+    """
+
+    __slots__ = ("index", "dispatch", "driver_names", "display_mask")
+
+    def __init__(self, index, rules=RULES):
+        dispatch = {}
+        for number, rule in enumerate(rules):
+            if not is_detected(rule):
+                continue
+            bit = 1 << number
+            any_mask, ids_bits, devices = dispatch.get((rule["class"], rule["vendor"]), (0, [], {}))
+            if "ids" in rule:
+                for name in rule["ids"]:
+                    index_bit = index.bit(name)
+                    if index_bit:
+                        ids_bits.append((index_bit, bit))
+            elif "devices" in rule:
+                for device_id in rule["devices"]:
+                    devices[device_id] = devices.get(device_id, 0) | bit
+            else:
+                any_mask |= bit
+            dispatch[(rule["class"], rule["vendor"])] = (any_mask, ids_bits, devices)
+
+        self.index = index
+        self.driver_names = tuple(rule["driver"] for rule in rules)
+        self.display_mask = 0
+        for number, rule in enumerate(rules):
+            if rule["class"] == DISPLAY_CLASS:
+                self.display_mask |= 1 << number
+        self.dispatch = dict(
+            (key, (any_mask, tuple(ids_bits), devices))
+            for key, (any_mask, ids_bits, devices) in dispatch.items())
+
+    def match(self, class_id, vendor_id, device_id):
+        """ Returns rules bitmask of a device, class_id is the 24 bit class code """
+        entry = self.dispatch.get((class_id >> 16, vendor_id))
+        if entry is None:
+            return 0
+        any_mask, ids_bits, devices = entry
+        mask = any_mask | devices.get(device_id, 0)
+        if ids_bits:
+            index_mask = self.index.lookup(vendor_id, device_id)
+            for index_bit, bit in ids_bits:
+                if index_mask & index_bit:
+                    mask |= bit
+        return mask
+
+    def drivers(self, mask):
+        """ Returns drivers of a rules bitmask in order of preference """
+        return [driver for number, driver in enumerate(self.driver_names) if mask & (1 << number)]
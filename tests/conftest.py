@@ -0,0 +1,14 @@
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules of fx-drivers live in the repository root
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(autouse=True)
+def repository_root(monkeypatch):
+    """ Runs every test in the repository root, the pci ids files are found relative to it """
+    monkeypatch.chdir(ROOT)
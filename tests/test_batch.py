@@ -0,0 +1,45 @@
+import batch
+import rules
+
+
+class EmptyIndex(object):
+    """ Compiled ids index without any entry """
+
+    records = b""
+
+    def bit(self, name):
+        return 0
+
+    def lookup(self, vendor_id, device_id):
+        return 0
+
+
+CUSTOM_RULES = [
+    {"driver": "first", "class": 0x03, "vendor": 0x10de, "devices": [0x1b80]},
+    {"driver": "second", "class": 0x03, "vendor": 0x10de, "any_device": True}]
+
+
+def test_detect_inventory_names_drivers_of_the_table():
+    table = rules.RuleTable(EmptyIndex(), CUSTOM_RULES)
+    columns = {"host": ["a", "a", "b", "c"],
+               "class": [0x030000, 0x020000, 0x030000, 0x030000],
+               "vendor": [0x10de, 0x8086, 0x10de, 0x1002],
+               "device": [0x1b80, 0x15f2, 0x1c03, 0x67df]}
+    assert batch.detect_inventory(columns, table) == [("a", "first"), ("b", "second"), ("c", None)]
+
+
+def test_detect_batch_with_empty_index():
+    table = rules.RuleTable(EmptyIndex(), CUSTOM_RULES)
+    masks = batch.detect_batch([0, 1], [0x030000, 0x030000], [0x10de, 0x8086], [0x1c03, 0x1234], table=table)
+    assert masks.tolist() == [2, 0]
+
+
+def test_detect_inventory_recommends_graphics_drivers_only():
+    table = rules.RuleTable(EmptyIndex(), [
+        {"driver": "wireless", "class": 0x02, "vendor": 0x14e4, "devices": [0x4360]},
+        {"driver": "graphics", "class": 0x03, "vendor": 0x10de, "any_device": True}])
+    columns = {"host": ["a", "a", "b"],
+               "class": [0x020000, 0x030000, 0x020000],
+               "vendor": [0x14e4, 0x10de, 0x14e4],
+               "device": [0x4360, 0x1b80, 0x4360]}
+    assert batch.detect_inventory(columns, table) == [("a", "graphics"), ("b", None)]
@@ -0,0 +1,31 @@
+import detectcache
+
+
+def test_hit_on_stale_entry_is_saved(tmp_path):
+    path = str(tmp_path / "detect.json")
+    cache = detectcache.DetectionCache(path)
+    cache.put("key", ["nvidia"])
+    cache.entries["key"]["used"] -= detectcache.USED_INTERVAL + 1
+    cache.save()
+
+    cache = detectcache.DetectionCache.load(path)
+    assert cache.get("key") == ["nvidia"]
+    assert cache.changed
+    cache.save()
+    assert not cache.changed
+
+    cache = detectcache.DetectionCache.load(path)
+    assert cache.get("key") == ["nvidia"]
+    assert not cache.changed
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path):
+    cache = detectcache.DetectionCache(str(tmp_path / "detect.json"), max_entries=2)
+    cache.put("old", ["intel"])
+    cache.put("new", ["amdgpu"])
+    cache.entries["old"]["used"] -= 2 * detectcache.USED_INTERVAL
+    cache.entries["new"]["used"] -= 3 * detectcache.USED_INTERVAL
+    # The hit makes old the most recently used entry
+    cache.get("old")
+    cache.put("newest", ["nvidia"])
+    assert sorted(cache.entries) == ["newest", "old"]
@@ -0,0 +1,31 @@
+import pytest
+import devutils
+
+# Recorded (sysfs vendor id, lspci description, expected vendor) samples
+VENDOR_SAMPLES = (
+    (0x10de, "NVIDIA Corporation GP107M [GeForce GTX 1050 Ti Mobile] (rev a1)", "nvidia"),
+    (0x10de, "NVIDIA Corporation GK208B [GeForce GT 710] (rev a1)", "nvidia"),
+    (0x1002, "Advanced Micro Devices, Inc. [AMD/ATI] Ellesmere [Radeon RX 470/480/570/570X/580/580X/590] (rev e7)", "amd"),
+    (0x1002, "Advanced Micro Devices, Inc. [AMD/ATI] Picasso (rev c2)", "amd"),
+    (0x1002, "ATI Technologies Inc RV370 [Radeon X300SE]", "amd"),
+    (0x8086, "Intel Corporation UHD Graphics 620 (rev 07)", "intel"),
+    (0x8086, "Intel Corporation HD Graphics 530 (rev 06)", "intel"),
+    (0x80ee, "InnoTek Systemberatung GmbH VirtualBox Graphics Adapter", "virtualbox"),
+    (0x15ad, "VMware SVGA II Adapter", "vmware"),
+    (0x1234, "Device 1234:1111 (rev 02)", "qemu"),
+    (0x14e4, "Broadcom Inc. and subsidiaries BCM4360 802.11ac Wireless Network Adapter (rev 03)", "broadcom"),
+    (0x1a03, "ASPEED Technology, Inc. ASPEED Graphics Family (rev 41)", "aspeed"),
+    (0x5333, "S3 Graphics Ltd. 86c764/765 [Trio32/64/64V+]", "unknown"),
+    (None, "NVIDIA Corporation TU116 [GeForce GTX 1660 SUPER] (rev a1)", "nvidia"),
+    (None, "Advanced Micro Devices, Inc. [AMD/ATI] Navi 10 [Radeon RX 5600 OEM/5600 XT / 5700/5700 XT] (rev c1)", "amd"),
+    (None, "ATI Technologies Inc RV280 [Radeon 9200 PRO]", "ati"),
+    (None, "Intel Corporation Xeon E3-1200 v3/4th Gen Core Processor Integrated Graphics Controller", "intel"),
+    (None, "InnoTek Systemberatung GmbH VirtualBox Graphics Adapter", "virtualbox"),
+    (None, "Matrox Electronics Systems Ltd. MGA G200e [Pilot] ServerEngines (SEP1) (rev 05)", "matrox"),
+    (None, "Red Hat, Inc. Virtio GPU (rev 01)", "unknown"),
+    (None, "", "unknown"))
+
+
+@pytest.mark.parametrize("vendor_id, text, expected", VENDOR_SAMPLES)
+def test_classify_vendor(vendor_id, text, expected):
+    assert devutils.classify_vendor(vendor_id, text) == expected
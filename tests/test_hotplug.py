@@ -0,0 +1,38 @@
+import os
+import hotplug
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fixtures")
+
+
+def test_replay_egpu_dock_and_undock():
+    snapshot, events = hotplug.read_event_log(os.path.join(FIXTURES, "hotplug-egpu.jsonl"))
+    state = hotplug.DetectionState(snapshot)
+    assert state.drivers == ["intel"]
+
+    changes = []
+    hotplug.watch(state, events, lambda uevent, old, new: changes.append((uevent.action, old, new)))
+    assert changes == [
+        ("add", ["intel"], ["nvidia", "nvidia-390xx", "intel"]),
+        ("remove", ["nvidia", "nvidia-390xx", "intel"], ["intel"])]
+
+
+def test_apply_keeps_the_old_state():
+    snapshot, events = hotplug.read_event_log(os.path.join(FIXTURES, "hotplug-egpu.jsonl"))
+    state = hotplug.DetectionState(snapshot)
+    docked = state
+    for uevent in events:
+        docked = docked.apply(uevent)
+        if "nvidia" in docked.drivers:
+            break
+    assert state.drivers == ["intel"]
+    assert len(docked.snapshot.devices) > len(state.snapshot.devices)
+
+
+def test_read_event_log_keeps_last_session(tmp_path):
+    with open(os.path.join(FIXTURES, "hotplug-egpu.jsonl")) as log_file:
+        session = log_file.read()
+    path = tmp_path / "twice.jsonl"
+    path.write_text(session + session)
+    _, events = hotplug.read_event_log(str(path))
+    _, once = hotplug.read_event_log(os.path.join(FIXTURES, "hotplug-egpu.jsonl"))
+    assert events == once
@@ -0,0 +1,48 @@
+import pytest
+import device
+import pkgbackend
+import pkgrepo
+
+
+def test_fake_backend_transaction():
+    backend = pkgbackend.FakeBackend(["xf86-video-nouveau", "mesa"], ["nvidia", "nvidia-utils"])
+    backend.transaction(["xf86-video-nouveau"], ["nvidia", "nvidia-utils"])
+    assert backend.installed_packages() == {"mesa", "nvidia", "nvidia-utils"}
+    assert backend.transactions == [(["xf86-video-nouveau"], ["nvidia", "nvidia-utils"])]
+
+
+def test_fake_backend_missing_target_changes_nothing():
+    backend = pkgbackend.FakeBackend(["mesa"], ["nvidia"])
+    with pytest.raises(pkgbackend.PackageError, match="nvidia-utils"):
+        backend.transaction([], ["nvidia", "nvidia-utils"])
+    assert backend.installed_packages() == {"mesa"}
+    assert backend.transactions == []
+
+
+def test_change_packages_runs_one_transaction(monkeypatch, tmp_path):
+    backend = pkgbackend.FakeBackend(["xf86-video-nouveau"], ["nvidia", "nvidia-utils"])
+    monkeypatch.setattr(device, "BACKEND", backend)
+    monkeypatch.setattr(pkgrepo, "LOCAL_REPO", str(tmp_path / "repo"))
+    assert device.change_packages(["xf86-video-nouveau"], ["nvidia", "nvidia-utils"])
+    assert backend.transactions == [(["xf86-video-nouveau"], ["nvidia", "nvidia-utils"])]
+
+
+def test_change_packages_reports_failure(monkeypatch, tmp_path):
+    backend = pkgbackend.FakeBackend(["xf86-video-nouveau"], [])
+    monkeypatch.setattr(device, "BACKEND", backend)
+    monkeypatch.setattr(pkgrepo, "LOCAL_REPO", str(tmp_path / "repo"))
+    assert device.change_packages(["xf86-video-nouveau"], ["nvidia"]) is False
+    assert backend.installed_packages() == {"xf86-video-nouveau"}
+
+
+def test_pacman_commands_match_transaction():
+    assert pkgbackend.pacman_commands(["a"], ["b"], refresh=False, root="/mnt") == [
+        ["pacman", "-Rs", "--noconfirm", "--noprogressbar", "--nodeps", "--sysroot", "/mnt", "a"],
+        ["pacman", "-Sq", "--noconfirm", "--noprogressbar", "--sysroot", "/mnt", "b"]]
+
+
+def test_questions_are_answered_like_noconfirm():
+    assert pkgbackend.answer_question(pkgbackend.QUESTION_SELECT_PROVIDER) == 0
+    # Replace and conflict questions
+    assert pkgbackend.answer_question(1 << 1) == 1
+    assert pkgbackend.answer_question(1 << 2) == 1
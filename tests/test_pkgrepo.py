@@ -0,0 +1,125 @@
+import os
+import shutil
+import pkgrepo
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fixtures")
+
+# file:// stand-in for a pacman mirror, core has nvidia, nvidia-utils,
+# glibc and nvidia-settings, which depends on libfoo the mirror lacks
+MIRROR = "file://" + os.path.join(FIXTURES, "mirror", "$repo", "os", "$arch")
+
+
+def make_local_db(path, kernel_version):
+    """ Creates pacman local database with one kernel installed """
+    shutil.rmtree(str(path), ignore_errors=True)
+    os.makedirs(os.path.join(str(path), "linux-" + kernel_version))
+    return str(path)
+
+
+def make_sync_db(path, packages):
+    """ Creates <path>/sync/core.db of packages, returns the DBPath """
+    os.makedirs(os.path.join(str(path), "sync"), exist_ok=True)
+    pkgrepo.build_repo_db(packages, os.path.join(str(path), "sync", "core.db"))
+    return str(path)
+
+
+def prefetch(tmp_path, names=("nvidia", "nvidia-settings"), log=None):
+    return pkgrepo.prefetch(
+        MIRROR, str(tmp_path / "repo"), ("core",), "x86_64", list(names), log,
+        local_db=make_local_db(tmp_path / "local", "6.9.1.arch1-1"))
+
+
+def test_resolve_closure_reports_missing_dependencies():
+    packages = pkgrepo.load_sync_dbs(MIRROR, ("core",), "x86_64")
+    closure, missing = pkgrepo.resolve_closure(["nvidia", "nvidia-settings"], packages)
+    assert sorted(closure) == ["glibc", "nvidia", "nvidia-settings", "nvidia-utils"]
+    assert missing == ["libfoo"]
+
+
+def test_resolve_closure_follows_provides():
+    packages = pkgrepo.load_sync_dbs(MIRROR, ("core",), "x86_64")
+    closure, missing = pkgrepo.resolve_closure(["libgl"], packages)
+    assert sorted(closure) == ["glibc", "nvidia-utils"]
+    assert missing == []
+
+
+def test_prefetch_downloads_closure(tmp_path):
+    messages = []
+    repo = prefetch(tmp_path, log=messages.append)
+    repo_dir = tmp_path / "repo"
+    for package in ("nvidia", "nvidia-utils", "glibc", "nvidia-settings"):
+        assert (repo_dir / repo.files[package]).is_file()
+    assert repo.missing == ["libfoo"]
+    assert repo.kernels == {"linux": "6.9.1.arch1-1"}
+    assert any(message.startswith("Not found in core: libfoo") for message in messages)
+
+    repo_db = pkgrepo.parse_sync_db(pkgrepo.REPO_NAME, (repo_dir / (pkgrepo.REPO_NAME + ".db")).read_bytes())
+    assert sorted(package.name for package in repo_db) == ["glibc", "nvidia", "nvidia-settings", "nvidia-utils"]
+
+
+def test_prefetch_again_downloads_nothing(tmp_path):
+    prefetch(tmp_path)
+    messages = []
+    prefetch(tmp_path, log=messages.append)
+    assert not [message for message in messages if message.startswith("Downloaded")]
+
+
+def test_covers_checks_dependency_closure(tmp_path):
+    repo = prefetch(tmp_path)
+    assert repo.covers(["nvidia"])
+    assert repo.covers(["libgl"])
+    assert not repo.covers(["nvidia-settings"])
+    assert not repo.covers(["nvidia", "bumblebee"])
+
+
+def test_manifest_round_trip(tmp_path):
+    repo = prefetch(tmp_path)
+    loaded = pkgrepo.LocalRepo(str(tmp_path / "repo"), **repo.to_dict())
+    assert loaded.to_dict() == repo.to_dict()
+    if os.uname().machine == "x86_64":
+        assert pkgrepo.LocalRepo.load(str(tmp_path / "repo")).to_dict() == repo.to_dict()
+
+
+def test_is_current_compares_sync_versions_and_kernels(tmp_path):
+    repo = prefetch(tmp_path)
+    packages = pkgrepo.load_sync_dbs(MIRROR, ("core",), "x86_64")
+    local_db = str(tmp_path / "local")
+
+    db_path = make_sync_db(tmp_path / "db", packages.values())
+    assert repo.is_current(["nvidia"], db_path, local_db)
+
+    make_local_db(tmp_path / "local", "6.10.arch1-1")
+    assert not repo.is_current(["nvidia"], db_path, local_db)
+    make_local_db(tmp_path / "local", "6.9.1.arch1-1")
+
+    newer = packages["nvidia"]
+    newer_desc = newer.desc.replace("550.1-1", "555.2-1")
+    packages["nvidia"] = pkgrepo.SyncPackage("core", newer_desc)
+    db_path = make_sync_db(tmp_path / "newer", packages.values())
+    assert not repo.is_current(["nvidia"], db_path, local_db)
+    # glibc alone did not change
+    assert repo.is_current(["glibc"], db_path, local_db)
+
+
+def test_build_repo_db_round_trip(tmp_path):
+    packages = pkgrepo.load_sync_dbs(MIRROR, ("core",), "x86_64")
+    path = str(tmp_path / "test.db")
+    pkgrepo.build_repo_db(packages.values(), path)
+    with open(path, "rb") as db_file:
+        rebuilt = pkgrepo.parse_sync_db("test", db_file.read())
+    assert sorted((package.name, package.version, package.desc) for package in rebuilt) == \
+        sorted((package.name, package.version, package.desc) for package in packages.values())
+
+
+def test_add_repo_section_goes_first():
+    config = "[options]\nDBPath = /var/lib/pacman/\n\n[core]\nInclude = /etc/pacman.d/mirrorlist\n"
+    result = pkgrepo.add_repo_section(config, "/var/cache/fx-drivers/repo")
+    assert result.index("[fx-drivers]") > result.index("[options]")
+    assert result.index("[fx-drivers]") < result.index("[core]")
+    assert "Server = file:///var/cache/fx-drivers/repo\n" in result
+    assert pkgrepo.pacman_option(result, "DBPath", None) == "/var/lib/pacman/"
+
+
+def test_add_repo_section_without_repositories():
+    result = pkgrepo.add_repo_section("[options]\n", "/repo")
+    assert result.rstrip().endswith("Server = file:///repo")
@@ -0,0 +1,13 @@
+import provision
+
+
+def test_log_dir_names_are_unique():
+    first = provision.log_dir_name(provision.Target("/a/b_c", "nvidia"))
+    second = provision.log_dir_name(provision.Target("/a_b/c", "nvidia"))
+    assert first != second
+    assert first.startswith("a_b_c-")
+
+
+def test_parse_target():
+    target = provision.parse_target("/srv/images/a=b=nvidia")
+    assert target == provision.Target("/srv/images/a=b", "nvidia")
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  tracing module
+#
+#  Copyright © 2019 Favourix <vladimir.kokes@favourix.com
+#  This file is part of fx-drivers (Favourix OS Driver manager).
+#
+#  Favourix is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Favourix is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Favourix; If not, see <http://www.gnu.org/licenses/>.
+
+""" Structured logging and timing spans
+
+Log messages are str.format templates formatted only when a handler
+emits them. The log file gets one json object per record; colors are
+added by the terminal handler only.
+
+span() measures a phase of the work. Spans nest per thread, every record
+logged inside one carries the span path, and finished spans can be
+written as a Chrome trace (chrome://tracing, Perfetto). count() counts
+events like forks and cache hits; metrics exports both.
+"""
+
+import collections
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+YELLOW = '\033[93m'
+GREEN = '\033[92m'
+RED = '\033[91m'
+ENDC = '\033[0m'
+
+LEVEL_COLORS = {
+    logging.INFO: GREEN,
+    logging.WARNING: YELLOW,
+    logging.ERROR: RED,
+    logging.CRITICAL: RED}
+
+Span = collections.namedtuple("Span", ["name", "start", "duration", "thread", "parent", "args"])
+Span.__doc__ = """ Finished span, start and duration in seconds of time.perf_counter() """
+
+# Finished spans kept, a long-running daemon drops the oldest
+MAX_SPANS = 10000
+
+# Finished spans of this process, oldest first
+SPANS = collections.deque(maxlen=MAX_SPANS)
+
+# Spans finished by this process, including dropped ones
+_FINISHED = 0
+
+_SPANS_LOCK = threading.Lock()
+
+# Open spans of every thread
+_LOCAL = threading.local()
+
+# Event counts of this process by (name, sorted label pairs)
+COUNTERS = collections.Counter()
+
+
+class Message(object):
+    """ str.format template formatted on first use """
+
+    __slots__ = ("template", "args")
+
+    def __init__(self, template, args):
+        self.template = template
+        self.args = args
+
+    def __str__(self):
+        if not self.args:
+            return self.template
+        return self.template.format(*self.args)
+
+
+def _stack():
+    """ Returns names of the spans open in this thread """
+    stack = getattr(_LOCAL, "stack", None)
+    if stack is None:
+        stack = _LOCAL.stack = []
+    return stack
+
+
+def current_span():
+    """ Returns path of open spans of this thread, "" outside of spans """
+    return "/".join(_stack())
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    """ Times the enclosed block as span name """
+    global _FINISHED
+    stack = _stack()
+    parent = "/".join(stack)
+    stack.append(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        stack.pop()
+        with _SPANS_LOCK:
+            SPANS.append(Span(name, start, duration, threading.get_ident(), parent, args))
+            _FINISHED += 1
+        logging.debug(Message("{0} took {1:.3f} s", (name, duration)))
+
+
+def finished_spans(start=0):
+    """ Returns (spans finished since the first start ones, number finished so far)
+
+    Spans dropped from SPANS are missing from the list.
+    """
+    with _SPANS_LOCK:
+        skip = max(start - (_FINISHED - len(SPANS)), 0)
+        return list(SPANS)[skip:], _FINISHED
+
+
+def count(name, value=1, **labels):
+    """ Adds value to counter name with labels """
+    key = (name, tuple(sorted(labels.items())))
+    with _SPANS_LOCK:
+        COUNTERS[key] += value
+
+
+def counter(name, **labels):
+    """ Returns value of counter name with labels not yet taken """
+    with _SPANS_LOCK:
+        return COUNTERS[(name, tuple(sorted(labels.items())))]
+
+
+def take_counters():
+    """ Returns counts since the last call and resets them """
+    with _SPANS_LOCK:
+        counters = dict(COUNTERS)
+        COUNTERS.clear()
+    return counters
+
+
+def chrome_trace(spans=None):
+    """ Returns spans as Chrome trace event dictionary """
+    if spans is None:
+        with _SPANS_LOCK:
+            spans = list(SPANS)
+    pid = os.getpid()
+    threads = {}
+    events = []
+    for item in sorted(spans, key=lambda item: item.start):
+        tid = threads.setdefault(item.thread, len(threads) + 1)
+        events.append({
+            "name": item.name, "cat": item.parent.split("/")[0] or item.name, "ph": "X",
+            "ts": item.start * 1e6, "dur": item.duration * 1e6,
+            "pid": pid, "tid": tid, "args": dict(item.args)})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def write_chrome_trace(path, spans=None):
+    """ Writes spans to path in Chrome trace format """
+    with open(path, "w") as trace_file:
+        json.dump(chrome_trace(spans), trace_file)
+
+
+class SpanFilter(logging.Filter):
+    """ Adds path of the open spans to every record """
+
+    def filter(self, record):
+        record.span = current_span()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats a record as one json line """
+
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "thread": record.threadName}
+        if getattr(record, "span", ""):
+            entry["span"] = record.span
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class ColorFormatter(logging.Formatter):
+    """ Colors messages by level for a terminal """
+
+    def format(self, record):
+        line = logging.Formatter.format(self, record)
+        color = LEVEL_COLORS.get(record.levelno)
+        return color + line + ENDC if color else line